@@ -1,82 +1,353 @@
-import peachpy
-from peachpy import Argument, double_, Constant
-from peachpy import x86_64
-# workaround because peachpy forget to expose rsp
-x86_64.rsp = peachpy.x86_64.registers.rsp
+import os
+import struct
+import importlib.util
+import libm
+import linking
+import perfmap
+import peephole
+import encoder
+from encoder import Constant
+from compilestats import CompileStats
+
+# the encoders of FunctionAssembler: PeachPy, or the faster one of
+# encoder.py, which encodes only the instructions used by the compiler and
+# is used also when PeachPy is not installed
+ENCODERS = ('peachpy', 'direct')
+DEFAULT_ENCODER = (os.environ.get('JIT30MIN_ENCODER') or
+                   ('peachpy' if importlib.util.find_spec('peachpy')
+                    else 'direct'))
 
 
 class FunctionAssembler:
 
-    from peachpy.x86_64 import (xmm0, xmm1, xmm2, xmm3, xmm4,
-                                xmm5, xmm6, xmm7, xmm8, xmm9,
-                                xmm10, xmm11, xmm12, xmm13,
-                                xmm14, xmm15)
+    from encoder import (xmm0, xmm1, xmm2, xmm3, xmm4,
+                         xmm5, xmm6, xmm7, xmm8, xmm9,
+                         xmm10, xmm11, xmm12, xmm13,
+                         xmm14, xmm15)
+    from encoder import (rax, rcx, rdx, rsi, rdi, r8, r9, r10, r11, rsp,
+                         eax, al)
+    from encoder import qword, oword, Label
+
+    # the registers used to pass the arguments, in order
+    FLOAT_ARGS = (xmm0, xmm1, xmm2, xmm3, xmm4, xmm5, xmm6, xmm7)
+    INT_ARGS = (rdi, rsi, rdx, rcx, r8, r9)
 
-    def __init__(self, name, argnames):
+    def __init__(self, name, argnames, argtypes=None, optimize=True,
+                 encoder=None):
         self.name = name
+        self.argnames = argnames
         self.nargs = len(argnames)
-        args = [Argument(double_, name=name) for name in argnames]
-        self._peachpy_fn = x86_64.Function(name, args, double_)
+        if argtypes is None:
+            argtypes = ['double'] * self.nargs
+        self.argtypes = argtypes
+        self.encoder = encoder or DEFAULT_ENCODER
+        if self.encoder not in ENCODERS:
+            raise ValueError('unknown encoder: %s' % self.encoder)
+        self.frame_size = 0
+        self.stack_depth = 0 # bytes pushed by pushsd on top of the frame
+        # the (name, args) emitted so far, which _flush() passes through
+        # the peephole optimizer if optimize is True
+        self.instructions = []
+        self.optimize = optimize
+        self.ninstructions = 0 # not counting the labels
+        self.registers = set() # the names of the registers used
 
     def __getattr__(self, name):
-        obj = getattr(x86_64, name)
-        if type(obj) is type and issubclass(obj, x86_64.instructions.Instruction):
-            instr = obj
-            def emit(*args):
-                self._peachpy_fn.add_instruction(instr(*args))
-            return emit
-        else:
-            return obj
+        # the instructions: the operands are checked when encoding them
+        if not name.isupper():
+            raise AttributeError(name)
+        def emit(*args):
+            self.instructions.append((name, args))
+        return emit
 
     def const(self, val):
         return Constant.float64(float(val))
 
+    # pushsd, popsd, push and pop are buffered as pseudo-instructions, so
+    # that the peephole optimizer can turn a push followed by a pop into a
+    # move: see _expand()
+
     def pushsd(self, reg):
-        self.SUB(self.rsp, 16)
-        self.MOVSD(self.qword[self.rsp], reg)
+        self.instructions.append(('pushsd', (reg,)))
+        self.stack_depth += 16
 
     def popsd(self, reg):
-        self.MOVSD(reg, self.qword[self.rsp])
-        self.ADD(self.rsp, 16)
+        self.instructions.append(('popsd', (reg,)))
+        self.stack_depth -= 16
+
+    def push(self, reg):
+        # like pushsd, for general purpose registers: we always use 16 bytes
+        # to keep the stack aligned
+        self.instructions.append(('push', (reg,)))
+        self.stack_depth += 16
+
+    def pop(self, reg):
+        self.instructions.append(('pop', (reg,)))
+        self.stack_depth -= 16
+
+    def _expand(self, name, args):
+        """
+        Return the list of (name, args) which implement the instruction
+        """
+        if name in ('pushsd', 'push'):
+            move = 'MOVSD' if name == 'pushsd' else 'MOV'
+            return [('SUB', (self.rsp, 16)),
+                    (move, (self.qword[self.rsp],) + args)]
+        elif name in ('popsd', 'pop'):
+            move = 'MOVSD' if name == 'popsd' else 'MOV'
+            return [(move, args + (self.qword[self.rsp],)),
+                    ('ADD', (self.rsp, 16))]
+        return [(name, args)]
+
+    def _flush(self):
+        """
+        Optimize the buffered instructions and expand the
+        pseudo-instructions: then self.instructions is the final code
+        """
+        instructions = self.instructions
+        if self.optimize:
+            instructions = peephole.optimize(instructions)
+        self.instructions = [expanded for name, args in instructions
+                             for expanded in self._expand(name, args)]
+        self.ninstructions = 0
+        self.registers = set()
+        for name, args in self.instructions:
+            self.ninstructions += name != 'LABEL'
+            for arg in args:
+                regname = REGISTER_NAMES.get(id(arg))
+                if regname is not None:
+                    self.registers.add(regname)
+
+    def const_mask(self, bits):
+        """
+        A 16-byte constant with bits in both halves, as the operand of the
+        packed bitwise instructions
+        """
+        return Constant.uint64x2(bits, bits)
+
+    def call(self, index):
+        """
+        Call the index-th function of the module, see link()
+        """
+        self.CALL(Constant.uint64(linking.placeholder('call', index)))
+
+    def line_marker(self, line):
+        """
+        Mark the beginning of the code of a line, see perfmap
+        """
+        self.MOV(self.rax, perfmap.LINE_MARKER + line)
+
+    def count(self, index):
+        """
+        Increment the index-th counter of the buffer, see profiler
+        """
+        self.MOV(self.rax, Constant.uint64(linking.placeholder('counters')))
+        self.ADD(self.qword[self.rax + 8*index], 1)
+
+    def cycles(self, index, start):
+        """
+        Subtract (if start) or add the time stamp counter to the index-th
+        counter of the buffer. RDTSC writes edx:eax, and rdx might hold a
+        variable.
+        """
+        self.push(self.rdx)
+        self.RDTSC()
+        self.SHL(self.rdx, 32)
+        self.OR(self.rax, self.rdx)
+        self.MOV(self.rdx, Constant.uint64(linking.placeholder('counters')))
+        op = self.SUB if start else self.ADD
+        op(self.qword[self.rdx + 8*index], self.rax)
+        self.pop(self.rdx)
+
+    def call_extern(self, name):
+        """
+        Call the libm function name, through a constant which
+        linking.resolve() sets to its address
+        """
+        self.CALL(Constant.uint64(linking.placeholder(
+            'libm', libm.NAMES.index(name))))
+
+    def prologue(self, nslots, makes_calls=False):
+        """
+        Reserve nslots 16-byte stack slots. On entry rsp is 8 bytes off the
+        16-byte alignment because of the return address, so we add 8 bytes
+        of padding to keep the slots aligned. Functions which make calls
+        always need the padding, since the ABI requires rsp to be aligned
+        at each CALL.
+        """
+        if nslots or makes_calls:
+            self.frame_size = 16*nslots + 8
+            self.SUB(self.rsp, self.frame_size)
+
+    def epilogue(self):
+        assert self.stack_depth == 0
+        if self.frame_size:
+            self.ADD(self.rsp, self.frame_size)
+
+    def stack(self, offset):
+        """
+        The memory operand at rsp + offset
+        """
+        if offset:
+            return self.qword[self.rsp + offset]
+        return self.qword[self.rsp]
+
+    def stack_slot(self, n):
+        return self.stack(self.stack_depth + 16*n)
+
+    def arg_slot(self, n):
+        """
+        The n-th argument passed on the stack, above the return address
+        """
+        return self.qword[self.rsp + self.stack_depth + self.frame_size +
+                          8 + 8*n]
 
     def _encode(self):
+        """
+        Encode the final code with PeachPy and return the encoded function
+        """
+        import peachpy
+        from peachpy import Argument, double_, int64_t, ptr
+        from peachpy import x86_64
+        types = {
+            'double': double_,
+            'double*': ptr(double_),
+            'const double*': ptr(double_),
+            'int64_t': int64_t,
+            }
+        args = [Argument(types[argtype], name=name)
+                for name, argtype in zip(self.argnames, self.argtypes)]
+        self._peachpy_fn = x86_64.Function(self.name, args, double_)
+        labels = {} # id(Label) -> PeachPy Label
+        def convert(arg):
+            if isinstance(arg, encoder.Register):
+                # peachpy forgets to expose rsp
+                return getattr(peachpy.x86_64.registers, arg.name)
+            if isinstance(arg, encoder.Memory):
+                address = arg.address
+                expr = convert(address.base)
+                if address.index is not None:
+                    expr = expr + convert(address.index) * address.scale
+                if address.disp:
+                    expr = expr + address.disp
+                return getattr(x86_64, encoder.SIZES[arg.size])[expr]
+            if isinstance(arg, Constant):
+                return getattr(peachpy.Constant, arg.kind)(*arg.values)
+            if isinstance(arg, encoder.Label):
+                if id(arg) not in labels:
+                    labels[id(arg)] = x86_64.Label()
+                return labels[id(arg)]
+            return arg
+        for name, args in self.instructions:
+            instr = getattr(x86_64, name)(*[convert(arg) for arg in args])
+            self._peachpy_fn.add_instruction(instr)
         abi_func = self._peachpy_fn.finalize(x86_64.abi.detect())
         return abi_func.encode()
 
-    def assemble_and_relocate(self):
-        # this code has been copied and adapted from PeachPy: the goal is to
-        # put the data section immediately contiguous to the code section:
-        # this is suboptimal and dangerous because it mixes code and data and
-        # puts the data inside an mmap-ed region with the executable flag, but
-        # I don't want/don't have time to talk and explain this stuff during
-        # the talk. Please forgive me :)
-
-        encoded_func = self._encode()
+    def assemble(self, stats=None):
+        """
+        Return (code, consts, relocs, links). The constants are not part of
+        the code: relocs is a list of (offset, delta), and the 32-bit field
+        at offset must be set to delta + (address of consts - address of
+        code). See codearena.CodeArena.allocate. links is a list of
+        (offset, kind, arg) of the addresses which are known only when the
+        code is linked or loaded, see linking. The time spent is added to
+        stats, if given.
+        """
+        if stats is None:
+            stats = CompileStats()
+        with stats.phase('encode'):
+            self._flush()
+            if self.encoder == 'direct':
+                code, consts, fixups, _ = encoder.encode(self.instructions)
+            else:
+                encoded_func = self._encode()
         #print(); print(encoded_func.format())
-        code_segment = bytearray(encoded_func.code_section.content)
-        const_segment = bytearray(encoded_func.const_section.content)
-        const_offset = len(code_segment)
+        with stats.phase('relocate'):
+            if self.encoder != 'direct':
+                code, consts, fixups = self._peachpy_fixups(encoded_func)
+            return self._relocate(code, consts, fixups)
+
+    def _peachpy_fixups(self, encoded_func):
+        """
+        Return (code, consts, fixups) like encoder.encode()
+        """
+        code_segment = bytes(encoded_func.code_section.content)
+        const_segment = bytes(encoded_func.const_section.content)
 
-        # Apply relocations
         from peachpy.x86_64.meta import RelocationType
-        from peachpy.util import is_sint32
+        fixups = []
         for relocation in encoded_func.code_section.relocations:
             assert relocation.type == RelocationType.rip_disp32
             assert relocation.symbol in encoded_func.const_section.symbols
-            old_value = code_segment[relocation.offset] | \
-                (code_segment[relocation.offset + 1] << 8) | \
-                (code_segment[relocation.offset + 2] << 16) | \
-                (code_segment[relocation.offset + 3] << 24)
-
-            # this is the biggest difference wrt peachpy
-            new_value = (old_value + const_offset + relocation.symbol.offset +
-                         -relocation.program_counter)
-            #
-            assert is_sint32(new_value)
-            code_segment[relocation.offset] = new_value & 0xFF
-            code_segment[relocation.offset + 1] = (new_value >> 8) & 0xFF
-            code_segment[relocation.offset + 2] = (new_value >> 16) & 0xFF
-            code_segment[relocation.offset + 3] = (new_value >> 24) & 0xFF
+            offset = relocation.offset
+            addend = int.from_bytes(code_segment[offset:offset+4], 'little',
+                                    signed=True)
+            target = addend + relocation.symbol.offset
+            fixups.append((offset, target, relocation.program_counter))
         assert not encoded_func.const_section.relocations
+        return code_segment, const_segment, fixups
+
+    def _relocate(self, code, consts, fixups):
+        """
+        Turn the fixups into relocs and links, see linking: the calls to the
+        other functions of the module have only a link
+        """
+        relocs = []
+        links = []
+        seen = set()
+        for offset, target, pc in fixups:
+            value, = struct.unpack_from('<Q', consts, target)
+            link = linking.decode(value)
+            if link is not None and link[0] == 'call':
+                assert code[offset-2:offset] == b'\xff\x15' # CALL [rip+x]
+                links.append((offset,) + link)
+                continue
+            relocs.append((offset, target - pc))
+            if link is not None and target not in seen:
+                seen.add(target)
+                links.append((target,) + link)
+        return code, consts, relocs, links
+
+# id(register) -> name, to find the registers used by the instructions
+REGISTER_NAMES = dict((id(getattr(FunctionAssembler, name)), name)
+                      for name in ['xmm%d' % i for i in range(16)] +
+                      ['rax', 'rcx', 'rdx', 'rsi', 'rdi', 'r8', 'r9', 'r10',
+                       'r11'])
+
 
-        return code_segment + const_segment
+def link(functions):
+    """
+    Put together the results of assemble() of the functions of a module,
+    so that they can be loaded into a single block of memory. Return
+    (code, consts, relocs, links, offsets), where the code of functions[i]
+    starts at offsets[i]. Each CALL [rip+const] to the i-th function
+    becomes NOP; CALL rel32, which has the same length: the other links are
+    left to linking.resolve().
+    """
+    code = bytearray()
+    consts = bytearray()
+    relocs = []
+    links = []
+    calls = []
+    offsets = []
+    for fn_code, fn_consts, fn_relocs, fn_links in functions:
+        # align each function and its constants to 16 bytes
+        code += b'\x90' * (-len(code) % 16)
+        consts += bytes(-len(consts) % 16)
+        start = len(code)
+        offsets.append(start)
+        relocs += [(start + offset, delta + len(consts) - start)
+                   for offset, delta in fn_relocs]
+        for offset, kind, arg in fn_links:
+            if kind == 'call':
+                calls.append((start + offset, arg))
+            else:
+                links.append((len(consts) + offset, kind, arg))
+        code += fn_code
+        consts += fn_consts
+    for offset, index in calls:
+        # the return address is the same: the end of the 32-bit field
+        rel32 = offsets[index] - (offset + 4)
+        code[offset-2:offset+4] = b'\x90\xe8' + struct.pack('<i', rel32)
+    return bytes(code), bytes(consts), relocs, links, offsets
@@ -0,0 +1,19 @@
+"""
+Benchmarks of the JIT compiler. For each kernel, we measure:
+
+    - the compilation time, with the caches disabled
+
+    - the time of the first call of the compiled function
+
+    - the steady state time of the compiled function, and of the same
+      Python function run by CPython and optionally by PyPy
+
+Usage:
+
+    python -m bench run -o results.json
+    python -m bench run -k pi,mandelbrot --repeat 10 --pypy pypy3
+    python -m bench compare old.json new.json
+
+compare reports the kernels which are slower by more than --threshold, and
+exits with status 1 if there are any.
+"""
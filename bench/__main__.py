@@ -0,0 +1,51 @@
+import sys
+import json
+import argparse
+from bench import runner
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('run', help='run the benchmarks')
+    p.add_argument('-k', '--kernels',
+                   help='comma-separated names of the kernels to run')
+    p.add_argument('-n', '--repeat', type=int, default=5)
+    p.add_argument('--scale', type=float, default=1.0,
+                   help='multiply the size of the problems')
+    p.add_argument('--pypy', help='the PyPy executable to compare with')
+    p.add_argument('--no-python', action='store_true',
+                   help="don't run the interpreted functions")
+    p.add_argument('--python-only', action='store_true',
+                   help="don't run the compiled functions")
+    p.add_argument('-o', '--output', help="write the results as JSON; "
+                   "'-' means stdout")
+    p = subparsers.add_parser('compare', help='compare two results')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.1,
+                   help='the slowdown reported as a regression')
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        names = args.kernels.split(',') if args.kernels else None
+        results = runner.run(names, args.scale, args.repeat,
+                             jit=not args.python_only,
+                             python=not args.no_python, pypy=args.pypy)
+        if args.output == '-':
+            json.dump(results, sys.stdout, indent=2)
+        elif args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        out = sys.stderr if args.output == '-' else sys.stdout
+        print(runner.format_results(results), file=out)
+        return 0
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows = runner.compare(old, new, args.threshold)
+    print(runner.format_comparison(rows, args.threshold))
+    return 1 if any(row[-1] for row in rows) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+The benchmarked functions. They are written in the subset of Python
+supported by the compiler, and this module does not import jit, so that
+they can also be run by PyPy.
+"""
+import array
+from math import sqrt
+
+
+def compute_pi(iterations: int):
+    # the same algorithm as pi.py
+    delta = 1.0 / iterations
+    inside = 0
+    for i in range(iterations):
+        x = i * delta
+        for j in range(iterations):
+            y = j * delta
+            if x*x + y*y < 1:
+                inside = inside + 1
+    return inside / (iterations * iterations) * 4
+
+def mandelbrot(size: int, maxiter: int):
+    step = 3.0 / size
+    inside = 0
+    for i in range(size):
+        ci = i * step - 1.5
+        for j in range(size):
+            cr = j * step - 2.0
+            zr = 0.0
+            zi = 0.0
+            n = 0
+            while n < maxiter:
+                zr2 = zr * zr
+                zi2 = zi * zi
+                if zr2 + zi2 > 4.0:
+                    break
+                zi = 2.0 * zr * zi + ci
+                zr = zr2 - zi2 + cr
+                n = n + 1
+            if n == maxiter:
+                inside = inside + 1
+    return inside
+
+def kinetic_energy(vx, vy, n: int):
+    energy = 0.0
+    for i in range(n):
+        energy = energy + 0.5 * (vx[i]*vx[i] + vy[i]*vy[i])
+    return energy
+
+def nbody(x, y, vx, vy, n: int, steps: int, dt):
+    for step in range(steps):
+        for i in range(n):
+            ax = 0.0
+            ay = 0.0
+            for j in range(n):
+                dx = x[j] - x[i]
+                dy = y[j] - y[i]
+                # softened, so that i == j does not divide by zero
+                d2 = dx*dx + dy*dy + 0.01
+                inv = 1.0 / (d2 * sqrt(d2))
+                ax = ax + dx * inv
+                ay = ay + dy * inv
+            vx[i] = vx[i] + ax * dt
+            vy[i] = vy[i] + ay * dt
+        for i in range(n):
+            x[i] = x[i] + vx[i] * dt
+            y[i] = y[i] + vy[i] * dt
+    return kinetic_energy(vx, vy, n)
+
+def dot(a, b, n: int):
+    total = 0.0
+    for i in range(n):
+        total = total + a[i] * b[i]
+    return total
+
+def poly(x):
+    # Horner's scheme
+    return ((((((0.5*x - 1.5)*x + 2.0)*x - 0.25)*x + 3.0)*x - 1.0)*x + 0.75)
+
+
+class Kernel:
+    """
+    A benchmark: setup(scale) returns a fresh list of arguments for a
+    problem whose size is proportional to scale. If map is True, the
+    function is applied to each element of the arrays with map().
+    """
+
+    def __init__(self, name, fn, setup, map=False):
+        self.name = name
+        self.fn = fn
+        self.setup = setup
+        self.map = map
+
+    def run_python(self, args):
+        if self.map:
+            return list(map(self.fn, *args))
+        return self.fn(*args)
+
+    def run_compiled(self, compiled, args):
+        if self.map:
+            return list(compiled.map(*args))
+        return compiled(*args)
+
+
+def size(n, scale):
+    return max(1, int(n * scale))
+
+def floats(n, seed):
+    # deterministic pseudo-random values in [0, 1)
+    return array.array('d', [((i + 1) * seed * 0.6180339887) % 1.0
+                             for i in range(n)])
+
+def nbody_setup(scale):
+    n = size(64, scale)
+    return [floats(n, 1), floats(n, 2), array.array('d', bytes(8*n)),
+            array.array('d', bytes(8*n)), n, 10, 0.001]
+
+def dot_setup(scale):
+    n = size(1000000, scale)
+    return [floats(n, 3), floats(n, 4), n]
+
+KERNELS = [
+    Kernel('pi', compute_pi, lambda scale: [size(1000, scale**0.5)]),
+    Kernel('mandelbrot', mandelbrot,
+           lambda scale: [size(200, scale**0.5), 100]),
+    Kernel('nbody', nbody, nbody_setup),
+    Kernel('dot', dot, dot_setup),
+    Kernel('poly', poly, lambda scale: [floats(size(1000000, scale), 5)],
+           map=True),
+    ]
+
+def get_kernels(names=None):
+    """
+    Return the kernels with the given names, or all of them if names is None
+    """
+    if names is None:
+        return list(KERNELS)
+    by_name = {kernel.name: kernel for kernel in KERNELS}
+    for name in names:
+        if name not in by_name:
+            raise ValueError('unknown kernel %r, expected one of: %s' %
+                             (name, ', '.join(by_name)))
+    return [by_name[name] for name in names]
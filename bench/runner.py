@@ -0,0 +1,190 @@
+"""
+Measure the kernels and compare the results of two runs.
+
+The results are a dict which can be saved as JSON:
+
+    {'info': {...},
+     'kernels': {name: {metric: {'min': ..., 'median': ..., ...}}}}
+
+where the metrics are 'compile', 'first_call' and 'jit' for the compiled
+function, and 'python' or 'pypy' for the interpreted one. All the times
+are in seconds.
+"""
+import os
+import sys
+import json
+import math
+import time
+import platform
+import statistics
+import contextlib
+import subprocess
+from bench.kernels import get_kernels
+
+# the metrics which measure the JIT: the baselines are not compared
+JIT_METRICS = ('compile', 'first_call', 'jit')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def stats(times):
+    return dict(min=min(times), median=statistics.median(times),
+                mean=statistics.fmean(times),
+                stdev=statistics.stdev(times) if len(times) > 1 else 0.0,
+                runs=len(times))
+
+def timed(f, *args):
+    """
+    Return (seconds, result) of f(*args)
+    """
+    start = time.perf_counter()
+    result = f(*args)
+    return time.perf_counter() - start, result
+
+def measure(f, args, repeat, warmup=1):
+    for i in range(warmup):
+        f(*args)
+    return stats([timed(f, *args)[0] for i in range(repeat)])
+
+
+@contextlib.contextmanager
+def no_caches(jit):
+    old = jit.compile_cache, jit.disk_cache
+    jit.compile_cache = jit.disk_cache = None
+    try:
+        yield
+    finally:
+        jit.compile_cache, jit.disk_cache = old
+
+def bench_jit(kernel, scale, repeat):
+    import jit
+    src = jit.getsource(kernel.fn)
+    compile_times = []
+    first_calls = []
+    with no_caches(jit):
+        for i in range(repeat):
+            args = kernel.setup(scale)
+            t, compiled = timed(jit.compile_source, src)
+            compile_times.append(t)
+            t, result = timed(kernel.run_compiled, compiled, args)
+            first_calls.append(t)
+            compiled.free()
+        compiled = jit.compile_source(src)
+    try:
+        result = kernel.run_compiled(compiled, kernel.setup(scale))
+        steady = measure(kernel.run_compiled, (compiled, kernel.setup(scale)),
+                         repeat)
+    finally:
+        compiled.free()
+    return dict(compile=stats(compile_times), first_call=stats(first_calls),
+                jit=steady), result
+
+def bench_python(kernel, scale, repeat):
+    result = kernel.run_python(kernel.setup(scale))
+    return measure(kernel.run_python, (kernel.setup(scale),), repeat), result
+
+def same_result(a, b):
+    if isinstance(a, list):
+        return len(a) == len(b) and all(map(same_result, a, b))
+    return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-12)
+
+
+def info():
+    return dict(python=sys.version,
+                implementation=platform.python_implementation(),
+                machine=platform.machine(), time=time.time())
+
+def run(names=None, scale=1.0, repeat=5, jit=True, python=True, pypy=None,
+        log=sys.stderr):
+    """
+    Run the kernels and return the results. pypy is the path of the PyPy
+    executable, which runs the Python version of the kernels in a separate
+    process.
+    """
+    kernels = get_kernels(names)
+    results = dict(info=info(), kernels={})
+    if jit:
+        import cpu
+        results['info']['cpu_features'] = sorted(cpu.features())
+    baseline = platform.python_implementation().lower()
+    for kernel in kernels:
+        log.write('%s...\n' % kernel.name)
+        res = results['kernels'][kernel.name] = {}
+        jit_result = py_result = None
+        if jit:
+            metrics, jit_result = bench_jit(kernel, scale, repeat)
+            res.update(metrics)
+        if python:
+            res[baseline], py_result = bench_python(kernel, scale, repeat)
+        if jit and python and not same_result(jit_result, py_result):
+            log.write('WARNING: %s: the compiled function returned %r '
+                      'instead of %r\n' % (kernel.name, jit_result, py_result))
+            res['mismatch'] = True
+    if pypy is not None:
+        other = run_pypy(pypy, [kernel.name for kernel in kernels], scale,
+                         repeat)
+        for name, metrics in other['kernels'].items():
+            results['kernels'][name]['pypy'] = metrics['pypy']
+    return results
+
+def run_pypy(pypy, names, scale, repeat):
+    cmd = [pypy, '-m', 'bench', 'run', '--python-only', '-o', '-',
+           '-k', ','.join(names), '--scale', str(scale),
+           '--repeat', str(repeat)]
+    output = subprocess.run(cmd, cwd=ROOT, check=True, stdout=subprocess.PIPE)
+    return json.loads(output.stdout)
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Compare the median times of the JIT metrics of two results. Return
+    [(kernel, metric, old, new, regression)], where regression is True if
+    new is slower than old by more than threshold.
+    """
+    rows = []
+    for name, metrics in new['kernels'].items():
+        old_metrics = old['kernels'].get(name, {})
+        for metric in JIT_METRICS:
+            if metric in metrics and metric in old_metrics:
+                a = old_metrics[metric]['median']
+                b = metrics[metric]['median']
+                rows.append((name, metric, a, b, b > a * (1 + threshold)))
+    return rows
+
+
+def format_time(t):
+    if t < 1e-3:
+        return '%.1f us' % (t * 1e6)
+    if t < 1:
+        return '%.2f ms' % (t * 1e3)
+    return '%.3f s' % t
+
+def format_results(results):
+    metrics = ['compile', 'first_call', 'jit', 'cpython', 'pypy']
+    lines = ['%-12s' % 'kernel' + ''.join('%14s' % m for m in metrics) +
+             '%10s' % 'speedup']
+    for name, res in results['kernels'].items():
+        line = '%-12s' % name
+        for metric in metrics:
+            if metric in res:
+                line += '%14s' % format_time(res[metric]['median'])
+            else:
+                line += '%14s' % '-'
+        if 'jit' in res and 'cpython' in res:
+            speedup = res['cpython']['median'] / res['jit']['median']
+            line += '%9.1fx' % speedup
+        lines.append(line)
+    return '\n'.join(lines)
+
+def format_comparison(rows, threshold):
+    lines = ['%-12s%12s%14s%14s%10s' % ('kernel', 'metric', 'old', 'new',
+                                         'change')]
+    for name, metric, a, b, regression in rows:
+        line = '%-12s%12s%14s%14s%+9.1f%%' % (name, metric, format_time(a),
+                                             format_time(b), (b/a - 1) * 100)
+        if regression:
+            line += '  REGRESSION'
+        lines.append(line)
+    nregressions = sum(row[-1] for row in rows)
+    lines.append('%d regression(s) over %.0f%%' % (nregressions,
+                                                    threshold * 100))
+    return '\n'.join(lines)
@@ -0,0 +1,192 @@
+"""
+Shared memory for the machine code of compiled functions.
+
+Instead of mmap-ing one page per function, the arena bump-allocates the
+functions into big chunks. Each chunk is a memfd which is mapped twice:
+
+  - a writable view, which is never executable, used to copy the code;
+
+  - an executable view, which is never writable: the code area is mapped
+    as read+exec, and the constants are placed in a separate area of
+    read-only pages at the end of the chunk.
+
+This way we never need to flip the protection of a page which might contain
+a running function, and the code can refer to its constants with a 32-bit
+rip-relative displacement, since they are in the same chunk.
+
+When all the functions in a chunk have been freed, the chunk is unmapped.
+free() is called by the finalizers of the compiled functions, which can run
+at any allocation, even inside allocate(): so it never waits for the lock,
+and if it is taken, the block is released by the next call to the arena.
+"""
+import os
+import mmap
+import struct
+import threading
+from cffi import FFI
+
+ffi = FFI()
+ffi.cdef("int mprotect(void *addr, size_t len, int prot);")
+libc = ffi.dlopen(None)
+
+PAGE = mmap.PAGESIZE
+CHUNK_SIZE = 256*1024
+CONSTS_SIZE = 32*1024 # size of the constants area of each chunk
+ALIGN = 16
+INT3 = b'\xcc'
+
+def round_up(n, align):
+    return (n + align - 1) & ~(align - 1)
+
+
+class Chunk:
+
+    def __init__(self, code_size, consts_size):
+        self.code_size = round_up(code_size, PAGE)
+        self.consts_size = round_up(consts_size, PAGE)
+        self.size = self.code_size + self.consts_size
+        self.fd = os.memfd_create('jit30min', os.MFD_CLOEXEC)
+        try:
+            os.ftruncate(self.fd, self.size)
+            self.wbuf = mmap.mmap(self.fd, self.size, mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+            self.xbuf = mmap.mmap(self.fd, self.size, mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_EXEC)
+        except BaseException:
+            os.close(self.fd)
+            raise
+        self._cbuf = ffi.from_buffer(self.xbuf)
+        self.address = int(ffi.cast('uintptr_t', self._cbuf))
+        if libc.mprotect(ffi.cast('void *', self.address + self.code_size),
+                         self.consts_size, mmap.PROT_READ) != 0:
+            self.close()
+            raise OSError(ffi.errno, 'mprotect failed')
+        self.code_used = 0
+        self.consts_used = 0
+        self.live = 0
+
+    def fits(self, code_size, consts_size):
+        return (round_up(self.code_used, ALIGN) + code_size <= self.code_size and
+                round_up(self.consts_used, ALIGN) + consts_size <=
+                self.consts_size)
+
+    def reset(self):
+        self.wbuf[:self.code_size] = INT3 * self.code_size
+        self.code_used = 0
+        self.consts_used = 0
+
+    def close(self):
+        ffi.release(self._cbuf)
+        self.xbuf.close()
+        self.wbuf.close()
+        os.close(self.fd)
+
+
+class CodeBlock:
+    """
+    The memory of a function inside the arena
+    """
+
+    def __init__(self, chunk, code_offset, code_size, consts_offset,
+                 consts_size):
+        self.chunk = chunk
+        self.code_offset = code_offset
+        self.code_size = code_size
+        self.consts_offset = consts_offset
+        self.consts_size = consts_size
+        self.address = chunk.address + code_offset
+
+    @property
+    def size(self):
+        return self.code_size + self.consts_size
+
+
+class CodeArena:
+
+    def __init__(self, chunk_size=CHUNK_SIZE, consts_size=CONSTS_SIZE):
+        self.chunk_size = chunk_size
+        self.consts_size = consts_size
+        self.chunks = []
+        self.lock = threading.Lock()
+        self.pending = [] # the blocks to free when we get the lock
+
+    def allocate(self, code, consts=b'', relocs=()):
+        """
+        Copy code and consts into the arena and return a CodeBlock.
+
+        relocs is a list of (offset, delta): the 32-bit field at offset in
+        the code is set to delta + (address of consts - address of code).
+        """
+        with self.lock:
+            self._free_pending()
+            chunk = self._find_chunk(len(code), len(consts))
+            code_offset = round_up(chunk.code_used, ALIGN)
+            consts_offset = (chunk.code_size +
+                             round_up(chunk.consts_used, ALIGN))
+            code = bytearray(code)
+            for offset, delta in relocs:
+                value = delta + consts_offset - code_offset
+                code[offset:offset+4] = struct.pack('<i', value)
+            chunk.wbuf[code_offset:code_offset+len(code)] = code
+            chunk.wbuf[consts_offset:consts_offset+len(consts)] = consts
+            chunk.code_used = code_offset + len(code)
+            chunk.consts_used = consts_offset + len(consts) - chunk.code_size
+            chunk.live += 1
+            return CodeBlock(chunk, code_offset, len(code), consts_offset,
+                             len(consts))
+
+    def _find_chunk(self, code_size, consts_size):
+        for chunk in reversed(self.chunks):
+            if chunk.fits(code_size, consts_size):
+                return chunk
+        chunk = Chunk(max(self.chunk_size - self.consts_size, code_size),
+                      max(self.consts_size, consts_size))
+        self.chunks.append(chunk)
+        return chunk
+
+    def free(self, block):
+        """
+        Release the memory of block: the chunk is unmapped when it contains
+        no more functions. If the lock is taken, block is released later.
+        """
+        self.pending.append(block)
+        if self.lock.acquire(blocking=False):
+            try:
+                self._free_pending()
+            finally:
+                self.lock.release()
+
+    def _free_pending(self):
+        # a finalizer might add more blocks while we free these ones
+        while self.pending:
+            block = self.pending.pop()
+            chunk = block.chunk
+            start = block.code_offset
+            chunk.wbuf[start:start+block.code_size] = INT3 * block.code_size
+            chunk.live -= 1
+            if chunk.live == 0:
+                if chunk is self.chunks[-1]:
+                    chunk.reset() # keep one chunk around for the next ones
+                else:
+                    self.chunks.remove(chunk)
+                    chunk.close()
+
+    def clear(self):
+        """
+        Unmap all the chunks: all the functions become invalid
+        """
+        with self.lock:
+            for chunk in self.chunks:
+                chunk.close()
+            self.chunks = []
+            self.pending = []
+
+    def stats(self):
+        with self.lock:
+            self._free_pending()
+            return dict(
+                chunks=len(self.chunks),
+                mapped=sum(chunk.size for chunk in self.chunks),
+                code=sum(chunk.code_used for chunk in self.chunks),
+                consts=sum(chunk.consts_used for chunk in self.chunks),
+                functions=sum(chunk.live for chunk in self.chunks))
@@ -0,0 +1,1591 @@
+import ast
+import copy
+import textwrap
+from collections import defaultdict, OrderedDict
+from assembler import FunctionAssembler as FA, link
+import cpu
+import libm
+import optimizer
+import lowering
+from lowering import RangeLoop
+from vectorizer import VectorLoop
+from typeinfer import Types, is_int_call, call_name, INT_BUILTINS
+from compilestats import CompileStats
+import profiler
+from jit import CompiledFunction
+
+class LiveRanges:
+    """
+    Compute the live range of each variable of a function.
+
+    Statements are numbered in program order, starting from 1: position 0
+    is the function entry, where the arguments are defined. The live range
+    of a variable is the interval [start, end] of positions between its
+    first and its last appearance; if a variable is live around the back
+    edge of a loop, its range is extended to cover the whole loop.
+
+    undefined is the set of variables which might be read before being
+    written, e.g. globals or variables assigned only in one branch of an
+    if: the compiler rejects them, else they would read whatever is left
+    in their register.
+    """
+
+    # each level of loop nesting makes a use of a variable this much hotter
+    LOOP_WEIGHT = 10
+
+    def __init__(self, funcdef, arrays=None):
+        # arrays are passed as pointers in general purpose registers, and
+        # don't take part to the allocation of xmm registers
+        if arrays is None:
+            arrays = find_arrays(funcdef)
+        self.arrays = arrays
+        self.argnames = [arg.arg for arg in funcdef.args.args
+                         if arg.arg not in self.arrays]
+        self.positions = {} # stmt -> position
+        self.ranges = {}    # varname -> [start, end]
+        self.weights = defaultdict(int) # varname -> uses, weighted by depth
+        self.loops = []     # [(start, end, node)], inner loops first
+        self.pos = 0
+        for argname in self.argnames:
+            self.ranges[argname] = [0, 0]
+        self._block(funcdef.body, 0)
+        for start, end, node in self.loops:
+            self._extend(start, end, node)
+        self.undefined = set()
+        self._exposed(funcdef.body, set(arg.arg for arg in funcdef.args.args),
+                      self.undefined)
+
+    def _touch(self, node, depth):
+        for child in variables(node):
+            if child.id not in self.arrays:
+                rng = self.ranges.setdefault(child.id, [self.pos, self.pos])
+                rng[1] = self.pos
+                self.weights[child.id] += self.LOOP_WEIGHT ** depth
+
+    def _block(self, stmts, depth):
+        for stmt in stmts:
+            self.pos += 1
+            self.positions[stmt] = self.pos
+            if isinstance(stmt, ast.While):
+                start = self.pos
+                self._touch(stmt.test, depth+1)
+                self._block(stmt.body, depth+1)
+                self.loops.append((start, self.pos, stmt))
+            elif isinstance(stmt, ast.If):
+                self._touch(stmt.test, depth)
+                self._block(stmt.body, depth)
+                self._block(stmt.orelse, depth)
+            else:
+                self._touch(stmt, depth)
+
+    def _extend(self, start, end, loop):
+        """
+        A variable is live at the loop header if it can be read before being
+        written inside the loop, or if it is read after the loop: in both
+        cases, it must survive the back edge.
+        """
+        exposed = set()
+        self._exposed([loop], set(), exposed)
+        for varname, rng in self.ranges.items():
+            if rng[0] > end or rng[1] < start:
+                continue
+            if varname in exposed or rng[1] > end:
+                rng[0] = min(rng[0], start)
+                rng[1] = max(rng[1], end)
+
+    def _exposed(self, stmts, defined, exposed):
+        """
+        Collect in exposed the variables which are read before being
+        written. defined is the set of variables which are written on every
+        path reaching the current statement; it is updated in place.
+        """
+        def reads(node):
+            for child in variables(node):
+                if child.id not in defined:
+                    exposed.add(child.id)
+        #
+        for stmt in stmts:
+            if isinstance(stmt, ast.While):
+                reads(stmt.test)
+                # the body might not be executed at all
+                self._exposed(stmt.body, set(defined), exposed)
+            elif isinstance(stmt, ast.If):
+                reads(stmt.test)
+                then_defined = set(defined)
+                else_defined = set(defined)
+                self._exposed(stmt.body, then_defined, exposed)
+                self._exposed(stmt.orelse, else_defined, exposed)
+                defined.update(then_defined & else_defined)
+            elif isinstance(stmt, ast.Assign):
+                reads(stmt.value)
+                for target in stmt.targets:
+                    if isinstance(target, ast.Name):
+                        defined.add(target.id)
+                    else:
+                        reads(target)
+            else:
+                reads(stmt)
+
+
+def variables(node):
+    """
+    Yield the Name nodes inside node which refer to variables, i.e. all of
+    them except the names of the called functions
+    """
+    funcs = set(id(name) for child in ast.walk(node)
+                if isinstance(child, ast.Call)
+                for name in ast.walk(child.func))
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and id(child) not in funcs:
+            yield child
+
+def find_arrays(funcdef):
+    """
+    Return the names of the arguments which are used as arrays
+    """
+    argnames = set(arg.arg for arg in funcdef.args.args)
+    return set(node.value.id for node in ast.walk(funcdef)
+               if isinstance(node, ast.Subscript) and
+               isinstance(node.value, ast.Name) and
+               node.value.id in argnames)
+
+# the builtins which are compiled to a few instructions
+FLOAT_BUILTINS = ('sqrt', 'abs', 'fabs', 'min', 'max')
+BUILTINS = frozenset(INT_BUILTINS + FLOAT_BUILTINS + tuple(libm.FUNCTIONS))
+
+def calls(node):
+    """
+    Yield the calls to the functions of the module inside node, i.e. to
+    anything which is not a builtin
+    """
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call) and call_name(child) not in BUILTINS:
+            yield child
+
+def callee(call):
+    name = call_name(call)
+    if name is None:
+        raise NotImplementedError('only calls to functions by name are '
+                                  'supported')
+    return name
+
+def reachable(funcdefs, entry):
+    """
+    Return the names of the functions which can be called by entry,
+    starting from entry itself and then in source order
+    """
+    seen = set([entry])
+    todo = [entry]
+    while todo:
+        for call in calls(funcdefs[todo.pop()]):
+            name = callee(call)
+            if name in funcdefs and name not in seen:
+                seen.add(name)
+                todo.append(name)
+    return [entry] + [name for name in funcdefs
+                      if name in seen and name != entry]
+
+def signatures(funcdefs, types):
+    """
+    Return ({name: arrays}, {name: argtypes}) for the functions of a module.
+    An argument is an array if the function uses it as such, or passes it
+    to an array argument of another function; it is writable if the array
+    is written by the function, or by the ones it passes it to.
+    """
+    arrays = {}
+    written = {}
+    for name, funcdef in funcdefs.items():
+        arrays[name] = find_arrays(funcdef)
+        written[name] = set(
+            target.value.id for node in ast.walk(funcdef)
+            if isinstance(node, ast.Assign)
+            for target in node.targets if isinstance(target, ast.Subscript))
+    changed = True
+    while changed:
+        changed = False
+        for name, funcdef in funcdefs.items():
+            argnames = [arg.arg for arg in funcdef.args.args]
+            for call in calls(funcdef):
+                other = funcdefs.get(callee(call))
+                if other is None:
+                    continue
+                params = [arg.arg for arg in other.args.args]
+                for param, arg in zip(params, call.args):
+                    if not (isinstance(arg, ast.Name) and arg.id in argnames):
+                        continue
+                    for props in (arrays, written):
+                        if (param in props[other.name] and
+                            arg.id not in props[name]):
+                            props[name].add(arg.id)
+                            changed = True
+    argtypes = {}
+    for name, funcdef in funcdefs.items():
+        argtypes[name] = []
+        for arg in funcdef.args.args:
+            if arg.arg not in arrays[name]:
+                argtypes[name].append(types[name].argtype(arg.arg))
+            elif arg.arg in written[name]:
+                argtypes[name].append('double*')
+            else:
+                argtypes[name].append('const double*')
+    return arrays, argtypes
+
+def is_simple(node):
+    """
+    Return whether node is a name, a number or an array item indexed by one
+    of them, which are cheap to compute more than once
+    """
+    if isinstance(node, ast.Subscript):
+        return (isinstance(node.value, ast.Name) and
+                isinstance(subscript_index(node), (ast.Name, ast.Num)))
+    return isinstance(node, (ast.Name, ast.Num))
+
+class Substitute(ast.NodeTransformer):
+    """
+    Replace the names in values by a copy of the corresponding nodes
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+    def visit_Name(self, node):
+        if node.id in self.values:
+            return copy.deepcopy(self.values[node.id])
+        return node
+
+def subscript_index(node):
+    index = node.slice
+    if isinstance(index, ast.Index): # Python < 3.9
+        index = index.value
+    return index
+
+
+class StackSlot:
+
+    def __init__(self, index):
+        self.index = index
+
+    def __repr__(self):
+        return '<StackSlot %d>' % self.index
+
+
+class ArgSlot(StackSlot):
+    """
+    An argument passed on the stack by the caller: index counts the 8-byte
+    words above the return address
+    """
+
+    def __repr__(self):
+        return '<ArgSlot %d>' % self.index
+
+
+def abi_locations(argtypes):
+    """
+    Return the location of each argument according to the System V ABI:
+    doubles are passed in xmm0-xmm7, ints and pointers in FA.INT_ARGS, and
+    the others on the stack, in order.
+    """
+    locations = []
+    nfloats = nints = nstack = 0
+    for argtype in argtypes:
+        if argtype == 'double' and nfloats < len(FA.FLOAT_ARGS):
+            locations.append(FA.FLOAT_ARGS[nfloats])
+            nfloats += 1
+        elif argtype != 'double' and nints < len(FA.INT_ARGS):
+            locations.append(FA.INT_ARGS[nints])
+            nints += 1
+        else:
+            locations.append(ArgSlot(nstack))
+            nstack += 1
+    return locations
+
+
+class RegAllocator:
+    """
+    Linear-scan register allocator.
+
+    Each variable gets a location for its whole live range: either a
+    register or, if there are too many variables live at the same time, a
+    StackSlot. When we run out of registers we spill the variable with the
+    lowest weight, i.e. the least used one. Variables whose ranges don't
+    overlap can share the same register.
+
+    RESERVED registers are always left free, so that there are enough
+    temporaries to evaluate expressions.
+
+    By default we allocate all the variables to xmm registers, and all the
+    arguments are doubles. To allocate the ints, pass varnames, the general
+    purpose registers to use, and nslots to allocate the stack slots after
+    the ones of the floats. argregs maps each argument to its location on
+    function entry: the arguments passed on the stack stay in their ArgSlot
+    if they are spilled.
+    """
+
+    REGISTERS = (FA.xmm0, FA.xmm1, FA.xmm2, FA.xmm3, FA.xmm4,
+                 FA.xmm5, FA.xmm6, FA.xmm7, FA.xmm8, FA.xmm9,
+                 FA.xmm10, FA.xmm11, FA.xmm12, FA.xmm13,
+                 FA.xmm14, FA.xmm15)
+    RESERVED = 2
+
+    def __init__(self, live, argregs=None, varnames=None, registers=None,
+                 nslots=0):
+        self.live = live
+        if argregs is None:
+            argnames = live.argnames
+            argregs = dict(zip(argnames,
+                               abi_locations(['double'] * len(argnames))))
+        if varnames is None:
+            varnames = set(live.ranges)
+        self.argregs = argregs
+        self.argnames = [name for name in live.argnames if name in varnames]
+        self.varnames = [name for name in live.ranges if name in varnames]
+        self.registers = registers or self.REGISTERS
+        self.locations = {} # varname -> register or StackSlot
+        self.nslots = nslots
+        self._registers = []
+        self._linear_scan()
+
+    def _linear_scan(self):
+        ranges = self.live.ranges
+        weights = self.live.weights
+        argnames = self.argnames
+        limit = len(self.registers) - self.RESERVED
+        free = list(reversed(self.registers))
+        active = []
+        # the arguments come first and get the register they are passed in
+        def key(varname):
+            if varname in argnames:
+                return (ranges[varname][0], argnames.index(varname))
+            return (ranges[varname][0], len(argnames))
+        # arguments passed on the stack are cheaper to spill, since they are
+        # already in memory
+        def spill_key(varname):
+            return (weights[varname], not self.on_stack(varname))
+        for varname in sorted(self.varnames, key=key):
+            start, end = ranges[varname]
+            for other in list(active):
+                if ranges[other][1] < start:
+                    active.remove(other)
+                    free.append(self.locations[other])
+            if len(active) < limit:
+                reg = self.argregs.get(varname)
+                if varname in argnames and not self.on_stack(varname):
+                    free = [other for other in free if other is not reg]
+                else:
+                    reg = free.pop()
+                self.locations[varname] = reg
+                active.append(varname)
+                continue
+            victim = min(active + [varname], key=spill_key)
+            if victim != varname:
+                self.locations[varname] = self.locations[victim]
+                active.remove(victim)
+                active.append(varname)
+            self.locations[victim] = self._spill_slot(victim)
+
+    def on_stack(self, varname):
+        return isinstance(self.argregs.get(varname), ArgSlot)
+
+    def _spill_slot(self, varname):
+        if self.on_stack(varname):
+            return self.argregs[varname]
+        slot = StackSlot(self.nslots)
+        self.nslots += 1
+        return slot
+
+    def get(self, varname):
+        return self.locations[varname]
+
+    def spilled_args(self):
+        """
+        Return [(reg, slot)] for the arguments which must be moved from the
+        register they are passed in to their stack slot.
+        """
+        return [(self.argregs[argname], self.locations[argname])
+                for argname in self.argnames
+                if not self.on_stack(argname) and
+                isinstance(self.locations[argname], StackSlot)]
+
+    def stack_args(self):
+        """
+        Return [(slot, reg)] for the arguments which must be loaded from the
+        stack to the register they are allocated to.
+        """
+        return [(self.argregs[argname], self.locations[argname])
+                for argname in self.argnames
+                if self.on_stack(argname) and
+                not isinstance(self.locations[argname], StackSlot)]
+
+    def at(self, pos):
+        """
+        Prepare the pool of temporaries for the statement at position pos:
+        all the registers which don't belong to a live variable.
+        """
+        busy = [loc for varname, loc in self.locations.items()
+                if not isinstance(loc, StackSlot) and
+                self.live.ranges[varname][0] <= pos <= self.live.ranges[varname][1]]
+        self._registers = [reg for reg in reversed(self.registers)
+                           if not any(reg is other for other in busy)]
+
+    def nfree(self):
+        return len(self._registers)
+
+    def busy(self):
+        """
+        Return the registers which hold a live variable or a temporary
+        """
+        return [reg for reg in self.registers
+                if not any(reg is other for other in self._registers)]
+
+    def new_temp(self):
+        try:
+            return self._registers.pop()
+        except IndexError:
+            raise NotImplementedError("Not enough registers for temporaries")
+
+    def free_temp(self, reg):
+        self._registers.append(reg)
+
+
+class AstCompiler:
+    """
+    Compile a function to machine code.
+
+    The source can contain several functions, which call each other
+    directly: entry is the name of the one to compile, by default the first.
+    The functions it calls are compiled too, and emitted in the same block
+    of code. Calls to small leaf functions are inlined.
+
+    Expressions are evaluated directly into xmm registers: the visitor of an
+    expression node returns a temporary register holding its value, which the
+    caller owns and must give back with self.regs.free_temp(). Subtrees are
+    evaluated in Sethi-Ullman order to minimize the number of temporaries;
+    the stack is used only when we run out of registers.
+
+    The int variables live in general purpose registers, managed by a
+    separate RegAllocator: int expressions are evaluated by ivisit() and
+    the other i* methods, and converted with CVTSI2SD where a float is
+    expected.
+    """
+
+    # the registers for the ints. rax is left out, because it's used as a
+    # scratch register to compute the address of array elements
+    INT_REGISTERS = (FA.r10, FA.r11, FA.r9, FA.r8, FA.rcx, FA.rdx, FA.rsi,
+                     FA.rdi)
+
+    # the maximum number of AST nodes of the expression returned by a
+    # function which can be inlined
+    INLINE_SIZE = 20
+
+    def __init__(self, src, optimize=True, vectorize=True, entry=None,
+                 lines=False, instrument=False, encoder=None):
+        self.stats = CompileStats()
+        with self.stats.phase('parse'):
+            self.tree = ast.parse(textwrap.dedent(src))
+        if optimize:
+            with self.stats.phase('optimize'):
+                self.tree = optimizer.optimize(self.tree)
+        with self.stats.phase('lower'):
+            self.tree = lowering.lower(self.tree)
+        # the vectorized loops don't count their iterations, see profiler
+        self.vectorize = vectorize and not instrument
+        self.inline = optimize
+        self.entry = entry
+        # emit a marker at the beginning of each statement, see perfmap
+        self.lines = lines
+        self.instrument = instrument
+        self.counters = [] # [(function name, line, counter name)]
+        # 'peachpy' or 'direct', see assembler.ENCODERS
+        self.encoder = encoder
+        self.asm = None
+        self.functions = [] # the FAs of the module, entry first
+        # [(continue_label, end_label, counters)] of the enclosing loops,
+        # where counters is the index of the first one, or None
+        self.loops = []
+        self._inlined = {} # call -> expression or None
+
+    def show(self, node):
+        import astpretty
+        from ast2png import ast2png
+        astpretty.pprint(node)
+        ast2png(self.tree, highlight_node=node, filename='ast.png')
+
+    def _newfunc(self, node):
+        argnames = [arg.arg for arg in node.args.args]
+        self.live = LiveRanges(node, self.module_arrays[node.name])
+        if self.live.undefined:
+            raise NotImplementedError(
+                'variable %s might be used before assignment' %
+                min(self.live.undefined))
+        self.types = self.module_types[node.name]
+        argtypes = self.signatures[node.name]
+        argregs = dict(zip(argnames, abi_locations(argtypes)))
+        self.arrays = {} # name -> register containing the pointer
+        for argname in self.live.arrays:
+            if isinstance(argregs[argname], ArgSlot):
+                raise NotImplementedError('Too many array arguments')
+            self.arrays[argname] = argregs[argname]
+        self.asm = FA(node.name, argnames, argtypes, encoder=self.encoder)
+        ints = self.types.ints
+        floats = set(self.live.ranges) - ints
+        self.regs = RegAllocator(self.live, argregs, floats)
+        # the pointers to the arrays are never moved
+        gprs = [reg for reg in self.INT_REGISTERS
+                if not any(reg is other for other in self.arrays.values())]
+        self.iregs = RegAllocator(self.live, argregs, ints, gprs,
+                                  self.regs.nslots)
+        self.asm.prologue(self.iregs.nslots, self.makes_calls(node))
+        for regs, mov in [(self.regs, self.asm.MOVSD),
+                          (self.iregs, self.asm.MOV)]:
+            for reg, slot in regs.spilled_args():
+                mov(self.asm.stack_slot(slot.index), reg)
+            for slot, reg in regs.stack_args():
+                mov(reg, self.asm.arg_slot(slot.index))
+
+    def makes_calls(self, node):
+        """
+        Check whether the code of node contains a CALL, to a function of the
+        module or of libm
+        """
+        for child in ast.walk(node):
+            if not isinstance(child, ast.Call):
+                continue
+            name = call_name(child)
+            if name in libm.FUNCTIONS:
+                return True
+            if name not in BUILTINS:
+                inlined = self.inlined(child)
+                if inlined is None or self.makes_calls(inlined):
+                    return True
+        return False
+
+    def assemble(self):
+        """
+        Compile the function and return (code, consts, relocs, links). The
+        time spent in each phase and the size of the code are in self.stats,
+        and the [(offset, size, name)] of the functions in self.symbols.
+        """
+        stats = self.stats
+        with stats.phase('codegen'):
+            self.visit(self.tree)
+        assert self.asm is not None, 'No function found?'
+        functions = [asm.assemble(stats) for asm in self.functions]
+        with stats.phase('link'):
+            code, consts, relocs, links, offsets = link(functions)
+        self.symbols = [(offset, len(fn[0]), asm.name) for offset, fn, asm
+                        in zip(offsets, functions, self.functions)]
+        stats.name = self.asm.name
+        stats.functions = len(self.functions)
+        stats.instructions = sum(asm.ninstructions for asm in self.functions)
+        stats.code_size = len(code)
+        stats.consts_size = len(consts)
+        stats.registers = sorted(set().union(*[asm.registers
+                                               for asm in self.functions]))
+        # the entry is the first function
+        return code, consts, relocs, links
+
+    def compile(self):
+        code, consts, relocs, links = self.assemble()
+        with self.stats.phase('load'):
+            fn = CompiledFunction(self.asm.nargs, code, self.asm.argtypes,
+                                  consts, relocs, links, self.symbols,
+                                  self.counters if self.instrument else None,
+                                  bool(self.lines))
+        fn.stats = self.stats
+        return fn
+
+    def visit(self, node):
+        pos = self.live.positions.get(node) if self.asm else None
+        if pos is not None:
+            self.at(pos)
+        if (self.lines and self.asm is not None and
+            isinstance(node, ast.stmt) and
+            not isinstance(node, ast.FunctionDef) and hasattr(node, 'lineno')):
+            self.asm.line_marker(node.lineno - self.def_line)
+        if (isinstance(node, ast.expr) and not isinstance(node, ast.Num) and
+            self.is_int(node)):
+            # an int used where a float is expected
+            return self.to_float(node)
+        methname = node.__class__.__name__
+        meth = getattr(self, methname, None)
+        if meth is None:
+            raise NotImplementedError(methname)
+        return meth(node)
+
+    def at(self, pos):
+        self.regs.at(pos)
+        self.iregs.at(pos)
+
+    # expression helpers
+
+    def is_int(self, node):
+        return self.types.is_int(node)
+
+    def location(self, varname):
+        if varname in self.types.ints:
+            return self.iregs.get(varname)
+        return self.regs.get(varname)
+
+    def var(self, varname):
+        """
+        Return the operand corresponding to the location of varname: either
+        a register or a memory reference to its stack slot
+        """
+        if varname in self.arrays:
+            raise NotImplementedError('array %s used as a scalar' % varname)
+        loc = self.location(varname)
+        if isinstance(loc, ArgSlot):
+            return self.asm.arg_slot(loc.index)
+        if isinstance(loc, StackSlot):
+            return self.asm.stack_slot(loc.index)
+        return loc
+
+    def in_register(self, varname):
+        return not isinstance(self.location(varname), StackSlot)
+
+    def element(self, node):
+        """
+        Return the memory operand for the array element node. A float index
+        is truncated to an integer and, like in C, there is no bounds
+        checking nor support for negative indexes. The operand might refer
+        to rax, so it must be used before evaluating any other array
+        element.
+        """
+        name = node.value.id
+        if name not in self.arrays:
+            raise NotImplementedError('%s is not an array argument' % name)
+        base = self.arrays[name]
+        index = subscript_index(node)
+        if isinstance(index, ast.Num):
+            offset = 8 * int(index.n)
+            return self.asm.qword[base + offset] if offset else self.asm.qword[base]
+        if self.is_int(index):
+            return self.int_element(base, index)
+        src, owned = self.operand(index)
+        self.asm.CVTTSD2SI(self.asm.rax, src)
+        self.release(src, owned)
+        return self.asm.qword[base + self.asm.rax*8]
+
+    def int_element(self, base, index):
+        """
+        Return the operand for base[index], when index is an int: a[i] and
+        a[i+1] use the register of i directly.
+        """
+        offset = 0
+        if (isinstance(index, ast.BinOp) and
+            isinstance(index.op, (ast.Add, ast.Sub)) and
+            isinstance(index.right, ast.Num) and
+            isinstance(index.left, ast.Name) and
+            abs(index.right.n) < 2**28):
+            offset = 8 * index.right.n
+            if isinstance(index.op, ast.Sub):
+                offset = -offset
+            index = index.left
+        if isinstance(index, ast.Name) and self.in_register(index.id):
+            reg = self.var(index.id)
+        else:
+            src, owned = self.ioperand(index)
+            self.asm.MOV(self.asm.rax, src)
+            self.irelease(src, owned)
+            reg = self.asm.rax
+        if offset:
+            return self.asm.qword[base + reg*8 + offset]
+        return self.asm.qword[base + reg*8]
+
+    def need(self, node, as_operand=False):
+        """
+        Sethi-Ullman number: how many registers are needed to evaluate
+        node. Leaves used as the right operand of an instruction don't need
+        a register, since they can be encoded directly as a register or
+        memory operand.
+        """
+        if not isinstance(node, ast.Num) and self.is_int(node):
+            # it must be converted to float into a new register; int(x)
+            # might need more to evaluate x
+            return max([1] + [self.need(child.args[0])
+                              for child in ast.walk(node)
+                              if is_int_call(child)])
+        if isinstance(node, ast.Call):
+            return self.call_need(node, as_operand)
+        if isinstance(node, ast.BinOp):
+            left = self.need(node.left)
+            right = self.need(node.right, as_operand=True)
+            if left == right:
+                return left + 1
+            return max(left, right)
+        if isinstance(node, ast.UnaryOp):
+            # computed in place
+            return self.need(node.operand)
+        if isinstance(node, ast.Subscript):
+            index = subscript_index(node)
+            if self.is_int(index):
+                index = 0
+            else:
+                index = self.need(index, as_operand=True)
+            return max(index, 0 if as_operand else 1)
+        return 0 if as_operand else 1
+
+    def call_need(self, node, as_operand):
+        inlined = self.inlined(node)
+        if inlined is not None:
+            return self.need(inlined, as_operand)
+        name = callee(node)
+        if name == 'sqrt' and node.args:
+            return max(1, self.need(node.args[0], as_operand=True))
+        if name in ('abs', 'fabs') and node.args:
+            return self.need(node.args[0])
+        if name in ('min', 'max') and node.args:
+            # the first argument is held while evaluating the others
+            return max([self.need(node.args[0])] +
+                       [self.need(arg) + 1 for arg in node.args[1:]])
+        # all the registers are saved around the call
+        return 1
+
+    def operand(self, node):
+        """
+        Return (op, owned), where op is something which can be used as the
+        source operand of an SSE instruction. If owned is True, op is a
+        temporary register which must be freed by the caller.
+        """
+        if isinstance(node, ast.Num):
+            return self.asm.const(node.n), False
+        elif self.is_int(node):
+            return self.to_float(node), True
+        elif isinstance(node, ast.Name):
+            return self.var(node.id), False
+        elif isinstance(node, ast.Subscript):
+            return self.element(node), False
+        elif isinstance(node, ast.Call) and self.inlined(node) is not None:
+            return self.operand(self.inlined(node))
+        return self.visit(node), True
+
+    def release(self, op, owned):
+        if owned:
+            self.regs.free_temp(op)
+
+    def visit_holding(self, node, held, as_operand=False):
+        """
+        Evaluate node while keeping alive the value in the temporary register
+        held. If there are not enough free registers, held is spilled to the
+        stack and reloaded afterwards, possibly into a different register.
+        Return (op, owned, held).
+        """
+        spill = self.need(node, as_operand) > self.regs.nfree()
+        if spill:
+            self.asm.pushsd(held)
+            self.regs.free_temp(held)
+        if as_operand:
+            op, owned = self.operand(node)
+        else:
+            op, owned = self.visit(node), True
+        if spill:
+            held = self.regs.new_temp()
+            self.asm.popsd(held)
+        return op, owned, held
+
+    def visit_into(self, node, dst, varname):
+        """
+        Evaluate node directly into dst, which is the register of varname.
+        The left spine of a BinOp can be computed in place as long as the
+        right operands don't read varname, which is overwritten in the
+        meantime: this way, "x = x + 1" becomes a single ADDSD.
+        """
+        if (isinstance(node, ast.BinOp) and not self.is_int(node) and
+            varname not in self.names(node.right)):
+            self.visit_into(node.left, dst, varname)
+            right, owned = self.operand(node.right)
+            self.binop(node.op)(dst, right)
+            self.release(right, owned)
+            return
+        src, owned = self.operand(node)
+        if src is not dst:
+            self.asm.MOVSD(dst, src)
+        self.release(src, owned)
+
+    def names(self, node):
+        return set(child.id for child in ast.walk(node)
+                   if isinstance(child, ast.Name))
+
+    def binop(self, op):
+        OPS = {
+            'ADD': self.asm.ADDSD,
+            'SUB': self.asm.SUBSD,
+            'MULT': self.asm.MULSD,
+            'DIV': self.asm.DIVSD,
+            }
+        opname = op.__class__.__name__.upper()
+        fn = OPS.get(opname)
+        if fn is None:
+            raise NotImplementedError('operator %s' % opname)
+        return fn
+
+    # visitors
+
+    def Module(self, node):
+        funcdefs = OrderedDict()
+        for child in node.body:
+            if isinstance(child, ast.FunctionDef):
+                # the source of a decorated function starts with the
+                # decorator, e.g. @jit.compile(...), which is not compiled
+                child.decorator_list = []
+                funcdefs[child.name] = child
+            else:
+                self.visit(child)
+        if not funcdefs:
+            return
+        entry = self.entry or next(iter(funcdefs))
+        if entry not in funcdefs:
+            raise ValueError('no function named %s' % entry)
+        # the other functions are ignored
+        funcdefs = OrderedDict((name, funcdefs[name])
+                               for name in reachable(funcdefs, entry))
+        self.funcdefs = funcdefs
+        self.index = dict((name, i) for i, name in enumerate(funcdefs))
+        self.module_types = dict((name, Types(funcdef))
+                                 for name, funcdef in funcdefs.items())
+        self.module_arrays, self.signatures = signatures(funcdefs,
+                                                         self.module_types)
+        for funcdef in funcdefs.values():
+            self.visit(funcdef)
+        self.asm = self.functions[0]
+
+    def FunctionDef(self, node):
+        self._newfunc(node)
+        self.def_line = node.lineno
+        self.functions.append(self.asm)
+        for child in node.body:
+            self.visit(child)
+        # return 0 by default
+        self.asm.PXOR(self.asm.xmm0, self.asm.xmm0)
+        self.asm.epilogue()
+        self.asm.RET()
+
+    def Pass(self, node):
+        pass
+
+    def Return(self, node):
+        src, owned = self.operand(node.value)
+        if src is not self.asm.xmm0:
+            self.asm.MOVSD(self.asm.xmm0, src)
+        self.release(src, owned)
+        for _, _, counters in self.loops:
+            if counters is not None:
+                self.asm.cycles(counters + 2, start=False)
+        self.asm.epilogue()
+        self.asm.RET()
+
+    def Num(self, node):
+        reg = self.regs.new_temp()
+        self.asm.MOVSD(reg, self.asm.const(node.n))
+        return reg
+
+    # Python 3.8+ produces Constant instead of Num
+    Constant = Num
+
+    def BinOp(self, node):
+        op = self.binop(node.op)
+        if self.need(node.right, as_operand=True) > self.need(node.left):
+            # evaluate the most expensive subtree first
+            right, right_owned = self.visit(node.right), True
+            left, _, right = self.visit_holding(node.left, right)
+        else:
+            left = self.visit(node.left)
+            right, right_owned, left = self.visit_holding(node.right, left,
+                                                          as_operand=True)
+        op(left, right)
+        self.release(right, right_owned)
+        return left
+
+    def UnaryOp(self, node):
+        if not isinstance(node.op, (ast.USub, ast.UAdd)):
+            raise NotImplementedError('operator %s' %
+                                      node.op.__class__.__name__.upper())
+        reg = self.visit(node.operand)
+        if isinstance(node.op, ast.USub):
+            # flip the sign bit
+            self.asm.XORPD(reg, self.asm.const_mask(0x8000000000000000))
+        return reg
+
+    def Name(self, node):
+        reg = self.regs.new_temp()
+        self.asm.MOVSD(reg, self.var(node.id))
+        return reg
+
+    def Expr(self, node):
+        # expressions have no side effects, but the functions they call can
+        # write to arrays
+        if any(True for call in calls(node)):
+            self.regs.free_temp(self.visit(node.value))
+
+    def Call(self, node):
+        inlined = self.inlined(node)
+        if inlined is not None:
+            return self.visit(inlined)
+        name = callee(node)
+        if name in FLOAT_BUILTINS:
+            return getattr(self, 'builtin_' + name)(node)
+        if name in libm.FUNCTIONS:
+            self.check_args(node, ['x'] * libm.FUNCTIONS[name])
+            return self.emit_call(node, ['double'] * len(node.args),
+                                  lambda: self.asm.call_extern(name))
+        if name not in self.signatures:
+            raise NotImplementedError('unknown function %s' % name)
+        self.check_args(node, [arg.arg for arg in self.funcdefs[name].args.args])
+        return self.emit_call(node, self.signatures[name],
+                              lambda: self.asm.call(self.index[name]))
+
+    def check_args(self, node, params):
+        if len(node.args) != len(params) or node.keywords:
+            raise TypeError('%s() takes %d arguments' % (callee(node),
+                                                          len(params)))
+
+    def emit_call(self, node, argtypes, emit):
+        """
+        All the functions follow the System V ABI, which has no callee-saved
+        xmm registers, nor callee-saved registers among the ones we use: the
+        registers which are in use are saved to the stack around the call.
+        The arguments are evaluated and pushed to the stack too, and loaded
+        into their location right before the call, because evaluating them
+        might need the argument registers. emit() emits the CALL.
+        """
+        asm = self.asm
+        saved_xmm = self.regs.busy()
+        saved_gpr = self.iregs.busy() + list(self.arrays.values())
+        for reg in saved_xmm:
+            asm.pushsd(reg)
+        for reg in saved_gpr:
+            asm.push(reg)
+        for i, (arg, argtype) in enumerate(zip(node.args, argtypes)):
+            if argtype == 'double':
+                reg = self.visit(arg)
+                asm.pushsd(reg)
+                self.regs.free_temp(reg)
+            elif argtype == 'int64_t':
+                if not self.is_int(arg):
+                    raise NotImplementedError(
+                        'cannot pass a float to the int argument %d of %s' %
+                        (i + 1, callee(node)))
+                reg = self.ivisit(arg)
+                asm.push(reg)
+                self.iregs.free_temp(reg)
+            elif isinstance(arg, ast.Name) and arg.id in self.arrays:
+                asm.push(self.arrays[arg.id])
+            else:
+                raise NotImplementedError('the argument %d of %s must be an '
+                                          'array' % (i + 1, callee(node)))
+        # the outgoing stack arguments go below the pushed values
+        locations = abi_locations(argtypes)
+        nstack = sum(isinstance(loc, ArgSlot) for loc in locations)
+        area = 8*nstack + 8*nstack % 16
+        if area:
+            asm.SUB(asm.rsp, area)
+            asm.stack_depth += area
+        for i, (loc, argtype) in enumerate(zip(locations, argtypes)):
+            pushed = asm.stack(area + 16*(len(argtypes) - 1 - i))
+            if isinstance(loc, ArgSlot):
+                asm.MOV(asm.rax, pushed)
+                asm.MOV(asm.stack(8*loc.index), asm.rax)
+            elif argtype == 'double':
+                asm.MOVSD(loc, pushed)
+            else:
+                asm.MOV(loc, pushed)
+        emit()
+        asm.ADD(asm.rsp, area + 16*len(argtypes))
+        asm.stack_depth -= area + 16*len(argtypes)
+        # the result register is free, so it's not among the saved ones
+        result = self.regs.new_temp()
+        if result is not asm.xmm0:
+            asm.MOVSD(result, asm.xmm0)
+        for reg in reversed(saved_gpr):
+            asm.pop(reg)
+        for reg in reversed(saved_xmm):
+            asm.popsd(reg)
+        return result
+
+    # builtins
+
+    def builtin_sqrt(self, node):
+        self.check_args(node, ['x'])
+        src, owned = self.operand(node.args[0])
+        reg = src if owned else self.regs.new_temp()
+        self.asm.SQRTSD(reg, src)
+        return reg
+
+    def builtin_abs(self, node):
+        # clear the sign bit
+        self.check_args(node, ['x'])
+        reg = self.visit(node.args[0])
+        self.asm.ANDPD(reg, self.asm.const_mask(0x7fffffffffffffff))
+        return reg
+
+    builtin_fabs = builtin_abs
+
+    def builtin_min(self, node):
+        return self.builtin_minmax(node, self.asm.MINSD)
+
+    def builtin_max(self, node):
+        return self.builtin_minmax(node, self.asm.MAXSD)
+
+    def builtin_minmax(self, node, op):
+        """
+        min(a, b) is b if b < a else a: that is MINSD b, a, which returns
+        its second operand if they are equal or one is NaN. The same for
+        max, and with more arguments min(a, b, c) is min(min(a, b), c).
+        """
+        if len(node.args) < 2 or node.keywords:
+            raise NotImplementedError('%s() needs at least 2 arguments' %
+                                      callee(node))
+        acc = self.visit(node.args[0])
+        for arg in node.args[1:]:
+            reg, _, acc = self.visit_holding(arg, acc)
+            op(reg, acc)
+            self.regs.free_temp(acc)
+            acc = reg
+        return acc
+
+    def inlined(self, node):
+        """
+        If node is a call to a function whose body is just "return <expr>",
+        with a small <expr> which does not call other functions, return
+        <expr> with the arguments in place of the parameters. Else, return
+        None.
+        """
+        if not self.inline:
+            return None
+        if node not in self._inlined:
+            self._inlined[node] = self._inline(node)
+        return self._inlined[node]
+
+    def _inline(self, node):
+        funcdef = self.funcdefs.get(callee(node))
+        if (funcdef is None or len(funcdef.body) != 1 or
+            not isinstance(funcdef.body[0], ast.Return) or
+            funcdef.body[0].value is None or node.keywords or
+            len(node.args) != len(funcdef.args.args)):
+            return None
+        expr = funcdef.body[0].value
+        if (len(list(ast.walk(expr))) > self.INLINE_SIZE or
+            any(True for call in calls(expr))):
+            return None
+        params = [arg.arg for arg in funcdef.args.args]
+        ints = self.module_types[funcdef.name].ints
+        uses = defaultdict(int)
+        for child in variables(expr):
+            uses[child.id] += 1
+        if not set(uses) <= set(params):
+            return None
+        values = {}
+        for param, arg in zip(funcdef.args.args, node.args):
+            is_int = param.arg in ints
+            if isinstance(arg, ast.Num) and not is_int:
+                arg = ast.Num(n=float(arg.n))
+            # the types must match, else the callee would compute with
+            # different types
+            if self.is_int(arg) != is_int:
+                return None
+            # don't compute the argument more than once, unless it's just a
+            # load
+            if uses[param.arg] > 1 and not is_simple(arg):
+                return None
+            values[param.arg] = arg
+        return Substitute(values).visit(copy.deepcopy(expr))
+
+    def Subscript(self, node):
+        mem = self.element(node)
+        reg = self.regs.new_temp()
+        self.asm.MOVSD(reg, mem)
+        return reg
+
+    def Assign(self, node):
+        assert len(node.targets) == 1
+        if isinstance(node.targets[0], ast.Subscript):
+            return self.store(node.targets[0], node.value)
+        varname = node.targets[0].id
+        if varname in self.types.ints:
+            if self.in_register(varname):
+                self.ivisit_into(node.value, self.var(varname), varname)
+            else:
+                reg = self.ivisit(node.value)
+                self.asm.MOV(self.var(varname), reg)
+                self.iregs.free_temp(reg)
+        elif self.in_register(varname):
+            self.visit_into(node.value, self.var(varname), varname)
+        else:
+            reg = self.visit(node.value)
+            self.asm.MOVSD(self.var(varname), reg)
+            self.regs.free_temp(reg)
+
+    def store(self, target, value):
+        if (isinstance(value, ast.Name) and not self.is_int(value) and
+            self.in_register(value.id)):
+            reg, owned = self.var(value.id), False
+        else:
+            reg, owned = self.visit(value), True
+        spill = owned and self.need(target, as_operand=True) > self.regs.nfree()
+        if spill:
+            self.asm.pushsd(reg)
+            self.regs.free_temp(reg)
+        mem = self.element(target)
+        if spill:
+            # rax is not touched by popsd: mem is still valid
+            reg = self.regs.new_temp()
+            self.asm.popsd(reg)
+        self.asm.MOVSD(mem, reg)
+        self.release(reg, owned)
+
+    def If(self, node):
+        """
+            IF NOT <test> GOTO else_label
+            <BODY>
+            GOTO end_label
+        else_label:
+            <ORELSE>
+        end_label:
+            ...
+        """
+        counters = None
+        if self.instrument:
+            counters = self.new_counters(node, profiler.BRANCH)
+        else_label = self.asm.Label()
+        self.cond_jump(node.test, else_label, False)
+        if counters is not None:
+            self.asm.count(counters)
+        for child in node.body:
+            self.visit(child)
+        if not node.orelse and counters is None:
+            self.asm.LABEL(else_label)
+            return
+        end_label = self.asm.Label()
+        if not self.terminates(node.body):
+            self.asm.JMP(end_label)
+        self.asm.LABEL(else_label)
+        if counters is not None:
+            self.asm.count(counters + 1)
+        for child in node.orelse:
+            self.visit(child)
+        self.asm.LABEL(end_label)
+
+    def terminates(self, body):
+        return bool(body) and isinstance(body[-1], (ast.Return, ast.Break,
+                                                    ast.Continue))
+
+    def While(self, node):
+        """
+        Loops are rotated, so that each iteration executes a single
+        conditional jump:
+
+            IF NOT <test> GOTO end_label
+            ALIGN 16
+        loop_label:
+            <BODY>
+            IF <test> GOTO loop_label
+        end_label:
+            ...
+
+        If the loop can be vectorized, the vectorized version runs first,
+        and the scalar loop processes the remaining elements.
+
+        continue jumps right before the back edge: in loops lowered from
+        for, that is before the increment of the counter.
+        """
+        if node.orelse:
+            raise NotImplementedError('while/else')
+        pos = self.live.positions[node]
+        counters = None
+        if self.instrument:
+            counters = self.new_counters(node, profiler.LOOP)
+            self.asm.count(counters)
+            self.asm.cycles(counters + 2, start=True)
+        if self.vectorize:
+            vloop = VectorLoop.analyze(node, self.arrays, self.types.ints)
+            if vloop and vloop.registers_needed() <= self.regs.nfree():
+                vloop.emit(self)
+                self.at(pos)
+        loop_label = self.asm.Label()
+        continue_label = self.asm.Label()
+        end_label = self.asm.Label()
+        body, step = node.body, []
+        if isinstance(node, RangeLoop):
+            body, step = body[:-1], body[-1:]
+        #
+        self.cond_jump(node.test, end_label, False)
+        self.asm.ALIGN(16)
+        self.asm.LABEL(loop_label)
+        if counters is not None:
+            self.asm.count(counters + 1)
+        self.loops.append((continue_label, end_label, counters))
+        for child in body:
+            self.visit(child)
+        self.loops.pop()
+        self.asm.LABEL(continue_label)
+        for child in step:
+            self.visit(child)
+        self.at(pos)
+        self.cond_jump(node.test, loop_label, True)
+        self.asm.LABEL(end_label)
+        if counters is not None:
+            self.asm.cycles(counters + 2, start=False)
+
+    RangeLoop = While
+
+    def new_counters(self, node, names):
+        """
+        Allocate the counters of node, see profiler: return the index of the
+        first one
+        """
+        index = len(self.counters)
+        line = node.lineno - self.def_line
+        self.counters += [(self.asm.name, line, name) for name in names]
+        return index
+
+    def Break(self, node):
+        if not self.loops:
+            raise NotImplementedError("'break' outside loop")
+        self.asm.JMP(self.loops[-1][1])
+
+    def Continue(self, node):
+        if not self.loops:
+            raise NotImplementedError("'continue' outside loop")
+        self.asm.JMP(self.loops[-1][0])
+
+    # conditions
+
+    def cond_jump(self, node, label, jump_if):
+        """
+        Emit the code to evaluate the condition node, jumping to label if its
+        truth value is jump_if, and falling through otherwise. and/or are
+        short-circuiting, like in Python.
+        """
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            self.cond_jump(node.operand, label, not jump_if)
+        elif isinstance(node, ast.BoolOp):
+            self.cond_jump_all(node.values, isinstance(node.op, ast.And),
+                               label, jump_if)
+        elif isinstance(node, ast.Compare):
+            # a < b < c is equivalent to a < b and b < c: since expressions
+            # have no side effects, it's fine to evaluate b twice
+            lefts = [node.left] + node.comparators[:-1]
+            conds = [(left, op, right) for left, op, right
+                     in zip(lefts, node.ops, node.comparators)]
+            self.cond_jump_all(conds, True, label, jump_if)
+        elif isinstance(node, tuple):
+            left, op, right = node
+            self.compare_jump(left, op, right, label, jump_if)
+        elif isinstance(node, ast.Num):
+            if bool(node.n) == jump_if:
+                self.asm.JMP(label)
+        else:
+            # any other expression is true if it's != 0
+            zero = ast.Num(n=0 if self.is_int(node) else 0.0)
+            self.compare_jump(node, ast.NotEq(), zero, label, jump_if)
+
+    def cond_jump_all(self, conds, is_and, label, jump_if):
+        """
+        Short-circuit evaluation of "conds[0] and conds[1] and ..." (or "or",
+        if is_and is False)
+        """
+        if len(conds) == 1:
+            self.cond_jump(conds[0], label, jump_if)
+            return
+        if is_and != jump_if:
+            # we jump as soon as one condition is decisive
+            for cond in conds:
+                self.cond_jump(cond, label, jump_if)
+            return
+        # we jump only if all the conditions are decisive: skip the rest as
+        # soon as one is not
+        skip_label = self.asm.Label()
+        for cond in conds[:-1]:
+            self.cond_jump(cond, skip_label, not jump_if)
+        self.cond_jump(conds[-1], label, jump_if)
+        self.asm.LABEL(skip_label)
+
+    def compare_jump(self, left, op, right, label, jump_if):
+        """
+        UCOMISD sets ZF, PF and CF to 1 if one of the operands is NaN: a < b
+        and a <= b are emitted as b > a and b >= a, so that the "above"
+        conditions correctly evaluate to False in that case.
+        """
+        opname = op.__class__.__name__.upper()
+        if self.is_int(left) and self.is_int(right):
+            self.int_compare_jump(left, opname, right, label, jump_if)
+            return
+        if opname in ('LT', 'LTE'):
+            left, right = right, left
+            opname = {'LT': 'GT', 'LTE': 'GTE'}[opname]
+        self.ucomisd(left, right)
+        asm = self.asm
+        if opname == 'GT':
+            (asm.JA if jump_if else asm.JBE)(label)
+        elif opname == 'GTE':
+            (asm.JAE if jump_if else asm.JB)(label)
+        elif (opname == 'EQ') == jump_if:
+            # jump if ordered and equal, i.e. PF=0 and ZF=1
+            skip_label = asm.Label()
+            asm.JP(skip_label)
+            asm.JE(label)
+            asm.LABEL(skip_label)
+        elif opname in ('EQ', 'NOTEQ'):
+            # jump if unordered or not equal, i.e. PF=1 or ZF=0
+            asm.JP(label)
+            asm.JNE(label)
+        else:
+            raise NotImplementedError(opname)
+
+    def ucomisd(self, left, right):
+        if (isinstance(left, ast.Name) and not self.is_int(left) and
+            self.in_register(left.id)):
+            # UCOMISD does not modify its operands: no need for a copy
+            left, left_owned = self.var(left.id), False
+            right, right_owned = self.operand(right)
+        else:
+            left, left_owned = self.visit(left), True
+            right, right_owned, left = self.visit_holding(right, left,
+                                                          as_operand=True)
+        self.asm.UCOMISD(left, right)
+        self.release(right, right_owned)
+        self.release(left, left_owned)
+
+    # ints
+
+    INT_JUMPS = {
+        # opname: (jump if true, jump if false)
+        'LT': ('JL', 'JGE'),
+        'LTE': ('JLE', 'JG'),
+        'GT': ('JG', 'JLE'),
+        'GTE': ('JGE', 'JL'),
+        'EQ': ('JE', 'JNE'),
+        'NOTEQ': ('JNE', 'JE'),
+        }
+
+    def int_compare_jump(self, left, opname, right, label, jump_if):
+        if opname not in self.INT_JUMPS:
+            raise NotImplementedError(opname)
+        if isinstance(left, ast.Name) and self.in_register(left.id):
+            left, left_owned = self.var(left.id), False
+            right, right_owned = self.ioperand(right)
+        else:
+            left, left_owned = self.ivisit(left), True
+            right, right_owned, left = self.ivisit_holding(right, left,
+                                                           as_operand=True)
+        self.asm.CMP(left, right)
+        self.irelease(right, right_owned)
+        self.irelease(left, left_owned)
+        jump = self.INT_JUMPS[opname][0 if jump_if else 1]
+        getattr(self.asm, jump)(label)
+
+    def to_float(self, node):
+        """
+        Convert the int expression node to float, into a new temporary xmm
+        register
+        """
+        if isinstance(node, ast.Name):
+            src, owned = self.var(node.id), False
+        else:
+            src, owned = self.ivisit(node), True
+        reg = self.regs.new_temp()
+        self.asm.CVTSI2SD(reg, src)
+        self.irelease(src, owned)
+        return reg
+
+    def ineed(self, node, as_operand=False):
+        """
+        Like need(), but for int expressions, which use the general purpose
+        registers
+        """
+        if isinstance(node, ast.BinOp):
+            left = self.ineed(node.left)
+            right = self.ineed(node.right, as_operand=True)
+            if left == right:
+                return left + 1
+            return max(left, right)
+        if isinstance(node, ast.UnaryOp):
+            return self.ineed(node.operand)
+        if isinstance(node, ast.Num) and as_operand:
+            return 0 if is_int32(node.n) else 1
+        if is_int_call(node):
+            # the result is always computed into a new register
+            return 1
+        if isinstance(node, ast.Call):
+            # abs(), min() or max() of ints
+            return max([self.ineed(node.args[0])] +
+                       [self.ineed(arg) + 1 for arg in node.args[1:]])
+        return 0 if as_operand else 1
+
+    def ioperand(self, node):
+        """
+        Like operand(), but for int expressions: op is a general purpose
+        register, a memory reference or a 32-bit immediate
+        """
+        if isinstance(node, ast.Name):
+            return self.var(node.id), False
+        elif isinstance(node, ast.Num) and is_int32(node.n):
+            return int(node.n), False
+        return self.ivisit(node), True
+
+    def irelease(self, op, owned):
+        if owned:
+            self.iregs.free_temp(op)
+
+    def ivisit(self, node):
+        """
+        Evaluate the int expression node into a temporary general purpose
+        register, which the caller owns
+        """
+        if isinstance(node, ast.BinOp):
+            return self.ibinop(node)
+        if isinstance(node, ast.UnaryOp):
+            reg = self.ivisit(node.operand)
+            if isinstance(node.op, ast.USub):
+                self.asm.NEG(reg)
+            return reg
+        if is_int_call(node):
+            return self.int_call(call_name(node), node.args[0])
+        if isinstance(node, ast.Call):
+            return getattr(self, 'int_' + call_name(node))(node)
+        reg = self.iregs.new_temp()
+        if isinstance(node, ast.Num):
+            self.asm.MOV(reg, int(node.n))
+        elif isinstance(node, ast.Name):
+            self.asm.MOV(reg, self.var(node.id))
+        else:
+            raise NotImplementedError(node.__class__.__name__)
+        return reg
+
+    # the rounding modes of ROUNDSD, with the precision exception suppressed
+    ROUND_FLOOR = 0x9
+    ROUND_CEIL = 0xa
+
+    def int_call(self, name, arg):
+        """
+        int(arg), floor(arg) or ceil(arg): int() truncates towards zero,
+        like in Python. Values which don't fit in 64 bits give the "integer
+        indefinite" value 0x8000000000000000 instead of raising
+        OverflowError.
+        """
+        if self.is_int(arg):
+            return self.ivisit(arg)
+        asm = self.asm
+        src, owned = self.operand(arg)
+        if name != 'int' and 'sse4_1' in cpu.features():
+            tmp = src if owned else self.regs.new_temp()
+            mode = self.ROUND_FLOOR if name == 'floor' else self.ROUND_CEIL
+            asm.ROUNDSD(tmp, src, mode)
+            src, owned = tmp, True
+        reg = self.iregs.new_temp()
+        asm.CVTTSD2SI(reg, src)
+        if name != 'int' and 'sse4_1' not in cpu.features():
+            # correct the truncated value if it's on the wrong side of arg:
+            # after UCOMISD, "above" means tmp > arg and "below" tmp < arg
+            tmp = self.regs.new_temp()
+            asm.CVTSI2SD(tmp, reg)
+            asm.UCOMISD(tmp, src)
+            if name == 'floor':
+                asm.SETA(asm.al)
+                asm.MOVZX(asm.eax, asm.al)
+                asm.SUB(reg, asm.rax)
+            else:
+                asm.SETB(asm.al)
+                asm.MOVZX(asm.eax, asm.al)
+                asm.ADD(reg, asm.rax)
+            self.regs.free_temp(tmp)
+        self.release(src, owned)
+        return reg
+
+    def int_abs(self, node):
+        self.check_args(node, ['x'])
+        reg = self.ivisit(node.args[0])
+        self.asm.MOV(self.asm.rax, reg)
+        self.asm.NEG(self.asm.rax)
+        # if -reg >= 0, i.e. reg <= 0
+        self.asm.CMOVNS(reg, self.asm.rax)
+        return reg
+
+    def int_min(self, node):
+        return self.int_minmax(node, self.asm.CMOVG)
+
+    def int_max(self, node):
+        return self.int_minmax(node, self.asm.CMOVL)
+
+    def int_minmax(self, node, cmov):
+        """
+        Like builtin_minmax(): the first of the equal values wins
+        """
+        if len(node.args) < 2 or node.keywords:
+            raise NotImplementedError('%s() needs at least 2 arguments' %
+                                      callee(node))
+        acc = self.ivisit(node.args[0])
+        for arg in node.args[1:]:
+            op, owned, acc = self.ivisit_holding(arg, acc, as_operand=True)
+            if isinstance(op, int):
+                # CMOV does not accept immediates
+                self.asm.MOV(self.asm.rax, op)
+                op = self.asm.rax
+            self.asm.CMP(acc, op)
+            cmov(acc, op)
+            self.irelease(op, owned)
+        return acc
+
+    def ibinop(self, node):
+        if self.ineed(node.right, as_operand=True) > self.ineed(node.left):
+            right, right_owned = self.ivisit(node.right), True
+            left, _, right = self.ivisit_holding(node.left, right)
+        else:
+            left = self.ivisit(node.left)
+            right, right_owned, left = self.ivisit_holding(node.right, left,
+                                                           as_operand=True)
+        self.iop(node.op, left, right)
+        self.irelease(right, right_owned)
+        return left
+
+    def iop(self, op, dst, src):
+        if isinstance(op, ast.Add):
+            self.asm.ADD(dst, src)
+        elif isinstance(op, ast.Sub):
+            self.asm.SUB(dst, src)
+        elif isinstance(op, ast.Mult):
+            if isinstance(src, int):
+                self.asm.IMUL(dst, dst, src)
+            else:
+                self.asm.IMUL(dst, src)
+        else:
+            raise NotImplementedError('operator %s' %
+                                      op.__class__.__name__.upper())
+
+    def ivisit_holding(self, node, held, as_operand=False):
+        """
+        Like visit_holding(), for int expressions
+        """
+        spill = self.ineed(node, as_operand) > self.iregs.nfree()
+        if spill:
+            self.asm.push(held)
+            self.iregs.free_temp(held)
+        if as_operand:
+            op, owned = self.ioperand(node)
+        else:
+            op, owned = self.ivisit(node), True
+        if spill:
+            held = self.iregs.new_temp()
+            self.asm.pop(held)
+        return op, owned, held
+
+    def ivisit_into(self, node, dst, varname):
+        """
+        Like visit_into(), for int expressions: "i = i + 1" becomes a single
+        ADD
+        """
+        if (isinstance(node, ast.BinOp) and
+            varname not in self.names(node.right)):
+            self.ivisit_into(node.left, dst, varname)
+            right, owned = self.ioperand(node.right)
+            self.iop(node.op, dst, right)
+            self.irelease(right, owned)
+            return
+        src, owned = self.ioperand(node)
+        if src is not dst:
+            self.asm.MOV(dst, src)
+        self.irelease(src, owned)
+
+
+def is_int32(value):
+    return -2**31 <= value < 2**31
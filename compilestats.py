@@ -0,0 +1,121 @@
+"""
+Statistics of the compilation: the time spent in each phase, and the size
+of the generated code.
+
+Each CompiledFunction produced by jit.compile() has a CompileStats in its
+stats attribute, and the totals of all the compilations are available with
+jit.compile_stats(). To export them, register a hook which is called with
+the CompileStats of each function after it is loaded:
+
+    compilestats.add_hook(lambda stats: send(stats.as_dict()))
+"""
+import time
+import warnings
+import threading
+import contextlib
+
+# in order: parse, optimize and lower are done on the AST, codegen emits
+# the instructions, encode and relocate are done by
+# FunctionAssembler.assemble() on each function, link puts them together,
+# load copies the code to executable memory
+PHASES = ('parse', 'optimize', 'lower', 'codegen', 'encode', 'relocate',
+          'link', 'load')
+
+
+class CompileStats:
+    """
+    The statistics of one compilation. If cached is True, the code was
+    loaded from the disk cache and only the load phase is timed.
+    """
+
+    def __init__(self, name=None, cached=False):
+        self.name = name
+        self.cached = cached
+        self.times = dict.fromkeys(PHASES, 0.0) # phase -> seconds
+        self.functions = 0 # including the callees compiled together
+        self.instructions = 0
+        self.code_size = 0
+        self.consts_size = 0
+        self.registers = [] # the names of the registers used
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    @property
+    def total_time(self):
+        return sum(self.times.values())
+
+    def as_dict(self):
+        return dict(name=self.name, cached=self.cached, times=dict(self.times),
+                    total_time=self.total_time, functions=self.functions,
+                    instructions=self.instructions, code_size=self.code_size,
+                    consts_size=self.consts_size,
+                    registers=list(self.registers))
+
+    def __repr__(self):
+        return '<CompileStats %s: %.2f ms, %d bytes>' % (
+            self.name, self.total_time * 1000, self.code_size)
+
+
+class Totals:
+    """
+    The sum of the statistics of all the compilations
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.compilations = 0
+        self.cached = 0
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.instructions = 0
+        self.code_size = 0
+        self.consts_size = 0
+
+    def add(self, stats):
+        with self.lock:
+            self.compilations += 1
+            self.cached += stats.cached
+            for phase, t in stats.times.items():
+                self.times[phase] += t
+            self.instructions += stats.instructions
+            self.code_size += stats.code_size
+            self.consts_size += stats.consts_size
+
+    def as_dict(self):
+        with self.lock:
+            return dict(compilations=self.compilations, cached=self.cached,
+                        times=dict(self.times),
+                        total_time=sum(self.times.values()),
+                        instructions=self.instructions,
+                        code_size=self.code_size,
+                        consts_size=self.consts_size)
+
+totals = Totals()
+_hooks = []
+
+def add_hook(hook):
+    _hooks.append(hook)
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+def record(stats):
+    """
+    Add stats to the totals and pass it to the hooks. An exception raised
+    by a hook is turned into a warning, so that it can't break compile()
+    """
+    totals.add(stats)
+    for hook in list(_hooks):
+        try:
+            hook(stats)
+        except Exception as e:
+            warnings.warn('compile stats hook %r failed: %s: %s' %
+                          (hook, type(e).__name__, e))
@@ -0,0 +1,27 @@
+"""
+Detection of the features of the CPU we are running on.
+"""
+import platform
+
+_features = None
+
+def features():
+    """
+    Return the set of the CPU flags, as reported by /proc/cpuinfo (e.g.
+    'sse4_1', 'avx2'). If they are not available, return a set containing
+    only the name of the architecture.
+    """
+    global _features
+    if _features is None:
+        _features = frozenset(_read_cpuinfo() or [platform.machine()])
+    return _features
+
+def _read_cpuinfo():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('flags'):
+                    return line.split(':', 1)[1].split()
+    except OSError:
+        pass
+    return None
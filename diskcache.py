@@ -0,0 +1,181 @@
+"""
+Persistent on-disk cache of compiled machine code.
+
+Each entry is a file named after the hash of the dedented source of the
+function, the version of the compiler, the compilation options and the
+features of the CPU. It contains the code, the constants, the relocations
+and the signature of the function, so that loading it does not need to
+import PeachPy at all.
+
+Entries are written to a temporary file which is atomically renamed, so
+multiple processes can safely share the same directory: readers see either
+a complete entry or no entry at all. When the total size of the cache
+exceeds max_size, the least recently used entries are deleted.
+"""
+import os
+import json
+import time
+import struct
+import hashlib
+import tempfile
+import cpu
+
+MAGIC = b'JIT30MIN'
+TMP_PREFIX = '.tmp-'
+SUFFIX = '.jit'
+
+# files which affect the generated code: if one of them changes, all the
+# entries are invalidated
+COMPILER_FILES = ('compiler.py', 'assembler.py', 'optimizer.py',
+                  'vectorizer.py', 'codearena.py', 'typeinfer.py',
+                  'lowering.py', 'libm.py', 'linking.py', 'perfmap.py',
+                  'profiler.py', 'peephole.py', 'encoder.py')
+
+_compiler_version = None
+
+def compiler_version():
+    global _compiler_version
+    if _compiler_version is None:
+        h = hashlib.sha256()
+        root = os.path.dirname(os.path.abspath(__file__))
+        for filename in COMPILER_FILES:
+            with open(os.path.join(root, filename), 'rb') as f:
+                h.update(f.read())
+        _compiler_version = h.hexdigest()
+    return _compiler_version
+
+
+class DiskCache:
+
+    def __init__(self, path, max_size=64*1024*1024):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, src, options):
+        h = hashlib.sha256()
+        h.update(src.encode('utf-8'))
+        h.update(compiler_version().encode('ascii'))
+        h.update(repr(sorted(options.items())).encode('utf-8'))
+        h.update(' '.join(sorted(cpu.features())).encode('ascii'))
+        return h.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + SUFFIX)
+
+    def get(self, key):
+        """
+        Return (nargs, code, argtypes, consts, relocs, links, symbols,
+        counters, line_markers), or None if the entry is missing or corrupted
+        """
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        entry = self._decode(data)
+        if entry is None:
+            self._unlink(filename)
+            return None
+        try:
+            # update the mtime, which is used for LRU eviction
+            os.utime(filename)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, nargs, code, argtypes, consts=b'', relocs=(),
+            links=(), symbols=None, counters=None, line_markers=False):
+        header = json.dumps({'nargs': nargs, 'argtypes': argtypes,
+                             'size': len(code), 'consts': len(consts),
+                             'relocs': list(relocs), 'links': list(links),
+                             'symbols': symbols,
+                             'counters': counters,
+                             'line_markers': line_markers}).encode('utf-8')
+        data = (MAGIC + struct.pack('<I', len(header)) + header + bytes(code) +
+                bytes(consts))
+        fd, tmpname = tempfile.mkstemp(dir=self.path, prefix=TMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmpname, self._filename(key))
+        except BaseException:
+            self._unlink(tmpname)
+            raise
+        self.evict()
+
+    def _decode(self, data):
+        start = len(MAGIC) + 4
+        if len(data) < start or not data.startswith(MAGIC):
+            return None
+        size, = struct.unpack('<I', data[len(MAGIC):start])
+        try:
+            header = json.loads(data[start:start+size].decode('utf-8'))
+        except ValueError:
+            return None
+        body = data[start+size:]
+        try:
+            code_size = header['size']
+            consts_size = header['consts']
+            relocs = [(offset, delta) for offset, delta in header['relocs']]
+            links = [(offset, kind, arg)
+                     for offset, kind, arg in header.get('links', ())]
+            symbols = header.get('symbols')
+            if symbols is not None:
+                symbols = [(offset, size, name)
+                           for offset, size, name in symbols]
+            counters = header.get('counters')
+            if counters is not None:
+                counters = [(name, line, counter)
+                            for name, line, counter in counters]
+            line_markers = bool(header.get('line_markers'))
+        except (KeyError, TypeError, ValueError):
+            return None
+        if len(body) != code_size + consts_size:
+            return None
+        code = body[:code_size]
+        consts = body[code_size:]
+        return (header['nargs'], code, header['argtypes'], consts, relocs,
+                links, symbols, counters, line_markers)
+
+    def entries(self):
+        """
+        Return [(mtime, size, filename)] of all the entries, and delete the
+        temporary files left behind by crashed processes
+        """
+        result = []
+        now = time.time()
+        for entry in os.scandir(self.path):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue # deleted by another process
+            if entry.name.startswith(TMP_PREFIX):
+                if now - st.st_mtime > 3600:
+                    self._unlink(entry.path)
+            elif entry.name.endswith(SUFFIX):
+                result.append((st.st_mtime, st.st_size, entry.path))
+        return result
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, filename in entries:
+            if total <= self.max_size:
+                break
+            self._unlink(filename)
+            total -= size
+
+    def clear(self):
+        for _, _, filename in self.entries():
+            self._unlink(filename)
+
+    def _unlink(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass # already deleted by another process
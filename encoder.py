@@ -0,0 +1,563 @@
+"""
+A direct x86-64 encoder for the instructions emitted by FunctionAssembler,
+which can be used instead of PeachPy: it encodes only the small subset of
+instructions and operands which the compiler needs, but it is much faster
+and it does not need to import PeachPy at all.
+
+This module also defines the operands used by FunctionAssembler, whatever
+the encoder: the registers, the memory operands qword[base + index*8 +
+disp] and oword[...], the Constants in memory and the Labels. They mimic
+the ones of PeachPy, and FunctionAssembler converts them when it encodes
+with PeachPy.
+
+encode() works in three steps:
+
+    - each instruction is encoded to bytes, except the jumps, LABEL and
+      ALIGN; the operands which refer to a Constant use RIP-relative
+      addressing, and their 32-bit displacement is filled later
+
+    - the jumps start as short jumps, and become near jumps until all the
+      targets are in range; then the offset of each instruction is known
+
+    - the code is written into a preallocated bytearray, resolving the
+      labels and the references to the constants
+"""
+import struct
+
+
+class Register:
+
+    def __init__(self, name, number, size):
+        self.name = name
+        self.number = number
+        self.size = size # in bytes
+
+    def __repr__(self):
+        return self.name
+
+    def __add__(self, other):
+        return Address(self) + other
+
+    def __sub__(self, disp):
+        return Address(self) - disp
+
+    def __mul__(self, scale):
+        return Address(index=self, scale=scale)
+
+    __rmul__ = __mul__
+
+
+class Address:
+    """
+    base + index*scale + disp, the address of a memory operand
+    """
+
+    def __init__(self, base=None, index=None, scale=1, disp=0):
+        self.base = base
+        self.index = index
+        self.scale = scale
+        self.disp = disp
+
+    def __add__(self, other):
+        if isinstance(other, int):
+            return Address(self.base, self.index, self.scale,
+                           self.disp + other)
+        if isinstance(other, Register):
+            other = Address(other)
+        if self.base is None:
+            self, other = other, self
+        if other.base is not None or self.index is not None:
+            raise EncodingError('unsupported address: %r + %r' %
+                                (self, other))
+        return Address(self.base, other.index, other.scale,
+                       self.disp + other.disp)
+
+    def __sub__(self, disp):
+        return self + (-disp)
+
+    def __repr__(self):
+        parts = []
+        if self.base is not None:
+            parts.append(self.base.name)
+        if self.index is not None:
+            parts.append('%s*%d' % (self.index.name, self.scale))
+        if self.disp or not parts:
+            parts.append(str(self.disp))
+        return ' + '.join(parts)
+
+
+class Memory:
+
+    def __init__(self, address, size):
+        self.address = address
+        self.size = size
+
+    def __repr__(self):
+        return '%s[%r]' % (SIZES[self.size], self.address)
+
+
+class MemorySize:
+    """
+    qword[address] and oword[address] are the memory operands of 8 and 16
+    bytes at address
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def __getitem__(self, address):
+        if isinstance(address, Register):
+            address = Address(address)
+        return Memory(address, self.size)
+
+
+class Constant:
+    """
+    A constant in memory: kind is the name of the constructor, so that it
+    can be converted to a PeachPy Constant
+    """
+
+    def __init__(self, kind, values, data):
+        self.kind = kind
+        self.values = values
+        self.data = data
+        self.size = len(data)
+
+    @classmethod
+    def float64(cls, value):
+        return cls('float64', (value,), struct.pack('<d', value))
+
+    @classmethod
+    def uint64(cls, value):
+        return cls('uint64', (value,), struct.pack('<Q', value))
+
+    @classmethod
+    def uint64x2(cls, a, b):
+        return cls('uint64x2', (a, b), struct.pack('<QQ', a, b))
+
+    def __repr__(self):
+        return 'Constant.%s%r' % (self.kind, self.values)
+
+
+class Label:
+
+    def __init__(self, name=None):
+        self.name = name
+
+    def __repr__(self):
+        return '<Label %s>' % (self.name or hex(id(self)))
+
+
+GPR_NAMES = ('rax', 'rcx', 'rdx', 'rbx', 'rsp', 'rbp', 'rsi', 'rdi',
+             'r8', 'r9', 'r10', 'r11', 'r12', 'r13', 'r14', 'r15')
+REGISTERS = {}
+for _i, _name in enumerate(GPR_NAMES):
+    REGISTERS[_name] = Register(_name, _i, 8)
+for _i in range(16):
+    REGISTERS['xmm%d' % _i] = Register('xmm%d' % _i, _i, 16)
+REGISTERS['eax'] = Register('eax', 0, 4)
+REGISTERS['al'] = Register('al', 0, 1)
+globals().update(REGISTERS)
+
+qword = MemorySize(8)
+oword = MemorySize(16)
+SIZES = {8: 'qword', 16: 'oword'}
+
+
+class EncodingError(Exception):
+    pass
+
+
+# ModRM and SIB
+
+def is_int8(value):
+    return -128 <= value < 128
+
+def is_int32(value):
+    return -2**31 <= value < 2**31
+
+SCALES = {1: 0, 2: 1, 4: 2, 8: 3}
+
+def modrm(reg, rm):
+    """
+    Return (rex, tail, const), where tail is the ModRM byte followed by the
+    SIB and the displacement, and rex the REX bits R, X and B. reg is a
+    register number or an opcode extension, rm a Register, Memory or
+    Constant. If rm is a Constant, the last 4 bytes of tail are its
+    RIP-relative displacement, which is filled by encode().
+    """
+    rex = (reg & 8) >> 1 # REX.R
+    reg &= 7
+    if isinstance(rm, Register):
+        rex |= (rm.number & 8) >> 3 # REX.B
+        return rex, bytes([0xc0 | reg << 3 | rm.number & 7]), None
+    if isinstance(rm, Constant):
+        return rex, bytes([reg << 3 | 5, 0, 0, 0, 0]), rm
+    if not isinstance(rm, Memory):
+        raise EncodingError('not a register or memory operand: %r' % (rm,))
+    address = rm.address
+    base, index, disp = address.base, address.index, address.disp
+    if base is None:
+        raise EncodingError('unsupported address: %r' % address)
+    rex |= (base.number & 8) >> 3
+    if disp == 0 and base.number & 7 != 5: # rbp and r13 need a disp
+        mod, disp_bytes = 0, b''
+    elif is_int8(disp):
+        mod, disp_bytes = 1, struct.pack('<b', disp)
+    elif is_int32(disp):
+        mod, disp_bytes = 2, struct.pack('<i', disp)
+    else:
+        raise EncodingError('displacement out of range: %r' % address)
+    if index is None and base.number & 7 != 4: # rsp and r12 need a SIB
+        byte = mod << 6 | reg << 3 | base.number & 7
+        return rex, bytes([byte]) + disp_bytes, None
+    if index is None:
+        sib = 0x24 # no index
+    else:
+        if index.number == 4:
+            raise EncodingError('rsp cannot be an index: %r' % address)
+        rex |= (index.number & 8) >> 2 # REX.X
+        sib = (SCALES[address.scale] << 6 | (index.number & 7) << 3 |
+               base.number & 7)
+    return rex, bytes([mod << 6 | reg << 3 | 4, sib]) + disp_bytes, None
+
+def instruction(prefix, rexw, opcode, reg, rm, imm=b''):
+    """
+    Return (data, const, disp_offset) of the instruction, where disp_offset
+    is the offset of the displacement of const in data
+    """
+    rex, tail, const = modrm(reg, rm)
+    if rexw:
+        rex |= 8
+    rex_byte = bytes([0x40 | rex]) if rex else b''
+    data = prefix + rex_byte + opcode + tail + imm
+    if const is None:
+        return data, None, 0
+    return data, const, len(data) - len(imm) - 4
+
+
+def check(condition, name, args):
+    if not condition:
+        raise EncodingError('unsupported operands: %s %s' %
+                            (name, ', '.join(map(repr, args))))
+
+def is_gpr(op, size=8):
+    return isinstance(op, Register) and op.size == size and op.size <= 8
+
+def is_xmm(op):
+    return isinstance(op, Register) and op.size == 16
+
+def is_mem(op):
+    return isinstance(op, (Memory, Constant))
+
+
+# the SSE instructions xmm, xmm/m: name -> (prefix, opcode)
+SSE = {
+    'ADDSD': (b'\xf2', b'\x0f\x58'),
+    'SUBSD': (b'\xf2', b'\x0f\x5c'),
+    'MULSD': (b'\xf2', b'\x0f\x59'),
+    'DIVSD': (b'\xf2', b'\x0f\x5e'),
+    'SQRTSD': (b'\xf2', b'\x0f\x51'),
+    'MINSD': (b'\xf2', b'\x0f\x5d'),
+    'MAXSD': (b'\xf2', b'\x0f\x5f'),
+    'ADDPD': (b'\x66', b'\x0f\x58'),
+    'SUBPD': (b'\x66', b'\x0f\x5c'),
+    'MULPD': (b'\x66', b'\x0f\x59'),
+    'DIVPD': (b'\x66', b'\x0f\x5e'),
+    'ANDPD': (b'\x66', b'\x0f\x54'),
+    'XORPD': (b'\x66', b'\x0f\x57'),
+    'PXOR': (b'\x66', b'\x0f\xef'),
+    'UNPCKLPD': (b'\x66', b'\x0f\x14'),
+    'UNPCKHPD': (b'\x66', b'\x0f\x15'),
+    'UCOMISD': (b'\x66', b'\x0f\x2e'),
+    }
+
+# the SSE moves: name -> (prefix, load opcode, store opcode)
+SSE_MOVES = {
+    'MOVSD': (b'\xf2', b'\x0f\x10', b'\x0f\x11'),
+    'MOVAPD': (b'\x66', b'\x0f\x28', b'\x0f\x29'),
+    'MOVUPD': (b'\x66', b'\x0f\x10', b'\x0f\x11'),
+    }
+
+# the arithmetic instructions: name -> opcode extension
+ALU = {'ADD': 0, 'OR': 1, 'SUB': 5, 'CMP': 7}
+
+CONDITIONS = {
+    'O': 0x0, 'NO': 0x1, 'B': 0x2, 'AE': 0x3, 'E': 0x4, 'NE': 0x5,
+    'BE': 0x6, 'A': 0x7, 'S': 0x8, 'NS': 0x9, 'P': 0xa, 'NP': 0xb,
+    'L': 0xc, 'GE': 0xd, 'LE': 0xe, 'G': 0xf,
+    }
+JUMPS = dict(('J' + cc, code) for cc, code in CONDITIONS.items())
+JUMPS['JMP'] = None
+
+
+def encode_sse(name, args):
+    prefix, opcode = SSE[name]
+    check(len(args) == 2 and is_xmm(args[0]) and
+          (is_xmm(args[1]) or is_mem(args[1])), name, args)
+    return instruction(prefix, False, opcode, args[0].number, args[1])
+
+def encode_sse_move(name, args):
+    prefix, load, store = SSE_MOVES[name]
+    check(len(args) == 2, name, args)
+    dst, src = args
+    if is_xmm(dst) and (is_xmm(src) or is_mem(src)):
+        return instruction(prefix, False, load, dst.number, src)
+    check(is_mem(dst) and is_xmm(src), name, args)
+    return instruction(prefix, False, store, src.number, dst)
+
+def encode_alu(name, args):
+    n = ALU[name]
+    check(len(args) == 2, name, args)
+    dst, src = args
+    if isinstance(src, int):
+        check((is_gpr(dst) or is_mem(dst)) and is_int32(src), name, args)
+        if is_int8(src):
+            return instruction(b'', True, b'\x83', n, dst,
+                               struct.pack('<b', src))
+        if dst is REGISTERS['rax']:
+            return b'\x48' + bytes([8*n + 5]) + struct.pack('<i', src), None, 0
+        return instruction(b'', True, b'\x81', n, dst, struct.pack('<i', src))
+    if is_gpr(src):
+        check(is_gpr(dst) or is_mem(dst), name, args)
+        return instruction(b'', True, bytes([8*n + 1]), src.number, dst)
+    check(is_gpr(dst) and is_mem(src), name, args)
+    return instruction(b'', True, bytes([8*n + 3]), dst.number, src)
+
+def encode_mov(name, args):
+    check(len(args) == 2, name, args)
+    dst, src = args
+    if isinstance(src, int):
+        check(is_gpr(dst) and -2**63 <= src < 2**64, name, args)
+        if is_int32(src):
+            return instruction(b'', True, b'\xc7', 0, dst,
+                               struct.pack('<i', src))
+        # MOV r64, imm64
+        rex = 0x48 | (dst.number & 8) >> 3
+        return (bytes([rex, 0xb8 | dst.number & 7]) +
+                struct.pack('<Q', src & (2**64 - 1)), None, 0)
+    if is_gpr(src):
+        check(is_gpr(dst) or is_mem(dst), name, args)
+        return instruction(b'', True, b'\x89', src.number, dst)
+    check(is_gpr(dst) and is_mem(src), name, args)
+    return instruction(b'', True, b'\x8b', dst.number, src)
+
+def encode_imul(name, args):
+    check(len(args) in (2, 3) and is_gpr(args[0]) and
+          (is_gpr(args[1]) or is_mem(args[1])), name, args)
+    if len(args) == 2:
+        return instruction(b'', True, b'\x0f\xaf', args[0].number, args[1])
+    imm = args[2]
+    check(isinstance(imm, int) and is_int32(imm), name, args)
+    if is_int8(imm):
+        return instruction(b'', True, b'\x6b', args[0].number, args[1],
+                           struct.pack('<b', imm))
+    return instruction(b'', True, b'\x69', args[0].number, args[1],
+                       struct.pack('<i', imm))
+
+def encode_neg(name, args):
+    check(len(args) == 1 and (is_gpr(args[0]) or is_mem(args[0])),
+          name, args)
+    return instruction(b'', True, b'\xf7', 3, args[0])
+
+def encode_shl(name, args):
+    check(len(args) == 2 and is_gpr(args[0]) and isinstance(args[1], int) and
+          0 <= args[1] < 64, name, args)
+    if args[1] == 1:
+        return instruction(b'', True, b'\xd1', 4, args[0])
+    return instruction(b'', True, b'\xc1', 4, args[0], bytes([args[1]]))
+
+def encode_cmov(name, args):
+    check(len(args) == 2 and is_gpr(args[0]) and
+          (is_gpr(args[1]) or is_mem(args[1])), name, args)
+    opcode = bytes([0x0f, 0x40 | CONDITIONS[name[4:]]])
+    return instruction(b'', True, opcode, args[0].number, args[1])
+
+def encode_set(name, args):
+    check(len(args) == 1 and is_gpr(args[0], 1), name, args)
+    opcode = bytes([0x0f, 0x90 | CONDITIONS[name[3:]]])
+    return instruction(b'', False, opcode, 0, args[0])
+
+def encode_movzx(name, args):
+    check(len(args) == 2 and is_gpr(args[0], 4) and is_gpr(args[1], 1),
+          name, args)
+    return instruction(b'', False, b'\x0f\xb6', args[0].number, args[1])
+
+def encode_cvtsi2sd(name, args):
+    check(len(args) == 2 and is_xmm(args[0]) and
+          (is_gpr(args[1]) or is_mem(args[1])), name, args)
+    return instruction(b'\xf2', True, b'\x0f\x2a', args[0].number, args[1])
+
+def encode_cvttsd2si(name, args):
+    check(len(args) == 2 and is_gpr(args[0]) and
+          (is_xmm(args[1]) or is_mem(args[1])), name, args)
+    return instruction(b'\xf2', True, b'\x0f\x2c', args[0].number, args[1])
+
+def encode_roundsd(name, args):
+    check(len(args) == 3 and is_xmm(args[0]) and
+          (is_xmm(args[1]) or is_mem(args[1])) and
+          isinstance(args[2], int) and 0 <= args[2] < 256, name, args)
+    return instruction(b'\x66', False, b'\x0f\x3a\x0b', args[0].number,
+                       args[1], bytes([args[2]]))
+
+def encode_call(name, args):
+    check(len(args) == 1 and (is_gpr(args[0]) or is_mem(args[0])),
+          name, args)
+    return instruction(b'', False, b'\xff', 2, args[0])
+
+def encode_fixed(data):
+    def encode(name, args):
+        check(not args, name, args)
+        return data, None, 0
+    return encode
+
+ENCODERS = {
+    'MOV': encode_mov,
+    'IMUL': encode_imul,
+    'NEG': encode_neg,
+    'SHL': encode_shl,
+    'MOVZX': encode_movzx,
+    'CVTSI2SD': encode_cvtsi2sd,
+    'CVTTSD2SI': encode_cvttsd2si,
+    'ROUNDSD': encode_roundsd,
+    'CALL': encode_call,
+    'RET': encode_fixed(b'\xc3'),
+    'RDTSC': encode_fixed(b'\x0f\x31'),
+    }
+ENCODERS.update(dict.fromkeys(SSE, encode_sse))
+ENCODERS.update(dict.fromkeys(SSE_MOVES, encode_sse_move))
+ENCODERS.update(dict.fromkeys(ALU, encode_alu))
+ENCODERS.update(dict.fromkeys(['CMOV' + cc for cc in CONDITIONS],
+                              encode_cmov))
+ENCODERS.update(dict.fromkeys(['SET' + cc for cc in CONDITIONS], encode_set))
+
+# the recommended multi-byte NOPs, by length
+NOPS = [
+    b'',
+    b'\x90',
+    b'\x66\x90',
+    b'\x0f\x1f\x00',
+    b'\x0f\x1f\x40\x00',
+    b'\x0f\x1f\x44\x00\x00',
+    b'\x66\x0f\x1f\x44\x00\x00',
+    b'\x0f\x1f\x80\x00\x00\x00\x00',
+    b'\x0f\x1f\x84\x00\x00\x00\x00\x00',
+    b'\x66\x0f\x1f\x84\x00\x00\x00\x00\x00',
+    ]
+
+def nops(n):
+    result = b''
+    while n > 0:
+        k = min(n, len(NOPS) - 1)
+        result += NOPS[k]
+        n -= k
+    return result
+
+# the kinds of the items which are not encoded in advance
+JUMP, LABEL, ALIGN = object(), object(), object()
+
+def encode(instructions):
+    """
+    Encode the list of (name, args), and return (code, consts, fixups,
+    padding). Each fixup (offset, target, pc) is a 32-bit field at offset
+    of code, which must be set to target - pc + (address of consts -
+    address of code) to refer to the constant at offset target of consts.
+    padding is the list of (offset, size) of the NOPs added by ALIGN.
+    """
+    # the items are (data, const, disp_offset) or (kind, arg, index)
+    items = []
+    jumps = [] # the indexes of the jumps in items
+    for name, args in instructions:
+        encoder = ENCODERS.get(name)
+        if encoder is not None:
+            items.append(encoder(name, args))
+        elif name in JUMPS:
+            check(len(args) == 1 and isinstance(args[0], Label), name, args)
+            jumps.append(len(items))
+            items.append((JUMP, args[0], JUMPS[name]))
+        elif name == 'LABEL':
+            check(len(args) == 1 and isinstance(args[0], Label), name, args)
+            items.append((LABEL, args[0], None))
+        elif name == 'ALIGN':
+            check(len(args) == 1 and args[0] in (1, 2, 4, 8, 16, 32),
+                  name, args)
+            items.append((ALIGN, args[0], None))
+        else:
+            raise EncodingError('unsupported instruction: %s' % name)
+    # choose the size of the jumps: they only grow, so it terminates
+    near = set()
+    while True:
+        offsets, labels, size = layout(items, near)
+        changed = False
+        for i in jumps:
+            if i in near:
+                continue
+            _, label, _ = items[i]
+            if id(label) not in labels:
+                raise EncodingError('undefined label: %r' % label)
+            if not is_int8(labels[id(label)] - (offsets[i] + 2)):
+                near.add(i)
+                changed = True
+        if not changed:
+            break
+    # lay out the constants, 16-byte ones first to keep them aligned
+    pool = {} # data -> offset in consts
+    for _, const, _ in items:
+        if isinstance(const, Constant):
+            pool.setdefault(const.data, None)
+    consts = bytearray()
+    for data in sorted(pool, key=len, reverse=True):
+        pool[data] = len(consts)
+        consts += data
+    code = bytearray(size)
+    fixups = []
+    padding = []
+    for i, (data, arg, extra) in enumerate(items):
+        offset = offsets[i]
+        if data is JUMP:
+            target = labels[id(arg)]
+            if i in near:
+                if extra is None:
+                    code[offset] = 0xe9
+                    end = offset + 5
+                else:
+                    code[offset:offset+2] = bytes([0x0f, 0x80 | extra])
+                    end = offset + 6
+                code[end-4:end] = struct.pack('<i', target - end)
+            else:
+                code[offset] = 0xeb if extra is None else 0x70 | extra
+                code[offset+1] = (target - (offset + 2)) & 0xff
+        elif data is ALIGN:
+            n = -offset % arg
+            if n:
+                code[offset:offset+n] = nops(n)
+                padding.append((offset, n))
+        elif data is not LABEL:
+            code[offset:offset+len(data)] = data
+            if arg is not None:
+                fixups.append((offset + extra, pool[arg.data],
+                               offset + len(data)))
+    return bytes(code), bytes(consts), fixups, padding
+
+def layout(items, near):
+    """
+    Return the offset of each item, the offset of each label (by id) and
+    the size of the code, given the indexes of the near jumps
+    """
+    offsets = []
+    labels = {}
+    offset = 0
+    for i, (data, arg, extra) in enumerate(items):
+        offsets.append(offset)
+        if data is JUMP:
+            if i not in near:
+                offset += 2
+            else:
+                offset += 5 if extra is None else 6
+        elif data is LABEL:
+            labels[id(arg)] = offset
+        elif data is ALIGN:
+            offset += -offset % arg
+        else:
+            offset += len(data)
+    return offsets, labels, offset
@@ -0,0 +1,223 @@
+"""
+Registration of the compiled code with the GDB JIT interface, so that gdb
+shows the names of the compiled functions in backtraces and disassembly.
+Enable it with enable(), or by setting the environment variable
+JIT30MIN_GDB_JIT=1.
+
+For each block of code, we build a minimal ELF relocatable object: a
+NOBITS .text section at the address of the code, and a symbol for each
+function. gdb finds it by putting a breakpoint on __jit_debug_register_code
+and walking the list of __jit_debug_descriptor, see
+https://sourceware.org/gdb/onlinedocs/gdb/JIT-Interface.html.
+
+Python does not define these two symbols, so enable() compiles them into a
+tiny shared library, which needs a C compiler (cc, or $CC).
+"""
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import subprocess
+from cffi import FFI
+
+C_SOURCE = r"""
+#include <stdint.h>
+
+struct jit_code_entry {
+    struct jit_code_entry *next_entry;
+    struct jit_code_entry *prev_entry;
+    const char *symfile_addr;
+    uint64_t symfile_size;
+};
+
+struct jit_descriptor {
+    uint32_t version;
+    uint32_t action_flag;
+    struct jit_code_entry *relevant_entry;
+    struct jit_code_entry *first_entry;
+};
+
+void __attribute__((noinline)) __jit_debug_register_code(void) {
+    __asm__ __volatile__("");
+}
+
+struct jit_descriptor __jit_debug_descriptor = { 1, 0, 0, 0 };
+"""
+
+JIT_REGISTER_FN = 1
+JIT_UNREGISTER_FN = 2
+
+ffi = FFI()
+ffi.cdef("""
+    struct jit_code_entry {
+        struct jit_code_entry *next_entry;
+        struct jit_code_entry *prev_entry;
+        const char *symfile_addr;
+        uint64_t symfile_size;
+    };
+    struct jit_descriptor {
+        uint32_t version;
+        uint32_t action_flag;
+        struct jit_code_entry *relevant_entry;
+        struct jit_code_entry *first_entry;
+    };
+    void __jit_debug_register_code(void);
+    extern struct jit_descriptor __jit_debug_descriptor;
+""")
+
+enabled = False
+_lib = None
+_descriptor = None
+_lock = threading.Lock()
+
+
+def _build_lib():
+    tmpdir = tempfile.mkdtemp(prefix='jit30min-gdb-')
+    try:
+        c_file = os.path.join(tmpdir, 'gdbjit.c')
+        so_file = os.path.join(tmpdir, 'libjit30min_gdb.so')
+        with open(c_file, 'w') as f:
+            f.write(C_SOURCE)
+        cc = os.environ.get('CC', 'cc')
+        try:
+            subprocess.run([cc, '-shared', '-fPIC', '-O0', '-o', so_file,
+                            c_file], check=True, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            raise RuntimeError('cannot find the C compiler %r needed by the '
+                               'gdb JIT interface: set $CC' % cc)
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError('cannot compile the gdb JIT helper:\n%s' %
+                               e.stderr.decode('utf-8', 'replace'))
+        # the library stays mapped after its file is removed
+        return ffi.dlopen(so_file)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def enable():
+    """
+    Start registering the compiled code with gdb. Raise RuntimeError if
+    the helper library cannot be compiled.
+    """
+    global enabled, _lib, _descriptor
+    with _lock:
+        if _lib is None:
+            _lib = _build_lib()
+            _descriptor = ffi.addressof(_lib, '__jit_debug_descriptor')
+        enabled = True
+
+def disable():
+    """
+    Stop registering the new code: the code already registered stays
+    registered until it is freed
+    """
+    global enabled
+    enabled = False
+
+
+# ELF constants
+ET_REL = 1
+EM_X86_64 = 62
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_NOBITS = 8
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+STB_GLOBAL = 1
+STT_FUNC = 2
+TEXT_INDEX = 1
+
+ELF_HEADER = struct.Struct('<16sHHIQQQIHHHHHH')
+SECTION_HEADER = struct.Struct('<IIQQQQIIQQ')
+SYMBOL = struct.Struct('<IBBHQQ')
+
+class StringTable:
+
+    def __init__(self):
+        self.data = bytearray(b'\0')
+
+    def add(self, s):
+        offset = len(self.data)
+        self.data += s.encode('utf-8') + b'\0'
+        return offset
+
+def make_elf(address, size, symbols):
+    """
+    Return the ELF object describing size bytes of code loaded at address,
+    which contains the functions [(offset, size, name)]
+    """
+    shstrtab = StringTable()
+    strtab = StringTable()
+    symtab = bytearray(SYMBOL.size) # the null symbol
+    for offset, fn_size, name in symbols:
+        symtab += SYMBOL.pack(strtab.add(name), STB_GLOBAL << 4 | STT_FUNC,
+                              0, TEXT_INDEX, offset, fn_size)
+    names = [shstrtab.add(name) for name in
+             ('.text', '.symtab', '.strtab', '.shstrtab')]
+    # the layout is: ELF header, symtab, strtab, shstrtab, section headers
+    symtab_offset = ELF_HEADER.size
+    strtab_offset = symtab_offset + len(symtab)
+    shstrtab_offset = strtab_offset + len(strtab.data)
+    shoff = shstrtab_offset + len(shstrtab.data)
+    shoff += -shoff % 8
+    sections = [
+        bytes(SECTION_HEADER.size),
+        SECTION_HEADER.pack(names[0], SHT_NOBITS, SHF_ALLOC | SHF_EXECINSTR,
+                            address, 0, size, 0, 0, 16, 0),
+        # sh_link is the string table, sh_info the first global symbol
+        SECTION_HEADER.pack(names[1], SHT_SYMTAB, 0, 0, symtab_offset,
+                            len(symtab), 3, 1, 8, SYMBOL.size),
+        SECTION_HEADER.pack(names[2], SHT_STRTAB, 0, 0, strtab_offset,
+                            len(strtab.data), 0, 0, 1, 0),
+        SECTION_HEADER.pack(names[3], SHT_STRTAB, 0, 0, shstrtab_offset,
+                            len(shstrtab.data), 0, 0, 1, 0),
+        ]
+    ident = b'\x7fELF' + bytes([2, 1, 1]) # 64 bit, little endian, version 1
+    header = ELF_HEADER.pack(ident, ET_REL, EM_X86_64, 1, 0, 0, shoff, 0,
+                             ELF_HEADER.size, 0, 0, SECTION_HEADER.size,
+                             len(sections), len(sections) - 1)
+    data = header + symtab + strtab.data + shstrtab.data
+    return data + bytes(shoff - len(data)) + b''.join(sections)
+
+
+class Entry:
+    """
+    A registered ELF object: the cffi objects must stay alive until it is
+    unregistered
+    """
+
+    def __init__(self, elf):
+        self.elf = ffi.new('char[]', elf)
+        self.entry = ffi.new('struct jit_code_entry *')
+        self.entry.symfile_addr = self.elf
+        self.entry.symfile_size = len(elf)
+
+def register(address, size, symbols):
+    """
+    Register the code and return an Entry to pass to unregister()
+    """
+    entry = Entry(make_elf(address, size, symbols))
+    with _lock:
+        first = _descriptor.first_entry
+        entry.entry.next_entry = first
+        if first != ffi.NULL:
+            first.prev_entry = entry.entry
+        _descriptor.first_entry = entry.entry
+        _descriptor.relevant_entry = entry.entry
+        _descriptor.action_flag = JIT_REGISTER_FN
+        _lib.__jit_debug_register_code()
+    return entry
+
+def unregister(entry):
+    with _lock:
+        e = entry.entry
+        if e.prev_entry != ffi.NULL:
+            e.prev_entry.next_entry = e.next_entry
+        else:
+            _descriptor.first_entry = e.next_entry
+        if e.next_entry != ffi.NULL:
+            e.next_entry.prev_entry = e.prev_entry
+        _descriptor.relevant_entry = e
+        _descriptor.action_flag = JIT_UNREGISTER_FN
+        _lib.__jit_debug_register_code()
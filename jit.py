@@ -1,202 +1,795 @@
-import mmap
+import os
+import re
 import ast
+import array
+import builtins
 import textwrap
+import types
 import inspect
-from collections import defaultdict
+import operator
+import warnings
+import functools
+import threading
+import concurrent.futures
+from collections import OrderedDict
 from cffi import FFI
-from assembler import FunctionAssembler as FA
+from diskcache import DiskCache
+from codearena import CodeArena
+from mapdriver import map_driver
+from compilestats import CompileStats
+import compilestats
+import perfmap
+import gdbjit
+import profiler
+import linking
 
 ffi = FFI()
 ffi.cdef("""
-    typedef double (*fn0)(void);
-    typedef double (*fn1)(double);
-    typedef double (*fn2)(double, double);
-    typedef double (*fn3)(double, double, double);
+    typedef void (*map_driver)(void *kernel, double **inputs,
+                               int64_t *strides, double *out, int64_t n);
 """)
 
+# all the compiled functions share the same executable memory
+code_arena = CodeArena()
+
+_map_drivers = {} # nargs -> fptr
+
+def get_map_driver(nargs):
+    fptr = _map_drivers.get(nargs)
+    if fptr is None:
+        code = map_driver(nargs)
+        block = code_arena.allocate(code)
+        register_code(block.address, len(code),
+                      [(0, len(code), 'map_driver%d' % nargs)])
+        fptr = _map_drivers.setdefault(
+            nargs, ffi.cast('map_driver', block.address))
+    return fptr
+
+def register_code(address, size, symbols, lines=()):
+    """
+    Register the functions [(offset, size, name)] loaded at address with
+    perf and gdb, if enabled. Return the gdbjit entry, or None.
+    """
+    if perfmap.enabled:
+        perfmap.register(address, symbols, lines)
+    if gdbjit.enabled:
+        return gdbjit.register(address, size, symbols)
+    return None
+
+_fntypes = {} # tuple(argtypes) -> cffi type
+
+def function_type(argtypes):
+    """
+    Return the cffi type of a function pointer with the given argtypes,
+    cached to avoid parsing the C declaration again
+    """
+    key = tuple(argtypes)
+    fntype = _fntypes.get(key)
+    if fntype is None:
+        fntype = ffi.typeof('double(*)(%s)' % (', '.join(argtypes) or 'void'))
+        _fntypes[key] = fntype
+    return fntype
+
 class CompiledFunction:
+    """
+    argtypes is the list of the C types of the arguments: by default, they
+    are all doubles. Arguments of type 'double*' and 'const double*' accept
+    any object supporting the buffer protocol, such as array.array('d') or
+    numpy arrays, which is passed to the machine code without copying it.
+    Arguments of type 'int64_t' accept Python ints.
+
+    symbols is the list of (offset, size, name) of the functions in code,
+    which are registered with perf and gdb if enabled: see perfmap and
+    gdbjit. By default, the whole code is a function called jit30min.
+
+    links is the list of (offset, kind, arg) of the addresses which are set
+    in consts when the code is loaded, see linking.
+
+    counters is the list of the counters of the code compiled with
+    instrument=True, which are read by profile(): see profiler.
+
+    line_markers is True if the code was compiled with lines=True: its
+    line markers are replaced with NOPs when it is loaded, see perfmap.
+    """
+
+    # the minimum number of elements processed by each thread of
+    # parallel_map()
+    MIN_CHUNK_SIZE = 1024
+
+    def __init__(self, nargs, code, argtypes=None, consts=b'', relocs=(),
+                 links=(), symbols=None, counters=None, line_markers=False):
+        self.counters = counters
+        address = 0
+        if counters:
+            self._counter_values = ffi.new('int64_t[]', len(counters))
+            address = int(ffi.cast('uintptr_t', self._counter_values))
+        consts = linking.resolve(consts, links, address)
+        markers = []
+        if line_markers:
+            code, markers = perfmap.strip_line_markers(code)
+        self.block = code_arena.allocate(code, consts, relocs)
+        if argtypes is None:
+            argtypes = ['double'] * nargs
+        self.argtypes = argtypes
+        self.arrays = [i for i, argtype in enumerate(argtypes)
+                       if argtype.endswith('*')]
+        self.fptr = ffi.cast(function_type(argtypes), self.block.address)
+        self.stats = None # set by compile(), see compilestats
+        if symbols is None:
+            symbols = [(0, len(code), 'jit30min')]
+        self.symbols = symbols
+        # [(offset, size, function name, line)], see perfmap
+        self.lines = perfmap.line_table(symbols, markers)
+        self._gdb_entry = register_code(self.block.address, len(code),
+                                        symbols, self.lines)
+
+    @property
+    def size(self):
+        return 0 if self.block is None else self.block.size
 
-    def __init__(self, nargs, code):
-        self.buf = mmap.mmap(-1, len(code), mmap.MAP_PRIVATE,
-                             mmap.PROT_READ | mmap.PROT_WRITE |
-                             mmap.PROT_EXEC)
-        self.buf[:len(code)] = code
-        fntype = 'fn%d' % nargs
-        self.fptr = ffi.cast(fntype, ffi.from_buffer(self.buf))
+    def profile(self):
+        """
+        Return the values of the counters as a dict
+        {(function name, line): {counter name: value}}, see profiler
+        """
+        if self.counters is None:
+            raise ValueError('the function was not compiled with '
+                             'instrument=True')
+        if not self.counters:
+            return {}
+        return profiler.report(self.counters, self._counter_values)
+
+    def reset_profile(self):
+        if self.counters:
+            ffi.buffer(self._counter_values)[:] = bytes(8*len(self.counters))
+
+    def free(self):
+        """
+        Release the machine code: calling the function afterwards raises
+        RuntimeError.
+        """
+        if self.block is None:
+            return
+        self.fptr = self._freed
+        if self._gdb_entry is not None:
+            gdbjit.unregister(self._gdb_entry)
+            self._gdb_entry = None
+        code_arena.free(self.block)
+        self.block = None
+
+    def __del__(self):
+        # the arena might already be gone at interpreter shutdown
+        if code_arena is not None and getattr(self, 'block', None):
+            self.free()
+
+    def _freed(self, *args):
+        raise RuntimeError("the machine code of this function has been freed")
 
     def __call__(self, *args):
-        return self.fptr(*args)
+        return self.fptr(*self._convert(args))
 
+    def _convert(self, args):
+        if self.arrays:
+            args = list(args)
+            for i in self.arrays:
+                args[i] = self._from_buffer(args[i], self.argtypes[i])
+        return args
 
-class RegAllocator:
+    def map(self, *args, out=None):
+        """
+        Call the function for each element of the arguments, and store the
+        results into out, which is returned. Each argument is either a
+        buffer of doubles or a number, which is broadcast to all the
+        elements. If out is None, a new array.array('d') is allocated.
+        The loop runs in machine code, so it is much faster than calling
+        the function many times.
+        """
+        return self._map(args, out, 1)
 
-    REGISTERS = (FA.xmm0, FA.xmm1, FA.xmm2, FA.xmm3, FA.xmm4,
-                 FA.xmm5, FA.xmm6, FA.xmm7, FA.xmm8, FA.xmm9,
-                 FA.xmm10, FA.xmm11, FA.xmm12, FA.xmm13,
-                 FA.xmm14, FA.xmm15)
+    def parallel_map(self, *args, out=None, nthreads=None):
+        """
+        Like map(), but split the elements into chunks which are processed
+        by nthreads threads, by default one per core. The machine code runs
+        without holding the GIL, so the threads run in parallel.
+        """
+        return self._map(args, out, nthreads or os.cpu_count() or 1)
 
-    def __init__(self):
-        self._registers = list(reversed(self.REGISTERS))
-        self.vars = defaultdict(self._allocate) # name -> reg
+    def parallel_reduce(self, start, stop, *args, combine=operator.add,
+                        nthreads=None):
+        """
+        Split range(start, stop) into nthreads chunks, by default one per
+        core, and call the function in parallel as fn(lo, hi, *args) for
+        each chunk [lo, hi). Return the results combined with combine,
+        from the first chunk to the last:
 
-    def _allocate(self):
-        try:
-            return self._registers.pop()
-        except IndexError:
-            raise NotImplementedError("Too many variables: register spilling not implemented")
-
-    def get(self, varname):
-        return self.vars[varname]
-
-class AstCompiler:
-
-    def __init__(self, src):
-        self.tree = ast.parse(textwrap.dedent(src))
-        self.asm = None
-
-    def show(self, node):
-        import astpretty
-        from ast2png import ast2png
-        astpretty.pprint(node)
-        ast2png(self.tree, highlight_node=node, filename='ast.png')
-
-    def _newfunc(self, name, argnames):
-        self.asm = FA(name, argnames)
-        self.regs = RegAllocator()
-        for argname in argnames:
-            self.regs.get(argname)
-        self.tmp0 = self.regs.get('__scratch_register_0__')
-        self.tmp1 = self.regs.get('__scratch_register_1__')
-
-    def compile(self):
-        self.visit(self.tree)
-        assert self.asm is not None, 'No function found?'
-        code = self.asm.assemble_and_relocate()
-        return CompiledFunction(self.asm.nargs, code)
-
-    def visit(self, node):
-        methname = node.__class__.__name__
-        meth = getattr(self, methname, None)
-        if meth is None:
-            raise NotImplementedError(methname)
-        return meth(node)
-
-    def Module(self, node):
-        for child in node.body:
-            self.visit(child)
-
-    def FunctionDef(self, node):
-        assert not self.asm, 'cannot compile more than one function'
-        argnames = [arg.arg for arg in node.args.args]
-        self._newfunc(node.name, argnames)
-        for child in node.body:
-            self.visit(child)
-        # return 0 by default
-        self.asm.PXOR(self.asm.xmm0, self.asm.xmm0)
-        self.asm.RET()
-
-    def Pass(self, node):
-        pass
-
-    def Return(self, node):
-        self.visit(node.value)
-        self.asm.popsd(self.asm.xmm0)
-        self.asm.RET()
-
-    def Num(self, node):
-        self.asm.MOVSD(self.tmp0, self.asm.const(node.n))
-        self.asm.pushsd(self.tmp0)
-
-    def BinOp(self, node):
-        OPS = {
-            'ADD': self.asm.ADDSD,
-            'SUB': self.asm.SUBSD,
-            'MULT': self.asm.MULSD,
-            'DIV': self.asm.DIVSD,
-            }
-        opname = node.op.__class__.__name__.upper()
-        self.visit(node.left)
-        self.visit(node.right)
-        self.asm.popsd(self.tmp1)
-        self.asm.popsd(self.tmp0)
-        OPS[opname](self.tmp0, self.tmp1)
-        self.asm.pushsd(self.tmp0)
-
-    def Name(self, node):
-        reg = self.regs.get(node.id)
-        self.asm.pushsd(reg)
-
-    def Assign(self, node):
-        assert len(node.targets) == 1
-        varname = node.targets[0].id
-        reg = self.regs.get(varname)
-        self.visit(node.value)
-        self.asm.popsd(self.tmp0)
-        self.asm.MOVSD(reg, self.tmp0)
-
-    def If(self, node):
+            @jit.compile
+            def partial_sum(lo: int, hi: int, a):
+                tot = 0.0
+                for i in range(lo, hi):
+                    tot = tot + a[i]
+                return tot
+
+            total = partial_sum.parallel_reduce(0, len(a), a)
+
+        The chunks must be independent: e.g., they must not write to the
+        same array elements.
         """
-            IF <test> GOTO then_label
-            GOTO end_label
-        then_label:
-            <BODY>
-        end_label:
+        if self.block is None:
+            self._freed()
+        args = self._convert((start, stop) + args)[2:]
+        fptr = self.fptr
+        def run(chunk):
+            return fptr(chunk[0], chunk[1], *args)
+        chunks = split(start, stop, nthreads or os.cpu_count() or 1)
+        results = parallel_executor().map(run, chunks)
+        return functools.reduce(combine, results)
+
+    def _map(self, args, out, nthreads):
+        if any(argtype != 'double' for argtype in self.argtypes):
+            raise TypeError('map() supports only functions of doubles')
+        nargs = len(self.argtypes)
+        if len(args) != nargs:
+            raise TypeError('expected %d arguments, got %d' %
+                            (nargs, len(args)))
+        driver = get_map_driver(nargs)
+        n = None
+        inputs = []
+        strides = []
+        for arg in args:
+            if isinstance(arg, (int, float)):
+                inputs.append(ffi.new('double[1]', [arg]))
+                strides.append(0)
+                continue
+            ptr = self._from_buffer(arg, 'const double*')
+            if n is None:
+                n = len(ptr)
+            elif len(ptr) != n:
+                raise ValueError('arguments of different lengths: %d and %d'
+                                 % (n, len(ptr)))
+            inputs.append(ptr)
+            strides.append(8)
+        if out is None:
+            if n is None:
+                raise TypeError('map() needs at least one array argument')
+            out = array.array('d', bytes(8*n))
+        cout = self._from_buffer(out, 'double*')
+        if n is None:
+            n = len(cout)
+        elif len(cout) != n:
+            raise ValueError('out has length %d, expected %d' % (len(cout), n))
+        if self.block is None:
+            self._freed()
+        kernel = ffi.cast('void *', self.block.address)
+        cstrides = ffi.new('int64_t[]', strides)
+        def run(chunk):
+            lo, hi = chunk
+            # the driver advances the pointers: each chunk needs its own
+            chunk_inputs = [ptr + lo if stride else ptr
+                            for ptr, stride in zip(inputs, strides)]
+            driver(kernel, ffi.new('double *[]', chunk_inputs), cstrides,
+                   cout + lo, hi - lo)
+        # don't bother the threads for a few elements
+        nthreads = min(nthreads, n // self.MIN_CHUNK_SIZE)
+        chunks = split(0, n, nthreads)
+        if len(chunks) == 1:
+            run(chunks[0])
+        else:
+            list(parallel_executor().map(run, chunks))
+        return out
+
+    def _from_buffer(self, obj, argtype):
+        fmt = memoryview(obj).format
+        if fmt not in ('d', '<d', '=d', '@d', 'B', 'b', 'c'):
+            raise TypeError("expected a buffer of doubles, got format %r" % fmt)
+        return ffi.from_buffer('double[]', obj,
+                               require_writable=(argtype == 'double*'))
+
+
+# the compiler imports PeachPy, which is slow to import: we import it lazily,
+# so that loading functions from the disk cache does not need it
+COMPILER_NAMES = ('AstCompiler', 'RegAllocator', 'LiveRanges', 'StackSlot',
+                  'ArgSlot')
+
+def __getattr__(name):
+    if name in COMPILER_NAMES:
+        import compiler
+        return getattr(compiler, name)
+    raise AttributeError("module 'jit' has no attribute %r" % name)
+
+
+class CompileCache:
+    """
+    In-process cache of the compiled functions, keyed on the source and the
+    compilation options: compiling the same source twice returns the same
+    CompiledFunction.
+
+    When there are more than max_entries functions, or their code takes more
+    than max_bytes, the least recently used ones are evicted. The cache only
+    drops its reference: eviction releases the code only once no caller
+    holds the CompiledFunction, so the functions already returned keep
+    working.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=16*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key -> CompiledFunction
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def key(self, src, options):
+        return (src, tuple(sorted(options.items())))
+
+    def get(self, key):
+        with self.lock:
+            fn = self.entries.get(key)
+            if fn is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return fn
+
+    def put(self, key, fn):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.size
+            self.entries[key] = fn
+            self.nbytes += fn.size
+            # never evict the function we just inserted
+            while (len(self.entries) > 1 and
+                   (len(self.entries) > self.max_entries or
+                    self.nbytes > self.max_bytes)):
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return dict(entries=len(self.entries), bytes=self.nbytes,
+                    hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
+
+# set it to None to disable the in-process cache
+compile_cache = CompileCache()
+
+disk_cache = None
+
+def set_disk_cache(path, max_size=64*1024*1024):
+    """
+    Store the compiled code in the given directory, and reuse it across
+    processes. If path is None, disable the disk cache.
+    """
+    global disk_cache
+    if path is None:
+        disk_cache = None
+    else:
+        disk_cache = DiskCache(path, max_size)
+
+if os.environ.get('JIT30MIN_CACHE_DIR'):
+    set_disk_cache(os.environ['JIT30MIN_CACHE_DIR'])
+
+if os.environ.get('JIT30MIN_PERF_MAP'):
+    perfmap.enable(lines=os.environ['JIT30MIN_PERF_MAP'] == 'lines')
+
+if os.environ.get('JIT30MIN_GDB_JIT'):
+    gdbjit.enable()
+
+
+def compile(fn=None, optimize=True, vectorize=True, instrument=False,
+            encoder=None):
+    """
+    Compile fn to machine code. Can be used as a plain decorator, or called
+    with keyword arguments to change the compilation options:
+
+        @jit.compile(optimize=False)
+        def foo(...):
             ...
+
+    The Python functions called by fn are compiled together with it: they
+    must be already defined when fn is compiled.
+
+    The floating point operations give the same results as in Python,
+    except that with vectorize=True the vectorized reductions add the
+    elements in a different order, so they might differ in the last bits:
+    use vectorize=False to get the exact results.
+
+    With instrument=True, the code counts the iterations and the cycles of
+    the loops and the branches taken, see CompiledFunction.profile().
+
+    encoder='direct' encodes the machine code with the built-in encoder
+    instead of PeachPy, which is much faster: see encoder.py. The default
+    is given by the environment variable JIT30MIN_ENCODER, else it is
+    PeachPy if it is installed.
+    """
+    options = _options(optimize, vectorize, instrument, encoder)
+    if fn is None:
+        return lambda fn: compile(fn, **options)
+    return compile_source(getsource(fn), **options)
+
+def _options(optimize, vectorize, instrument, encoder=None):
+    options = dict(optimize=optimize, vectorize=vectorize)
+    # not part of the keys of the caches unless needed
+    if instrument:
+        options['instrument'] = True
+    if encoder:
+        options['encoder'] = encoder
+    return options
+
+def lookup(fn, name):
+    """
+    Return the object which name refers to inside fn: a variable of the
+    enclosing functions, or a global
+    """
+    code = fn.__code__
+    if name in code.co_freevars:
+        cell = fn.__closure__[code.co_freevars.index(name)]
+        try:
+            return cell.cell_contents
+        except ValueError: # not assigned yet
+            return None
+    return fn.__globals__.get(name)
+
+def getsource(fn):
+    """
+    Return the source of fn, followed by the source of the Python functions
+    it calls, directly or indirectly, so that they are compiled together
+    """
+    sources = OrderedDict()
+    todo = [fn]
+    while todo:
+        fn = todo.pop(0)
+        if fn.__name__ in sources:
+            continue
+        src = textwrap.dedent(inspect.getsource(fn))
+        sources[fn.__name__] = src
+        for node in ast.walk(ast.parse(src)):
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+                obj = lookup(fn, node.func.id)
+                if isinstance(obj, TieredFunction):
+                    obj = obj.fn
+                if inspect.isfunction(obj):
+                    todo.append(obj)
+    return '\n'.join(sources.values())
+
+def compile_source(src, **options):
+    """
+    Compile the first function of src, or the one named by the entry
+    option, together with the functions it calls
+    """
+    options = _line_option(options)
+    memo = compile_cache
+    if memo is not None:
+        memo_key = memo.key(src, options)
+        fn = memo.get(memo_key)
+        if fn is not None:
+            return fn
+    fn = _compile_source(src, options)
+    if memo is not None:
+        memo.put(memo_key, fn)
+    return fn
+
+def _line_option(options):
+    # the line markers change the code, so lines is a compilation option,
+    # which is part of the keys of the caches
+    if perfmap.lines_enabled and 'lines' not in options:
+        return dict(options, lines=True)
+    return options
+
+def _compile_source(src, options):
+    fn = _load_from_disk(src, options)
+    if fn is None:
+        entry, stats = _compile_entry(src, options)
+        fn = _load_entry(src, options, entry, stats)
+    return fn
+
+def _load_from_disk(src, options):
+    cache = disk_cache
+    if cache is not None:
+        entry = cache.get(cache.key(src, options))
+        if entry is not None:
+            stats = CompileStats(entry_name(src, options), cached=True)
+            stats.code_size = len(entry[1])
+            stats.consts_size = len(entry[3])
+            return _load(entry, stats)
+    return None
+
+def _load_entry(src, options, entry, stats):
+    cache = disk_cache
+    if cache is not None:
+        cache.put(cache.key(src, options), *entry)
+    return _load(entry, stats)
+
+def _load(entry, stats):
+    with stats.phase('load'):
+        fn = CompiledFunction(*entry)
+    fn.stats = stats
+    compilestats.record(stats)
+    return fn
+
+def _compile_entry(src, options):
+    """
+    Compile src and return (entry, stats), where entry is (nargs, code,
+    argtypes, consts, relocs, links, symbols, counters, line_markers), i.e.
+    the arguments of CompiledFunction: they are plain data, which can be
+    stored in the disk cache or sent back from another process together
+    with the CompileStats
+    """
+    from compiler import AstCompiler
+    comp = AstCompiler(src, **options)
+    code, consts, relocs, links = comp.assemble()
+    entry = (comp.asm.nargs, code, comp.asm.argtypes, consts, relocs, links,
+             comp.symbols, comp.counters if comp.instrument else None,
+             bool(comp.lines))
+    return entry, comp.stats
+
+def entry_name(src, options):
+    """
+    The name of the function compiled from src, without parsing it
+    """
+    if options.get('entry'):
+        return options['entry']
+    match = re.search(r'^\s*def\s+(\w+)', src, re.MULTILINE)
+    return match.group(1) if match else None
+
+def compile_stats():
+    """
+    Return the totals of the statistics of all the compilations: see
+    compilestats for the statistics of each CompiledFunction
+    """
+    return compilestats.totals.as_dict()
+
+
+class CompileError(Exception):
+    """
+    Raised by compile_many() when some functions fail to compile: errors is
+    the list of (fn, exception), in the same order as the functions
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        lines = ['%d function(s) failed to compile:' % len(errors)]
+        for fn, e in errors:
+            name = fn if isinstance(fn, str) else fn.__name__
+            lines.append('  %s: %s: %s' % (name.strip().splitlines()[0],
+                                           type(e).__name__, e))
+        Exception.__init__(self, '\n'.join(lines))
+
+def compile_many(fns, optimize=True, vectorize=True, instrument=False,
+                 encoder=None, processes=None):
+    """
+    Compile many functions at once, distributing the work to a pool of
+    processes, by default one per core, and return the list of the
+    CompiledFunctions in the same order. Each item of fns is either a
+    Python function, as for compile(), or a source, as for compile_source().
+
+    The functions found in the caches are not compiled again. If some
+    functions fail to compile, the others are compiled anyway, then
+    CompileError reports all the failures.
+    """
+    options = _line_option(_options(optimize, vectorize, instrument,
+                                    encoder))
+    fns = list(fns)
+    srcs = [fn if isinstance(fn, str) else getsource(fn) for fn in fns]
+    memo = compile_cache
+    loaded = {} # src -> CompiledFunction
+    todo = []
+    for src in srcs:
+        if src in loaded or src in todo:
+            continue
+        fn = None
+        if memo is not None:
+            fn = memo.get(memo.key(src, options))
+        if fn is None:
+            fn = _load_from_disk(src, options)
+            if fn is not None and memo is not None:
+                memo.put(memo.key(src, options), fn)
+        if fn is None:
+            todo.append(src)
+        else:
+            loaded[src] = fn
+    processes = min(processes or os.cpu_count() or 1, len(todo))
+    if processes > 1:
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            futures = [pool.submit(_compile_entry, src, options)
+                       for src in todo]
+            outcomes = [_outcome(future.result) for future in futures]
+    else:
+        outcomes = [_outcome(_compile_entry, src, options) for src in todo]
+    failed = {} # src -> exception
+    for src, outcome in zip(todo, outcomes):
+        if isinstance(outcome, Exception):
+            failed[src] = outcome
+            continue
+        fn = loaded[src] = _load_entry(src, options, *outcome)
+        if memo is not None:
+            memo.put(memo.key(src, options), fn)
+    if failed:
+        raise CompileError([(fn, failed[src]) for fn, src in zip(fns, srcs)
+                            if src in failed])
+    return [loaded[src] for src in srcs]
+
+def _outcome(f, *args):
+    try:
+        return f(*args)
+    except Exception as e:
+        return e
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def background_executor():
+    """
+    The thread which compiles the hot TieredFunctions
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='jit30min')
+        return _executor
+
+
+_parallel_executor = None
+
+def parallel_executor():
+    """
+    The threads which run the chunks of parallel_map() and
+    parallel_reduce()
+    """
+    global _parallel_executor
+    with _executor_lock:
+        if _parallel_executor is None:
+            _parallel_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                thread_name_prefix='jit30min-parallel')
+        return _parallel_executor
+
+def split(start, stop, nchunks):
+    """
+    Split range(start, stop) into at most nchunks [(lo, hi)] of almost the
+    same size. There is always at least one chunk, possibly empty.
+    """
+    n = max(stop - start, 0)
+    nchunks = max(1, min(nchunks, n))
+    return [(start + n*k // nchunks, start + n*(k+1) // nchunks)
+            for k in range(nchunks)]
+
+
+def inner_code(code, name):
+    """
+    Return the code of the function name defined by code
+    """
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType) and const.co_name == name:
+            return const
+    raise ValueError('no function named %s' % name)
+
+def make_cell(value):
+    return (lambda: value).__closure__[0]
+
+
+class TieredFunction:
+    """
+    Run fn in the interpreter, counting the calls and the loop iterations:
+    when they reach threshold, fn is compiled in a background thread, and
+    the subsequent calls use the CompiledFunction.
+
+    Note that the interpreter computes with Python numbers, so it might
+    return an int where the compiled code returns a float.
+    """
+
+    def __init__(self, fn, threshold, options):
+        self.fn = fn
+        self.threshold = threshold
+        self.options = options
+        self.src = textwrap.dedent(inspect.getsource(fn))
+        self.signature = inspect.signature(fn)
+        self.nargs = len(self.signature.parameters)
+        self.counter = 0
+        self.compiled = None
+        self.future = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.interp = self._instrument()
+        functools.update_wrapper(self, fn)
+
+    def _instrument(self):
         """
-        CMP = {
-            'LT': self.asm.JB
-            }
-        assert not node.orelse
-        then_label = self.asm.Label()
-        end_label = self.asm.Label()
-        op = self.visit(node.test)
-        CMP[op](then_label)
-        self.asm.JMP(end_label)
-        self.asm.LABEL(then_label)
-        for child in node.body:
-            self.visit(child)
-        self.asm.LABEL(end_label)
-
-    def Compare(self, node):
-        assert len(node.ops) == 1
-        cmp_op = node.ops[0].__class__.__name__.upper()
-        self.visit(node.left)
-        self.visit(node.comparators[0])
-        self.asm.popsd(self.tmp1)
-        self.asm.popsd(self.tmp0)
-        self.asm.UCOMISD(self.tmp0, self.tmp1)
-        return cmp_op
-
-    def While(self, node):
+        Return a copy of fn which calls self.tick() at each loop iteration,
+        with the same globals and closure as fn
         """
-        begin_label:
-            IF <test> GOTO body_label
-            GOTO end_label
-        body_label:
-            <BODY>
-            GOTO begin_label
-        end_label:
-            ...
+        tree = ast.parse(self.src)
+        funcdef = tree.body[0]
+        funcdef.decorator_list = []
+        for node in ast.walk(funcdef):
+            if isinstance(node, (ast.While, ast.For)):
+                tick = ast.Expr(value=ast.Call(
+                    func=ast.Name(id='__jit_tick__', ctx=ast.Load()),
+                    args=[], keywords=[]))
+                node.body.insert(0, tick)
+        # nest it into a function whose arguments are the free variables of
+        # fn and __jit_tick__, so that they are free variables of the copy
+        freevars = self.fn.__code__.co_freevars + ('__jit_tick__',)
+        wrapper = ast.parse('def __jit_wrapper__(%s): pass' %
+                            ', '.join(freevars)).body[0]
+        wrapper.body = [funcdef]
+        tree.body = [wrapper]
+        ast.fix_missing_locations(tree)
+        ast.increment_lineno(tree, self.fn.__code__.co_firstlineno - 1)
+        code = builtins.compile(tree, self.fn.__code__.co_filename, 'exec')
+        code = inner_code(inner_code(code, wrapper.name), funcdef.name)
+        cells = dict(zip(self.fn.__code__.co_freevars,
+                         self.fn.__closure__ or ()))
+        cells['__jit_tick__'] = make_cell(self.tick)
+        interp = types.FunctionType(code, self.fn.__globals__, funcdef.name,
+                                    self.fn.__defaults__,
+                                    tuple(cells[name]
+                                          for name in code.co_freevars))
+        interp.__kwdefaults__ = self.fn.__kwdefaults__
+        return interp
+
+    def __call__(self, *args, **kwargs):
+        compiled = self.compiled
+        if compiled is not None:
+            if kwargs or len(args) != self.nargs:
+                # the compiled code takes only positional arguments
+                bound = self.signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                args = bound.args
+            return compiled(*args)
+        self.tick()
+        return self.interp(*args, **kwargs)
+
+    def tick(self):
+        self.counter += 1
+        if self.counter >= self.threshold and self.future is None:
+            self._start_compile()
+
+    def _start_compile(self):
+        with self.lock:
+            if self.future is None:
+                self.future = background_executor().submit(self._compile)
+
+    def _compile(self):
+        try:
+            # the functions called by fn might be defined after it
+            self.compiled = compile_source(getsource(self.fn), **self.options)
+        except Exception as e:
+            # keep running in the interpreter
+            self.error = e
+            warnings.warn('cannot compile %s: %s: %s' % (
+                self.fn.__name__, e.__class__.__name__, e), RuntimeWarning)
+
+    def wait(self, timeout=None):
+        """
+        Wait until the background compilation finishes, and return the
+        CompiledFunction, or None if fn is not hot yet or cannot be compiled
         """
-        CMP = {
-            'LT': self.asm.JB
-            }
-        begin_label = self.asm.Label()
-        body_label = self.asm.Label()
-        end_label = self.asm.Label()
-        #
-        self.asm.LABEL(begin_label)
-        op = self.visit(node.test)
-        CMP[op](body_label)
-        self.asm.JMP(end_label)
-        self.asm.LABEL(body_label)
-        for child in node.body:
-            self.visit(child)
-        self.asm.JMP(begin_label)
-        self.asm.LABEL(end_label)
-
-
-def compile(fn):
-    src = inspect.getsource(fn)
-    comp = AstCompiler(src)
-    return comp.compile()
+        if self.future is not None:
+            self.future.result(timeout)
+        return self.compiled
+
+
+def tiered(fn=None, threshold=1000, optimize=True, vectorize=True):
+    """
+    Like compile(), but compile fn only after it has been called threshold
+    times or its loops have run threshold iterations:
+
+        @jit.tiered(threshold=100)
+        def foo(...):
+            ...
+    """
+    options = dict(optimize=optimize, vectorize=vectorize)
+    if fn is None:
+        return lambda fn: tiered(fn, threshold, **options)
+    return TieredFunction(fn, threshold, options)
@@ -0,0 +1,31 @@
+"""
+The functions of libm which can be called by the compiled code, either as
+math.f(...) or as f(...): they take and return doubles, and like in C they
+return NaN or inf instead of raising ValueError or OverflowError.
+
+The compiled code calls them through a constant containing their address,
+which changes from process to process: it is set when the code is loaded,
+see linking.
+"""
+from cffi import FFI
+
+# name -> number of arguments
+FUNCTIONS = {
+    'exp': 1, 'expm1': 1, 'log': 1, 'log1p': 1, 'log2': 1, 'log10': 1,
+    'sin': 1, 'cos': 1, 'tan': 1, 'asin': 1, 'acos': 1, 'atan': 1,
+    'sinh': 1, 'cosh': 1, 'tanh': 1, 'asinh': 1, 'acosh': 1, 'atanh': 1,
+    'cbrt': 1, 'erf': 1, 'erfc': 1,
+    'atan2': 2, 'pow': 2, 'hypot': 2, 'fmod': 2, 'copysign': 2,
+    }
+NAMES = sorted(FUNCTIONS)
+
+ffi = FFI()
+ffi.cdef('\n'.join('double %s(%s);' % (name, ', '.join(['double'] * nargs))
+                   for name, nargs in sorted(FUNCTIONS.items())))
+_lib = None
+
+def address(name):
+    global _lib
+    if _lib is None:
+        _lib = ffi.dlopen('m')
+    return int(ffi.cast('uintptr_t', getattr(_lib, name)))
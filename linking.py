@@ -0,0 +1,60 @@
+"""
+The addresses used by the compiled code which are known only when the code
+is linked or loaded: the other functions of the module, the functions of
+libm and the buffer of the counters of instrument=True.
+
+The code loads each of them from an 8-byte constant, with CALL [rip+const]
+or MOV reg, [rip+const]. The assembler fills the constant with
+placeholder(kind, arg), and FunctionAssembler.assemble() returns the
+(offset, kind, arg) links of the instructions which use it:
+
+    - 'call', the index of the callee in the module: offset is the 32-bit
+      field of the CALL, which assembler.link() turns into a direct call
+
+    - 'libm', the index of the function in libm.NAMES, and 'counters', 0:
+      offset is the position of the constant in consts, which resolve()
+      sets to the address when the code is loaded. This way, the disk cache
+      stores code which can be loaded by any process.
+
+The placeholders are the only constants in the range MARKER..MARKER+2**24,
+which are NaNs with a payload: the float constants of the compiled code are
+the literals of the source and the results of constant folding, which
+produces only the default NaN 0x7ff8000000000000.
+"""
+import struct
+import libm
+
+MARKER = 0x7ff4a11c00000000
+KINDS = ('call', 'libm', 'counters')
+
+
+def placeholder(kind, arg=0):
+    assert 0 <= arg < 0x10000
+    return MARKER | KINDS.index(kind) << 16 | arg
+
+def decode(value):
+    """
+    Return (kind, arg) if value is a placeholder, else None
+    """
+    index = (value - MARKER) >> 16
+    if 0 <= index < len(KINDS):
+        return KINDS[index], value & 0xffff
+    return None
+
+def resolve(consts, links, counters=0):
+    """
+    Return a copy of consts where the constants of the links are set to the
+    addresses, where counters is the address of the buffer of the counters
+    """
+    if not links:
+        return consts
+    consts = bytearray(consts)
+    for offset, kind, arg in links:
+        if kind == 'libm':
+            address = libm.address(libm.NAMES[arg])
+        elif kind == 'counters':
+            address = counters
+        else:
+            raise ValueError('unresolved link: %s %d' % (kind, arg))
+        struct.pack_into('<Q', consts, offset, address)
+    return bytes(consts)
@@ -0,0 +1,145 @@
+"""
+Lowering of the constructs which the compiler implements in terms of
+simpler ones.
+
+    for i in range(start, stop, step):
+        <body>
+
+becomes a RangeLoop, i.e. a while loop whose last statement is the
+increment, so that continue can jump to it:
+
+    stop' = int(stop)
+    i = start
+    while i < stop':        # i > stop' if step is negative
+        <body>
+        i = i + step
+
+The bounds are evaluated only once, and converted to int by truncation if
+they are floats; the step must be a nonzero int constant. If i is read
+outside the loop, or assigned inside it, Python semantics requires i to
+hold the last value of the range after the loop and to ignore the
+assignments: in that case we use a hidden counter and assign i = next at
+the beginning of each iteration.
+"""
+import ast
+
+
+class RangeLoop(ast.While):
+    """
+    A while loop lowered from a for loop: the last statement of the body is
+    the increment of the counter
+    """
+
+
+def lower(tree):
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            ForLowering(node).visit(node)
+    return ast.fix_missing_locations(tree)
+
+
+def is_int_const(node):
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return is_int_const(node.operand)
+    return isinstance(node, ast.Num) and type(node.n) is int
+
+def const_value(node):
+    if isinstance(node, ast.UnaryOp):
+        return -const_value(node.operand)
+    return node.n
+
+def name(varname, store=False):
+    return ast.Name(id=varname, ctx=ast.Store() if store else ast.Load())
+
+def assign(varname, value):
+    return ast.Assign(targets=[name(varname, store=True)], value=value)
+
+
+class ForLowering(ast.NodeTransformer):
+
+    def __init__(self, funcdef):
+        self.funcdef = funcdef
+        self.count = 0
+        # decide on the original tree, before lowering it
+        self.counters = set(id(node) for node in ast.walk(funcdef)
+                            if isinstance(node, ast.For) and
+                            isinstance(node.target, ast.Name) and
+                            self.needs_counter(node))
+
+    def visit_For(self, node):
+        self.generic_visit(node)
+        if node.orelse:
+            raise NotImplementedError('for/else')
+        if not isinstance(node.target, ast.Name):
+            raise NotImplementedError('for loops need a single variable')
+        call = node.iter
+        if not (isinstance(call, ast.Call) and
+                isinstance(call.func, ast.Name) and call.func.id == 'range' and
+                1 <= len(call.args) <= 3 and not call.keywords):
+            raise NotImplementedError('for loops are supported only on range()')
+        args = list(call.args)
+        if len(args) == 1:
+            args.insert(0, ast.Num(n=0))
+        if len(args) == 2:
+            args.append(ast.Num(n=1))
+        start, stop, step = args
+        if not is_int_const(step) or const_value(step) == 0:
+            raise NotImplementedError('the step of range() must be a nonzero '
+                                      'int constant')
+        step = const_value(step)
+        #
+        self.count += 1
+        prefix = 'for%d.' % self.count # not a valid Python identifier
+        varname = node.target.id
+        stmts = []
+        if is_int_const(start):
+            start = ast.Num(n=const_value(start))
+        else:
+            start = to_int(start)
+        if is_int_const(stop):
+            stop = ast.Num(n=const_value(stop))
+        else:
+            stmts.append(assign(prefix + 'stop', to_int(stop)))
+            stop = name(prefix + 'stop')
+        body = node.body
+        if id(node) in self.counters:
+            counter = prefix + 'next'
+            body = [assign(varname, name(counter))] + body
+        else:
+            counter = varname
+        # stop might read the loop variable: assign the counter afterwards
+        stmts.append(assign(counter, start))
+        op = ast.Lt() if step > 0 else ast.Gt()
+        test = ast.Compare(left=name(counter), ops=[op], comparators=[stop])
+        increment = assign(counter, ast.BinOp(left=name(counter), op=ast.Add(),
+                                              right=ast.Num(n=step)))
+        loop = RangeLoop(test=test, body=body + [increment], orelse=[])
+        stmts.append(loop)
+        return [ast.copy_location(stmt, node) for stmt in stmts]
+
+    def needs_counter(self, loop):
+        """
+        We can use the loop variable as the counter only if it's not assigned
+        in the body and its value after the loop is never read, i.e. it is
+        used only inside for loops over it.
+        """
+        varname = loop.target.id
+        for stmt in loop.body:
+            for node in ast.walk(stmt):
+                if (isinstance(node, ast.Name) and node.id == varname and
+                    isinstance(node.ctx, ast.Store)):
+                    return True
+        inside = set()
+        for node in ast.walk(self.funcdef):
+            if (isinstance(node, ast.For) and
+                isinstance(node.target, ast.Name) and
+                node.target.id == varname):
+                inside.update(id(child) for child in ast.walk(node))
+        return any(isinstance(node, ast.Name) and node.id == varname and
+                   id(node) not in inside
+                   for node in ast.walk(self.funcdef))
+
+
+def to_int(node):
+    return ast.Call(func=ast.Name(id='int', ctx=ast.Load()), args=[node],
+                    keywords=[])
@@ -0,0 +1,79 @@
+"""
+The machine code of the loop which calls a compiled function for each
+element of its input arrays, used by CompiledFunction.map:
+
+    void driver(void *kernel, double **inputs, int64_t *strides,
+                double *out, int64_t n)
+
+For each element, it loads the k-th argument from *inputs[k] into xmmk,
+or into the outgoing stack area for the arguments after the eighth,
+advances inputs[k] by strides[k] bytes, calls kernel and stores xmm0 into
+out. Scalar arguments are broadcast by using a stride of 0.
+
+The driver does not depend on the compiled function, so we write it
+directly in machine code: this way map() works also for functions loaded
+from the disk cache, without importing PeachPy. The state of the loop is
+kept in callee-saved registers, which the kernel does not touch.
+"""
+import struct
+
+NARGREGS = 8 # xmm0-xmm7
+
+def disp32(n):
+    return struct.pack('<i', n)
+
+def map_driver(nargs):
+    # the arguments which don't fit in registers are passed on the stack
+    stack_size = 8 * max(nargs - NARGREGS, 0)
+    stack_size += stack_size % 16
+    prologue = [
+        b'\x53',                # push rbx
+        b'\x41\x54',            # push r12
+        b'\x41\x55',            # push r13
+        b'\x41\x56',            # push r14
+        b'\x41\x57',            # push r15: now rsp is 16-byte aligned
+        b'\x48\x89\xfb',        # mov rbx, rdi     kernel
+        b'\x49\x89\xf4',        # mov r12, rsi     inputs
+        b'\x49\x89\xd5',        # mov r13, rdx     strides
+        b'\x49\x89\xce',        # mov r14, rcx     out
+        b'\x4d\x89\xc7',        # mov r15, r8      n
+        b'\x48\x81\xec' + disp32(stack_size), # sub rsp, stack_size
+        b'\x4d\x85\xff',        # test r15, r15
+        ]
+    loop = []
+    for k in range(nargs):
+        disp = disp32(8*k)
+        loop.append(b'\x49\x8b\x84\x24' + disp)     # mov rax, [r12 + 8k]
+        if k < NARGREGS:
+            loop.append(b'\xf2\x0f\x10' + bytes([k << 3])) # movsd xmmk, [rax]
+        else:
+            loop += [
+                b'\x48\x8b\x08',                    # mov rcx, [rax]
+                # mov [rsp + 8(k-8)], rcx
+                b'\x48\x89\x8c\x24' + disp32(8*(k - NARGREGS)),
+                ]
+        loop += [
+            b'\x49\x03\x85' + disp,         # add rax, [r13 + 8k]
+            b'\x49\x89\x84\x24' + disp,     # mov [r12 + 8k], rax
+            ]
+    loop += [
+        b'\xff\xd3',            # call rbx
+        b'\xf2\x41\x0f\x11\x06', # movsd [r14], xmm0
+        b'\x49\x83\xc6\x08',    # add r14, 8
+        b'\x49\xff\xcf',        # dec r15
+        ]
+    epilogue = [
+        b'\x48\x81\xc4' + disp32(stack_size), # add rsp, stack_size
+        b'\x41\x5f',            # pop r15
+        b'\x41\x5e',            # pop r14
+        b'\x41\x5d',            # pop r13
+        b'\x41\x5c',            # pop r12
+        b'\x5b',                # pop rbx
+        b'\xc3',                # ret
+        ]
+    loop = b''.join(loop)
+    jnz_size = 6
+    # jz done; loop: ...; jnz loop; done:
+    jz = b'\x0f\x84' + disp32(len(loop) + jnz_size)
+    jnz = b'\x0f\x85' + disp32(-(len(loop) + jnz_size))
+    return b''.join(prologue) + jz + loop + jnz + b''.join(epilogue)
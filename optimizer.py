@@ -0,0 +1,151 @@
+"""
+AST-level optimizations, run on the tree before code generation.
+
+All the transformations of this module are IEEE-safe: they compute exactly
+the same values as the original, including the sign of zeros and the
+propagation of NaNs. E.g., x*1 is simplified to x, but x+0 is not, because
+-0.0 + 0 == +0.0. The vectorizer, which is enabled separately, is not: it
+reassociates the sums of the reductions, see vectorizer.py.
+"""
+import ast
+import math
+import operator
+
+BINOPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    }
+
+def optimize(tree):
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            optimize_function(node)
+    return ast.fix_missing_locations(tree)
+
+def optimize_function(funcdef):
+    folder = ConstantFolder()
+    funcdef.body = folder.visit_block(funcdef.body)
+    while propagate_constants(funcdef):
+        funcdef.body = folder.visit_block(funcdef.body)
+
+
+def is_const(node):
+    # on Python 3.8+, isinstance(Constant(True), ast.Num) is False, but
+    # isinstance(Constant(1.0), ast.Num) is True
+    return isinstance(node, ast.Num)
+
+def make_const(value, orig):
+    return ast.copy_location(ast.Num(n=value), orig)
+
+def is_power_of_two(value):
+    mantissa, exp = math.frexp(value)
+    return abs(mantissa) == 0.5
+
+
+class ConstantFolder(ast.NodeTransformer):
+    """
+    Fold constant subexpressions and apply algebraic identities
+    """
+
+    def visit_block(self, stmts):
+        return [self.visit(stmt) for stmt in stmts]
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if is_const(node.operand):
+            if isinstance(node.op, ast.USub):
+                return make_const(-node.operand.n, node)
+            if isinstance(node.op, ast.UAdd):
+                return make_const(+node.operand.n, node)
+        return node
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        left, right = node.left, node.right
+        fn = BINOPS.get(type(node.op))
+        if fn is None:
+            return node
+        if is_const(left) and is_const(right):
+            try:
+                return make_const(fn(left.n, right.n), node)
+            except ZeroDivisionError:
+                return node
+        if is_const(right):
+            return self.simplify_right(node, right.n)
+        if is_const(left):
+            return self.simplify_left(node, left.n)
+        return node
+
+    def simplify_right(self, node, value):
+        op = type(node.op)
+        # only int constants are dropped: x*1.0 is a float even if x is an
+        # int
+        if type(value) is int:
+            if (op in (ast.Mult, ast.Div) and value == 1 or
+                op is ast.Sub and value == 0):
+                return node.left
+        if op is ast.Div and value != 0 and is_power_of_two(value):
+            # multiplying by the reciprocal is exact for powers of two, as
+            # long as the reciprocal is a normal number
+            recip = 1.0 / value
+            if is_power_of_two(recip) and abs(recip) >= 2.0**-1022:
+                node.op = ast.Mult()
+                node.right = make_const(recip, node.right)
+        return node
+
+    def simplify_left(self, node, value):
+        if type(node.op) is ast.Mult and type(value) is int and value == 1:
+            return node.right
+        return node
+
+
+class Substitute(ast.NodeTransformer):
+
+    def __init__(self, consts):
+        self.consts = consts
+
+    def visit_Name(self, node):
+        if node.id in self.consts and isinstance(node.ctx, ast.Load):
+            return make_const(self.consts[node.id], node)
+        return node
+
+
+def propagate_constants(funcdef):
+    """
+    Replace the variables which are assigned exactly once, to a constant, by
+    the constant itself. We consider only the assignments at the top level
+    of the function, which are executed unconditionally, and only if the
+    variable is never read before. Return True if something changed.
+    """
+    argnames = set(arg.arg for arg in funcdef.args.args)
+    assignments = {}
+    for node in ast.walk(funcdef):
+        if isinstance(node, ast.Assign):
+            targets = node.targets
+        elif isinstance(node, ast.For):
+            targets = [node.target]
+        else:
+            continue
+        for target in targets:
+            if isinstance(target, ast.Name):
+                assignments[target.id] = assignments.get(target.id, 0) + 1
+    #
+    consts = {}
+    seen = set()
+    body = []
+    for stmt in funcdef.body:
+        if (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and
+            isinstance(stmt.targets[0], ast.Name) and is_const(stmt.value)):
+            varname = stmt.targets[0].id
+            if (assignments[varname] == 1 and varname not in argnames and
+                varname not in seen):
+                consts[varname] = stmt.value.n
+                continue
+        for node in ast.walk(stmt):
+            if isinstance(node, ast.Name):
+                seen.add(node.id)
+        body.append(Substitute(consts).visit(stmt))
+    funcdef.body = body or [ast.Pass()]
+    return bool(consts)
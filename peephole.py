@@ -0,0 +1,123 @@
+"""
+Peephole optimizations of the instructions of a FunctionAssembler, which
+buffers them as (name, args) and runs optimize() before encoding them:
+
+    - pushsd X; popsd Y becomes MOVSD Y, X, or nothing if X is Y, and the
+      same for push and pop
+
+    - moves of a register to itself are removed
+
+    - jumps to a label followed by JMP go directly to the target of the JMP
+
+    - jumps to the next instruction are removed
+
+    - the code after JMP or RET is removed, up to the next label or ALIGN
+      (which is always followed by a label)
+
+pushsd, popsd, push and pop are pseudo-instructions, which the
+FunctionAssembler expands after the optimization. The registers and the
+labels are compared by identity, since encoder.py creates each register
+once and each Label is a distinct object.
+"""
+
+MOVES = ('MOV', 'MOVSD', 'MOVAPD')
+# push, pop -> the equivalent move
+PUSH_POP = {
+    ('pushsd', 'popsd'): 'MOVSD',
+    ('push', 'pop'): 'MOV',
+    }
+UNCONDITIONAL = ('JMP', 'RET')
+# the instructions which define a position in the code
+MARKS = ('LABEL', 'ALIGN')
+
+
+def is_jump(name):
+    return name.startswith('J')
+
+def fuse_moves(instructions):
+    """
+    Turn each push immediately followed by a pop into a move, and remove
+    the moves of a register to itself
+    """
+    result = []
+    for name, args in instructions:
+        if result:
+            prev_name, prev_args = result[-1]
+            move = PUSH_POP.get((prev_name, name))
+            if move is not None:
+                result.pop()
+                name, args = move, (args[0], prev_args[0])
+        if name in MOVES and args[0] is args[1]:
+            continue
+        result.append((name, args))
+    return result
+
+def next_labels(instructions, i):
+    """
+    Return the labels defined right before the i-th instruction which is
+    not a LABEL or ALIGN, and its index
+    """
+    labels = []
+    while i < len(instructions) and instructions[i][0] in MARKS:
+        name, args = instructions[i]
+        if name == 'LABEL':
+            labels.append(args[0])
+        i += 1
+    return labels, i
+
+def thread_jumps(instructions):
+    """
+    Make the jumps to a label followed by JMP go to the final target
+    """
+    forward = {} # id(label) -> the target of the JMP which follows it
+    for i, (name, args) in enumerate(instructions):
+        if name == 'LABEL':
+            labels, j = next_labels(instructions, i)
+            if j < len(instructions) and instructions[j][0] == 'JMP':
+                forward[id(args[0])] = instructions[j][1][0]
+    if not forward:
+        return instructions
+    result = []
+    for name, args in instructions:
+        if is_jump(name) and id(args[0]) in forward:
+            target = args[0]
+            seen = set()
+            # stop at the loops of jumps, which never end anyway
+            while id(target) in forward and id(target) not in seen:
+                seen.add(id(target))
+                target = forward[id(target)]
+            args = (target,) + args[1:]
+        result.append((name, args))
+    return result
+
+def remove_dead_code(instructions):
+    """
+    Remove the code after JMP or RET up to the next label, and the jumps
+    to the next instruction
+    """
+    result = []
+    dead = False
+    for i, (name, args) in enumerate(instructions):
+        if name in MARKS:
+            dead = False
+        elif dead:
+            continue
+        elif is_jump(name):
+            labels, _ = next_labels(instructions, i + 1)
+            if any(label is args[0] for label in labels):
+                continue
+        result.append((name, args))
+        if name in UNCONDITIONAL:
+            dead = True
+    return result
+
+def optimize(instructions):
+    """
+    Return the optimized list of (name, args)
+    """
+    instructions = thread_jumps(fuse_moves(instructions))
+    while True:
+        n = len(instructions)
+        instructions = remove_dead_code(instructions)
+        if len(instructions) == n:
+            return instructions
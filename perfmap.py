@@ -0,0 +1,134 @@
+"""
+Support for Linux perf: the compiled functions are written to
+/tmp/perf-<pid>.map, so that perf report shows their names instead of
+[unknown] addresses. Enable it with enable(), or by setting the environment
+variable JIT30MIN_PERF_MAP=1.
+
+With enable(lines=True), or JIT30MIN_PERF_MAP=lines, the code is compiled
+with a marker at the beginning of each statement, and each range of
+addresses is reported as jit30min:<function>:+<line>, where <line> is
+counted from the def of the function. The marker is
+
+    MOV rax, LINE_MARKER + line
+
+which is turned into a NOP of the same length when the code is loaded, so
+the addresses don't change. rax is a scratch register which is never live
+across statements.
+"""
+import os
+import threading
+
+# the marker is the 64-bit immediate of MOV rax, in the instruction stream:
+# strip_line_markers() looks for its upper 4 bytes preceded by 48 B8 and 4
+# bytes of line number. Any other 10 bytes of code which happen to match,
+# e.g. across the end of an instruction and the beginning of the next one,
+# would be mangled too, so only the code compiled with lines=True is
+# stripped: its CompiledFunction is created with line_markers=True
+LINE_MARKER = 0x7ff4a11e00000000
+# REX.W B8: MOV rax, imm64
+MOVABS_RAX = b'\x48\xb8'
+MARKER_TAIL = (LINE_MARKER >> 32).to_bytes(4, 'little')
+NOP10 = b'\x66\x2e\x0f\x1f\x84\x00\x00\x00\x00\x00'
+
+PREFIX = 'jit30min:'
+
+enabled = False
+lines_enabled = False
+_file = None
+_lock = threading.Lock()
+
+
+def enable(path=None, lines=False):
+    """
+    Start writing the compiled functions to path, by default
+    /tmp/perf-<pid>.map. If lines is True, the functions compiled from now
+    on are reported line by line.
+    """
+    global enabled, lines_enabled, _file
+    with _lock:
+        if _file is not None:
+            _file.close()
+        if path is None:
+            path = '/tmp/perf-%d.map' % os.getpid()
+        _file = open(path, 'a')
+        enabled = True
+        lines_enabled = lines
+
+def disable():
+    global enabled, lines_enabled, _file
+    with _lock:
+        if _file is not None:
+            _file.close()
+        _file = None
+        enabled = lines_enabled = False
+
+
+def strip_line_markers(code):
+    """
+    Replace the line markers in code with NOPs, and return
+    (code, [(offset, line)])
+    """
+    markers = []
+    start = code.find(MARKER_TAIL)
+    if start < 0:
+        return code, markers
+    code = bytearray(code)
+    while start >= 0:
+        offset = start - 6 # the tail is the last 4 bytes of the 10
+        if offset >= 0 and code[offset:offset+2] == MOVABS_RAX:
+            line = int.from_bytes(code[offset+2:offset+6], 'little')
+            markers.append((offset, line))
+            code[offset:offset+10] = NOP10
+        start = code.find(MARKER_TAIL, start + 4)
+    return bytes(code), markers
+
+def line_table(symbols, markers):
+    """
+    Return [(offset, size, name, line)] of the ranges of code which
+    correspond to each line, given the [(offset, size, name)] of the
+    functions and the markers found by strip_line_markers()
+    """
+    result = []
+    for start, size, name in symbols:
+        end = start + size
+        inside = [(offset, line) for offset, line in markers
+                  if start <= offset < end]
+        for i, (offset, line) in enumerate(inside):
+            if i + 1 < len(inside):
+                next_offset = inside[i + 1][0]
+            else:
+                next_offset = end
+            result.append((offset, next_offset - offset, name, line))
+    return result
+
+
+def entries(symbols, line_ranges=()):
+    """
+    Return the [(offset, size, symbol name)] to write to the map: with
+    line_ranges, the code of each function before the first line keeps
+    the name of the function
+    """
+    result = []
+    for start, size, name in symbols:
+        ranges = [(offset, length, line) for offset, length, fn, line
+                  in line_ranges if fn == name]
+        if not ranges:
+            result.append((start, size, PREFIX + name))
+            continue
+        if ranges[0][0] > start:
+            result.append((start, ranges[0][0] - start, PREFIX + name))
+        for offset, length, line in ranges:
+            result.append((offset, length, '%s%s:+%d' % (PREFIX, name, line)))
+    return result
+
+def register(address, symbols, line_ranges=()):
+    """
+    Write the functions loaded at address to the map
+    """
+    text = ''.join('%x %x %s\n' % (address + offset, size, name)
+                   for offset, size, name in entries(symbols, line_ranges)
+                   if size > 0)
+    with _lock:
+        if _file is not None:
+            _file.write(text)
+            _file.flush()
@@ -3,20 +3,38 @@ import inspect
 import platform
 import jit
 
-def compute_pi(iterations):
+def compute_pi(iterations: int):
     delta = 1.0 / iterations
-    inside = 0.0
-    x = 0.0
-    while x < 1:
-        y = 0.0
-        while y < 1:
+    inside = 0
+    i = 0
+    while i < iterations:
+        x = i * delta
+        j = 0
+        while j < iterations:
+            y = j * delta
             if x*x + y*y < 1:
                 inside = inside + 1
-            y = y + delta
-        x = x + delta
+            j = j + 1
+        i = i + 1
     total = iterations * iterations
     return inside / total * 4
 
+def count_inside(start: int, stop: int, iterations: int):
+    # the rows [start, stop) of compute_pi
+    delta = 1.0 / iterations
+    inside = 0
+    for i in range(start, stop):
+        x = i * delta
+        for j in range(iterations):
+            y = j * delta
+            if x*x + y*y < 1:
+                inside = inside + 1
+    return inside
+
+def parallel_pi(jitted, iterations):
+    inside = jitted.parallel_reduce(0, iterations, iterations)
+    return inside / (iterations * iterations) * 4
+
 def run(name, fn, iterations):
     a = time.time()
     pi = fn(iterations)
@@ -30,6 +48,8 @@ def main():
     if platform.python_implementation() != 'PyPy':
         jitted = jit.compile(compute_pi)
         run('JIT', jitted, N)
+        jitted = jit.compile(count_inside)
+        run('parallel', lambda n: parallel_pi(jitted, n), N)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,33 @@
+"""
+Counters of the code compiled with instrument=True:
+
+    - each loop counts how many times it's entered, its iterations, and the
+      cycles spent in it, measured with RDTSC, including the inner loops
+
+    - each if counts how many times its body is executed (taken) or not
+
+The counters live in a buffer owned by the CompiledFunction, whose address
+is loaded from a constant which is set when the code is loaded, see
+linking. The functions compiled together share the same buffer. The
+vectorized loops are disabled, so that every iteration is counted.
+
+The counters are not atomic: if the function runs in several threads at
+the same time, some increments might be lost.
+"""
+# the counters of each kind of node, allocated consecutively
+LOOP = ('entries', 'iterations', 'cycles')
+BRANCH = ('taken', 'not_taken')
+
+
+def report(counters, values):
+    """
+    counters is the list of (function name, line, counter name) of each
+    counter, values their values. Return a dict
+    {(function name, line): {counter name: value}}, where line is counted
+    from the def of the function.
+    """
+    result = {}
+    for (name, line, counter), value in zip(counters, values):
+        d = result.setdefault((name, line), {})
+        d[counter] = d.get(counter, 0) + value
+    return result
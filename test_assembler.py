@@ -1,23 +1,34 @@
+import pytest
+import encoder
+import assembler
+import jit
 from assembler import FunctionAssembler
-from peachpy import x86_64
 
 class TestFunctionAssembler:
 
+    @pytest.fixture(autouse=True, params=assembler.ENCODERS)
+    def select_encoder(self, request, monkeypatch):
+        if request.param == 'peachpy':
+            pytest.importorskip('peachpy')
+        monkeypatch.setattr(assembler, 'DEFAULT_ENCODER', request.param)
+
     def load(self, asm):
-        encoded_func = asm._encode()
-        return encoded_func.load()
+        code, consts, relocs, links = asm.assemble()
+        return jit.CompiledFunction(asm.nargs, code, consts=consts,
+                                    relocs=relocs, links=links)
 
     def test_getattr(self):
         asm = FunctionAssembler('foo', [])
-        assert asm.xmm0 is x86_64.xmm0
-        assert asm.rsp is x86_64.rsp
-        assert asm.qword is x86_64.qword
+        assert asm.xmm0 is encoder.xmm0
+        assert asm.rsp is encoder.rsp
+        assert asm.qword is encoder.qword
+        with pytest.raises(AttributeError):
+            asm.foo
 
     def test_opcode(self):
         asm = FunctionAssembler('foo', [])
         asm.ADDSD(asm.xmm0, asm.xmm1)
-        assert len(asm._peachpy_fn._instructions) == 1
-        assert asm._peachpy_fn._instructions[0].__class__.__name__ == 'ADDSD'
+        assert asm.instructions == [('ADDSD', (asm.xmm0, asm.xmm1))]
 
     def test_encode(self):
         asm = FunctionAssembler('foo', ['a', 'b'])
@@ -62,3 +73,30 @@ class TestFunctionAssembler:
         asm.RET()
         pyfn = self.load(asm)
         assert pyfn() == 42
+
+    def names(self, asm):
+        return [name for name, args in asm.instructions]
+
+    def test_peephole(self):
+        asm = FunctionAssembler('foo', ['a', 'b'])
+        asm.pushsd(asm.xmm0)
+        asm.popsd(asm.xmm2)
+        asm.MOVSD(asm.xmm1, asm.xmm1)
+        asm.ADDSD(asm.xmm2, asm.xmm1)
+        asm.MOVSD(asm.xmm0, asm.xmm2)
+        asm.RET()
+        asm.PXOR(asm.xmm0, asm.xmm0)
+        asm.RET()
+        pyfn = self.load(asm)
+        assert self.names(asm) == ['MOVSD', 'ADDSD', 'MOVSD', 'RET']
+        assert asm.ninstructions == 4
+        assert pyfn(3, 4) == 7
+
+    def test_no_peephole(self):
+        asm = FunctionAssembler('foo', ['a'], optimize=False)
+        asm.pushsd(asm.xmm0)
+        asm.popsd(asm.xmm0)
+        asm.RET()
+        pyfn = self.load(asm)
+        assert self.names(asm) == ['SUB', 'MOVSD', 'MOVSD', 'ADD', 'RET']
+        assert pyfn(3) == 3
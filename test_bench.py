@@ -0,0 +1,70 @@
+import json
+import pytest
+from bench import kernels, runner
+from bench.__main__ import main
+
+
+def result(**medians):
+    return {'kernels': {'pi': {metric: runner.stats([t])
+                               for metric, t in medians.items()}}}
+
+
+class TestKernels:
+
+    def test_python(self):
+        pi, = kernels.get_kernels(['pi'])
+        assert abs(pi.run_python(pi.setup(0.01)) - 3.14) < 0.1
+        dot, poly = kernels.get_kernels(['dot', 'poly'])
+        a, b, n = dot.setup(0.001)
+        assert n == 1000
+        assert dot.run_python([a, b, n]) == pytest.approx(
+            sum(x*y for x, y in zip(a, b)))
+        xs, = poly.setup(0.0001)
+        assert len(poly.run_python([xs])) == 100
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            kernels.get_kernels(['pi', 'nonexistent'])
+
+    @pytest.mark.parametrize('kernel', kernels.KERNELS,
+                             ids=lambda kernel: kernel.name)
+    def test_compiled(self, kernel):
+        import jit
+        compiled = jit.compile(kernel.fn)
+        expected = kernel.run_python(kernel.setup(0.01))
+        res = kernel.run_compiled(compiled, kernel.setup(0.01))
+        assert runner.same_result(res, expected)
+
+
+class TestRunner:
+
+    def test_stats(self):
+        s = runner.stats([3.0, 1.0, 2.0])
+        assert s == dict(min=1.0, median=2.0, mean=2.0, stdev=1.0, runs=3)
+        assert runner.stats([5.0])['stdev'] == 0.0
+
+    def test_run_python(self):
+        results = runner.run(['pi', 'poly'], scale=0.001, repeat=2, jit=False)
+        assert list(results['kernels']) == ['pi', 'poly']
+        assert results['kernels']['pi']['cpython']['runs'] == 2
+        assert 'jit' not in results['kernels']['pi']
+        json.dumps(results)
+
+    def test_compare(self):
+        old = result(compile=1.0, jit=1.0, cpython=1.0)
+        new = result(compile=1.05, jit=1.5, cpython=3.0)
+        assert runner.compare(old, new) == [
+            ('pi', 'compile', 1.0, 1.05, False),
+            ('pi', 'jit', 1.0, 1.5, True)]
+        assert runner.compare(old, new, threshold=0.01)[0][-1]
+        text = runner.format_comparison(runner.compare(old, new), 0.1)
+        assert 'REGRESSION' in text.splitlines()[2]
+        assert text.endswith('1 regression(s) over 10%')
+
+    def test_main_compare(self, tmpdir):
+        old = tmpdir.join('old.json')
+        new = tmpdir.join('new.json')
+        old.write(json.dumps(result(jit=1.0)))
+        new.write(json.dumps(result(jit=0.5)))
+        assert main(['compare', str(old), str(new)]) == 0
+        assert main(['compare', str(new), str(old)]) == 1
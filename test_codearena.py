@@ -0,0 +1,96 @@
+import struct
+from cffi import FFI
+from codearena import CodeArena, PAGE
+
+ffi = FFI()
+
+ADD = b'\xf2\x0f\x58\xc1\xc3' # addsd  xmm0,xmm1 ; ret
+# addsd xmm0,[rip+disp32] ; ret
+ADD_CONST = b'\xf2\x0f\x58\x05\x00\x00\x00\x00\xc3'
+
+def call(block, *args):
+    fntype = 'double(*)(%s)' % ', '.join(['double'] * len(args))
+    return ffi.cast(fntype, block.address)(*args)
+
+def permissions(address):
+    with open('/proc/self/maps') as f:
+        for line in f:
+            addresses, perms = line.split()[:2]
+            start, end = [int(x, 16) for x in addresses.split('-')]
+            if start <= address < end:
+                return perms[:3]
+
+
+class TestCodeArena:
+
+    def test_allocate(self):
+        arena = CodeArena()
+        block = arena.allocate(ADD)
+        assert call(block, 1, 2) == 3
+        assert block.address % 16 == 0
+
+    def test_consts(self):
+        arena = CodeArena()
+        blocks = [arena.allocate(ADD_CONST, struct.pack('<d', i), [(4, -8)])
+                  for i in range(10)]
+        for i, block in enumerate(blocks):
+            assert call(block, 1) == 1 + i
+
+    def test_permissions(self):
+        arena = CodeArena()
+        block = arena.allocate(ADD_CONST, struct.pack('<d', 42), [(4, -8)])
+        chunk = block.chunk
+        assert permissions(block.address) == 'r-x'
+        assert permissions(chunk.address + block.consts_offset) == 'r--'
+
+    def test_share_chunks(self):
+        arena = CodeArena()
+        blocks = [arena.allocate(ADD) for i in range(1000)]
+        assert len(arena.chunks) == 1
+        stats = arena.stats()
+        assert stats['functions'] == 1000
+        assert stats['mapped'] == arena.chunk_size
+        assert all(call(block, 1, 2) == 3 for block in blocks)
+
+    def test_big_function(self):
+        arena = CodeArena(chunk_size=4*PAGE, consts_size=PAGE)
+        nops = b'\x90' * (5*PAGE)
+        block = arena.allocate(nops + ADD)
+        assert call(block, 1, 2) == 3
+        assert block.chunk.code_size == 6*PAGE
+
+    def test_free(self):
+        arena = CodeArena(chunk_size=4*PAGE, consts_size=PAGE)
+        nops = b'\x90' * (2*PAGE)
+        a = arena.allocate(nops + ADD)
+        b = arena.allocate(nops + ADD) # does not fit in the first chunk
+        assert len(arena.chunks) == 2
+        assert call(b, 1, 2) == 3
+        arena.free(a)
+        assert len(arena.chunks) == 1
+        assert arena.stats()['functions'] == 1
+        # the last chunk is kept around, and reused
+        arena.free(b)
+        assert len(arena.chunks) == 1
+        assert arena.stats()['code'] == 0
+        c = arena.allocate(ADD)
+        assert c.chunk is b.chunk
+        assert call(c, 1, 2) == 3
+
+    def test_free_while_locked(self):
+        # e.g. a finalizer which runs inside allocate()
+        arena = CodeArena(chunk_size=4*PAGE, consts_size=PAGE)
+        nops = b'\x90' * (2*PAGE)
+        a = arena.allocate(nops + ADD)
+        arena.allocate(nops + ADD)
+        with arena.lock:
+            arena.free(a) # does not wait for the lock
+            assert len(arena.chunks) == 2
+        assert arena.stats()['chunks'] == 1
+        assert arena.pending == []
+
+    def test_clear(self):
+        arena = CodeArena()
+        arena.allocate(ADD)
+        arena.clear()
+        assert arena.stats()['chunks'] == 0
@@ -0,0 +1,82 @@
+import pytest
+import compilestats
+from compilestats import CompileStats, Totals, PHASES
+
+
+class TestCompileStats:
+
+    def test_phase(self):
+        stats = CompileStats('foo')
+        assert list(stats.times) == list(PHASES)
+        with stats.phase('parse'):
+            pass
+        with pytest.raises(ValueError):
+            with stats.phase('codegen'):
+                raise ValueError
+        assert stats.times['parse'] > 0
+        assert stats.times['codegen'] > 0
+        assert stats.total_time == stats.times['parse'] + stats.times['codegen']
+
+    def test_as_dict(self):
+        stats = CompileStats('foo', cached=True)
+        stats.code_size = 10
+        d = stats.as_dict()
+        assert d['name'] == 'foo'
+        assert d['cached'] is True
+        assert d['code_size'] == 10
+        assert d['times'] == dict.fromkeys(PHASES, 0.0)
+        assert d['total_time'] == 0.0
+
+
+class TestTotals:
+
+    def test_add(self):
+        totals = Totals()
+        a = CompileStats('a')
+        a.times['parse'] = 1.0
+        a.code_size = 10
+        a.instructions = 3
+        b = CompileStats('b', cached=True)
+        b.times['load'] = 0.5
+        b.code_size = 20
+        totals.add(a)
+        totals.add(b)
+        d = totals.as_dict()
+        assert d['compilations'] == 2
+        assert d['cached'] == 1
+        assert d['times']['parse'] == 1.0
+        assert d['times']['load'] == 0.5
+        assert d['total_time'] == 1.5
+        assert d['code_size'] == 30
+        assert d['instructions'] == 3
+        totals.reset()
+        assert totals.as_dict()['compilations'] == 0
+
+
+class TestHooks:
+
+    def test_record(self, monkeypatch):
+        monkeypatch.setattr(compilestats, 'totals', Totals())
+        seen = []
+        compilestats.add_hook(seen.append)
+        try:
+            stats = CompileStats('foo')
+            compilestats.record(stats)
+        finally:
+            compilestats.remove_hook(seen.append)
+        assert seen == [stats]
+        assert compilestats.totals.compilations == 1
+        compilestats.record(CompileStats('bar'))
+        assert seen == [stats]
+
+    def test_broken_hook(self, monkeypatch):
+        monkeypatch.setattr(compilestats, 'totals', Totals())
+        def broken(stats):
+            raise ZeroDivisionError
+        compilestats.add_hook(broken)
+        try:
+            with pytest.warns(UserWarning, match='ZeroDivisionError'):
+                compilestats.record(CompileStats('foo'))
+        finally:
+            compilestats.remove_hook(broken)
+        assert compilestats.totals.compilations == 1
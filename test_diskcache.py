@@ -0,0 +1,144 @@
+import os
+import struct
+import threading
+import pytest
+import jit
+from diskcache import DiskCache
+
+ADD = b'\xf2\x0f\x58\xc1\xc3' # addsd  xmm0,xmm1 ; ret
+# addsd xmm0,[rip+disp32] ; ret
+ADD_CONST = b'\xf2\x0f\x58\x05\x00\x00\x00\x00\xc3'
+CONST_100 = struct.pack('<d', 100.0)
+
+class TestDiskCache:
+
+    def test_put_get(self, tmpdir):
+        cache = DiskCache(str(tmpdir))
+        key = cache.key('def foo(a, b): return a+b', {'optimize': True})
+        assert cache.get(key) is None
+        cache.put(key, 2, ADD, ['double', 'double'])
+        (nargs, code, argtypes, consts, relocs, links, symbols, counters,
+         line_markers) = cache.get(key)
+        assert nargs == 2
+        assert code == ADD
+        assert argtypes == ['double', 'double']
+        assert consts == b''
+        assert relocs == []
+        assert links == []
+        assert symbols is None
+        assert counters is None
+        assert line_markers is False
+        fn = jit.CompiledFunction(nargs, code, argtypes, consts, relocs)
+        assert fn(1, 2) == 3
+
+    def test_symbols(self, tmpdir):
+        cache = DiskCache(str(tmpdir))
+        key = cache.key('def foo(a, b): return a+b', {})
+        cache.put(key, 2, ADD, ['double', 'double'], symbols=[(0, 5, 'foo')])
+        assert cache.get(key)[6] == [(0, 5, 'foo')]
+
+    def test_counters(self, tmpdir):
+        cache = DiskCache(str(tmpdir))
+        key = cache.key('def foo(a, b): return a+b', {})
+        counters = [('foo', 2, 'taken'), ('foo', 2, 'not_taken')]
+        cache.put(key, 2, ADD, ['double', 'double'], counters=counters)
+        assert cache.get(key)[7] == counters
+
+    def test_links(self, tmpdir):
+        cache = DiskCache(str(tmpdir))
+        key = cache.key('def foo(a): return sin(a)', {})
+        links = [(0, 'libm', 3), (8, 'counters', 0)]
+        cache.put(key, 1, ADD, ['double'], bytes(16), links=links)
+        assert cache.get(key)[5] == links
+
+    def test_line_markers(self, tmpdir):
+        cache = DiskCache(str(tmpdir))
+        key = cache.key('def foo(a, b): return a+b', {'lines': True})
+        cache.put(key, 2, ADD, ['double', 'double'], line_markers=True)
+        assert cache.get(key)[8] is True
+        cache.put(key, 2, ADD, ['double', 'double'])
+        assert cache.get(key)[8] is False
+
+    def test_put_get_consts(self, tmpdir):
+        cache = DiskCache(str(tmpdir))
+        key = cache.key('def foo(a): return a+100', {})
+        cache.put(key, 1, ADD_CONST, ['double'], CONST_100, [(4, -8)])
+        entry = cache.get(key)
+        assert entry[3] == CONST_100
+        assert entry[4] == [(4, -8)]
+        fn = jit.CompiledFunction(*entry)
+        assert fn(2) == 102
+
+    def test_key(self, tmpdir):
+        cache = DiskCache(str(tmpdir))
+        key1 = cache.key('def foo(): pass', {'optimize': True})
+        key2 = cache.key('def foo(): pass', {'optimize': False})
+        key3 = cache.key('def bar(): pass', {'optimize': True})
+        assert len(set([key1, key2, key3])) == 3
+        assert key1 == cache.key('def foo(): pass', {'optimize': True})
+
+    def test_corrupted(self, tmpdir):
+        cache = DiskCache(str(tmpdir))
+        key = cache.key('def foo(): pass', {})
+        cache.put(key, 2, ADD, ['double', 'double'])
+        filename, = [entry[2] for entry in cache.entries()]
+        with open(filename, 'r+b') as f:
+            f.truncate(os.path.getsize(filename) - 1)
+        assert cache.get(key) is None
+        assert not os.path.exists(filename)
+
+    def test_lru_eviction(self, tmpdir):
+        cache = DiskCache(str(tmpdir))
+        keys = [cache.key('def foo%d(): pass' % i, {}) for i in range(4)]
+        for i, key in enumerate(keys):
+            cache.put(key, 2, ADD, ['double', 'double'])
+            filename = cache._filename(key)
+            os.utime(filename, (1000 + i, 1000 + i))
+        entry_size = cache.size() // 4
+        # keys[0] becomes the most recently used
+        assert cache.get(keys[0]) is not None
+        cache.max_size = entry_size * 2
+        cache.evict()
+        assert cache.get(keys[0]) is not None
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[2]) is None
+        assert cache.get(keys[3]) is not None
+
+    def test_concurrent_access(self, tmpdir):
+        cache = DiskCache(str(tmpdir))
+        key = cache.key('def foo(a, b): return a+b', {})
+        errors = []
+        def worker():
+            for i in range(50):
+                cache.put(key, 2, ADD, ['double', 'double'])
+                entry = cache.get(key)
+                if entry is not None and entry[1] != ADD:
+                    errors.append(entry)
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors
+        assert len(cache.entries()) == 1
+        assert not [name for name in os.listdir(str(tmpdir))
+                    if name.startswith('.tmp-')]
+
+
+class TestCompile:
+
+    def test_compile_uses_cache(self, tmpdir, monkeypatch):
+        import compiler
+        monkeypatch.setattr(jit, 'disk_cache', DiskCache(str(tmpdir)))
+        monkeypatch.setattr(jit, 'compile_cache', None)
+        def foo(a, b):
+            return a * b
+        fn = jit.compile(foo)
+        assert fn(6, 7) == 42
+        assert len(jit.disk_cache.entries()) == 1
+        def broken(*args, **kwargs):
+            raise AssertionError('the cache was not used')
+        monkeypatch.setattr(compiler, 'AstCompiler', broken)
+        fn = jit.compile(foo)
+        assert fn(6, 7) == 42
+        pytest.raises(AssertionError, jit.compile, foo, optimize=False)
@@ -0,0 +1,295 @@
+import struct
+import shutil
+import subprocess
+import pytest
+from encoder import (encode, ENCODERS, SSE, SSE_MOVES, ALU, REGISTERS,
+                     Constant, Label, EncodingError, qword, oword,
+                     rax, rcx, rdx, rsp, rbp, rdi, rsi, r8, r9, r10, r11,
+                     r12, r13, eax, al, xmm0, xmm1, xmm2, xmm3, xmm5, xmm8,
+                     xmm9, xmm10, xmm12, xmm13, xmm15)
+
+
+def code(*instructions):
+    data, consts, fixups, padding = encode(list(instructions))
+    return data
+
+
+class TestOperands:
+
+    def test_address(self):
+        addr = rdi + rsi*8 + 16
+        assert addr.base is rdi
+        assert addr.index is rsi
+        assert addr.scale == 8
+        assert addr.disp == 16
+        assert (addr - 24).disp == -8
+        mem = qword[rdi + rsi*8 + 16]
+        assert mem.size == 8
+        assert mem.address.disp == 16
+        assert oword[rsp].size == 16
+        assert repr(mem) == 'qword[rdi + rsi*8 + 16]'
+
+    def test_constant(self):
+        assert Constant.float64(1.5).data == struct.pack('<d', 1.5)
+        assert Constant.uint64(7).data == struct.pack('<Q', 7)
+        assert Constant.uint64x2(1, 2).data == struct.pack('<QQ', 1, 2)
+
+
+class TestEncode:
+
+    def test_instructions(self):
+        for instr, expected in [
+                (('RET', ()), 'c3'),
+                (('ADDSD', (xmm0, xmm1)), 'f20f58c1'),
+                (('MOVSD', (xmm8, qword[rdi + rsi*8])), 'f2440f1004f7'),
+                (('MOVSD', (qword[rsp], xmm0)), 'f20f110424'),
+                (('MOV', (rax, rcx)), '4889c8'),
+                (('MOV', (r12, qword[r13])), '4d8b6500'),
+                (('MOV', (qword[rbp - 8], rax)), '488945f8'),
+                (('MOV', (rax, 2**40)), '48b80000000000010000'),
+                (('ADD', (rsp, 8)), '4883c408'),
+                (('CMP', (rax, 1000)), '483de8030000'),
+                (('IMUL', (rax, rcx, 3)), '486bc103'),
+                (('SETL', (al,)), '0f9cc0'),
+                (('MOVZX', (eax, al)), '0fb6c0'),
+                (('CVTSI2SD', (xmm0, rax)), 'f2480f2ac0'),
+                # the bytes below come from GNU as
+                (('SUBSD', (xmm9, xmm15)), 'f2450f5ccf'),
+                (('MULSD', (xmm0, qword[rax + r10*8 + 1024])),
+                 'f2420f5984d000040000'),
+                (('DIVSD', (xmm3, qword[rsp + 8])), 'f20f5e5c2408'),
+                (('SQRTSD', (xmm1, xmm2)), 'f20f51ca'),
+                (('MINSD', (xmm0, qword[r13])), 'f2410f5d4500'),
+                (('MAXSD', (xmm12, xmm3)), 'f2440f5fe3'),
+                (('ADDPD', (xmm2, oword[rdi + rsi*8])), '660f5814f7'),
+                (('MULPD', (xmm8, xmm9)), '66450f59c1'),
+                (('ANDPD', (xmm0, xmm1)), '660f54c1'),
+                (('XORPD', (xmm5, xmm5)), '660f57ed'),
+                (('PXOR', (xmm0, xmm0)), '660fefc0'),
+                (('UNPCKLPD', (xmm0, xmm1)), '660f14c1'),
+                (('UNPCKHPD', (xmm3, xmm3)), '660f15db'),
+                (('UCOMISD', (xmm0, xmm1)), '660f2ec1'),
+                (('MOVAPD', (xmm0, xmm9)), '66410f28c1'),
+                (('MOVUPD', (xmm2, oword[rdi + rsi*8 + 16])), '660f1054f710'),
+                (('MOVUPD', (oword[r8 + rax*8], xmm10)), '66450f1114c0'),
+                (('MOVAPD', (oword[rsp], xmm0)), '660f290424'),
+                (('MOVSD', (xmm1, qword[r12 + 16])), 'f2410f104c2410'),
+                (('ADD', (r11, -129)), '4981c37fffffff'),
+                (('SUB', (rax, 100000)), '482da0860100'),
+                (('SUB', (rdx, 100000)), '4881eaa0860100'),
+                (('CMP', (qword[rsp + 8], 1)), '48837c240801'),
+                (('OR', (rcx, r9)), '4c09c9'),
+                (('ADD', (qword[rdi + rax*8], rdx)), '480114c7'),
+                (('SUB', (r10, qword[r11 - 16])), '4d2b53f0'),
+                (('MOV', (r9, -1)), '49c7c1ffffffff'),
+                (('MOV', (rdx, -2**31 - 1)), '48baffffff7fffffffff'),
+                (('MOV', (rsp, rbp)), '4889ec'),
+                (('IMUL', (r10, rdx)), '4c0fafd2'),
+                (('IMUL', (rcx, r9, 1000)), '4969c9e8030000'),
+                (('NEG', (r10,)), '49f7da'),
+                (('SHL', (rax, 1)), '48d1e0'),
+                (('SHL', (r11, 32)), '49c1e320'),
+                (('CMOVNS', (rax, r11)), '490f49c3'),
+                (('CMOVG', (r10, qword[rsp + 8])), '4c0f4f542408'),
+                (('SETB', (al,)), '0f92c0'),
+                (('CVTTSD2SI', (rcx, xmm13)), 'f2490f2ccd'),
+                (('CVTSI2SD', (xmm13, qword[rdi + 8])), 'f24c0f2a6f08'),
+                (('ROUNDSD', (xmm1, xmm9, 9)), '66410f3a0bc909'),
+                (('RDTSC', ()), '0f31'),
+                (('CALL', (rax,)), 'ffd0'),
+                (('CALL', (qword[r11],)), '41ff13'),
+                ]:
+            assert code(instr).hex() == expected, instr
+
+    def test_jumps(self):
+        label = Label()
+        short = code(('LABEL', (label,)), ('JL', (label,)))
+        assert short.hex() == '7cfe'
+        body = [('ADD', (rax, rcx))] * 50 # 150 bytes
+        near = code(('LABEL', (label,)), *body, ('JMP', (label,)))
+        assert near[150:].hex() == 'e9' + struct.pack('<i', -155).hex()
+        forward = Label()
+        data = code(('JE', (forward,)), *body, ('LABEL', (forward,)))
+        assert data[:6].hex() == '0f84' + struct.pack('<i', 150).hex()
+
+    def test_align(self):
+        label = Label()
+        data, _, _, padding = encode([('RET', ()), ('ALIGN', (16,)),
+                                      ('LABEL', (label,)), ('RET', ())])
+        assert len(data) == 17
+        assert padding == [(1, 15)]
+        assert data[16] == 0xc3
+
+    def test_constants(self):
+        one = Constant.float64(1.0)
+        mask = Constant.uint64x2(1, 2)
+        data, consts, fixups, _ = encode([
+            ('ADDSD', (xmm0, one)),
+            ('ANDPD', (xmm1, mask)),
+            ('MULSD', (xmm0, Constant.float64(1.0))),
+            ('RET', ())])
+        # the 16-byte constants first, and the equal ones are shared
+        assert consts == mask.data + one.data
+        assert [target for offset, target, pc in fixups] == [16, 0, 16]
+        for offset, target, pc in fixups:
+            assert data[offset-1] & 0xc7 == 0x05 # RIP-relative
+            assert pc == offset + 4
+
+    def test_errors(self):
+        with pytest.raises(EncodingError):
+            encode([('FOO', ())])
+        with pytest.raises(EncodingError):
+            encode([('ADDSD', (rax, xmm0))])
+        with pytest.raises(EncodingError):
+            encode([('JMP', (Label(),))])
+
+
+@pytest.mark.skipif(not (shutil.which('as') and shutil.which('objcopy')),
+                    reason='needs GNU as and objcopy')
+class TestGnuAs:
+    """
+    Compare the encoding of many operand combinations with GNU as
+    """
+
+    GPRS = ['rax', 'rcx', 'rsp', 'rbp', 'rsi', 'r8', 'r12', 'r13']
+    XMMS = ['xmm0', 'xmm7', 'xmm8', 'xmm15']
+    IMMS = [0, 1, -1, 127, 128, -129, 100000, -2**31]
+
+    def memories(self):
+        """
+        Yield (operand, text) for the memory operands, with the base
+        registers which need a SIB byte or a displacement
+        """
+        for base in ['rax', 'rsp', 'rbp', 'r12', 'r13']:
+            for index in [None, 'rdi', 'r10']:
+                for disp in [0, 8, -16, 1024]:
+                    address = REGISTERS[base] + disp
+                    text = base
+                    if index:
+                        address = address + REGISTERS[index]*8
+                        text += '+%s*8' % index
+                    yield address, '%s%+d' % (text, disp)
+
+    def cases(self):
+        """
+        Yield (instruction, text in Intel syntax)
+        """
+        R = REGISTERS
+        memories = list(self.memories())
+        for name in SSE:
+            size, ptr = ((oword, 'xmmword') if name.endswith('PD') or
+                         name == 'PXOR' else (qword, 'qword'))
+            for x in self.XMMS:
+                for y in self.XMMS:
+                    yield (name, (R[x], R[y])), '%s %s, %s' % (name, x, y)
+                for address, text in memories[::7]:
+                    yield ((name, (R[x], size[address])),
+                           '%s %s, %s ptr [%s]' % (name, x, ptr, text))
+        for name in SSE_MOVES:
+            size, ptr = ((qword, 'qword') if name == 'MOVSD' else
+                         (oword, 'xmmword'))
+            for x in self.XMMS:
+                for address, text in memories[::5]:
+                    mem = '%s ptr [%s]' % (ptr, text)
+                    yield ((name, (R[x], size[address])),
+                           '%s %s, %s' % (name, x, mem))
+                    yield ((name, (size[address], R[x])),
+                           '%s %s, %s' % (name, mem, x))
+        for name in list(ALU) + ['MOV']:
+            for d in self.GPRS:
+                for s in self.GPRS:
+                    yield (name, (R[d], R[s])), '%s %s, %s' % (name, d, s)
+                for imm in self.IMMS:
+                    yield (name, (R[d], imm)), '%s %s, %d' % (name, d, imm)
+                for address, text in memories[::3]:
+                    mem = 'qword ptr [%s]' % text
+                    yield ((name, (R[d], qword[address])),
+                           '%s %s, %s' % (name, d, mem))
+                    yield ((name, (qword[address], R[d])),
+                           '%s %s, %s' % (name, mem, d))
+        for d in self.GPRS:
+            for imm in [2**31, 2**32, -2**31 - 1]:
+                yield ('MOV', (R[d], imm)), 'movabs %s, %d' % (d, imm)
+            yield ('NEG', (R[d],)), 'neg %s' % d
+            yield ('SHL', (R[d], 3)), 'shl %s, 3' % d
+            yield ('CALL', (R[d],)), 'call %s' % d
+            for s in ['rdx', 'r13']:
+                yield ('IMUL', (R[d], R[s])), 'imul %s, %s' % (d, s)
+                yield ('IMUL', (R[d], R[s], 1000)), 'imul %s, %s, 1000' % (d, s)
+                yield ('CMOVL', (R[d], R[s])), 'cmovl %s, %s' % (d, s)
+            for x in self.XMMS:
+                yield ('CVTSI2SD', (R[x], R[d])), 'cvtsi2sd %s, %s' % (x, d)
+                yield ('CVTTSD2SI', (R[d], R[x])), 'cvttsd2si %s, %s' % (d, x)
+                yield (('ROUNDSD', (R[x], R[x], 10)),
+                       'roundsd %s, %s, 10' % (x, x))
+
+    def test_gnu_as(self, tmpdir):
+        cases = list(self.cases())
+        src = tmpdir.join('test.s')
+        src.write('.intel_syntax noprefix\n' +
+                  ''.join(text + '\n' for _, text in cases))
+        obj = str(tmpdir.join('test.o'))
+        binary = str(tmpdir.join('test.bin'))
+        subprocess.run(['as', '-o', obj, str(src)], check=True)
+        subprocess.run(['objcopy', '-O', 'binary', '-j', '.text', obj,
+                        binary], check=True)
+        expected = tmpdir.join('test.bin').read_binary()
+        pos = 0
+        for (name, args), text in cases:
+            data, _, _ = ENCODERS[name](name, args)
+            assert data.hex() == expected[pos:pos+len(data)].hex(), text
+            pos += len(data)
+        assert pos == len(expected)
+
+
+class TestPeachPy:
+    """
+    The direct encoder produces the same code as PeachPy, apart from the
+    NOPs of the padding and the displacements of the constants, which can
+    be laid out in a different order
+    """
+
+    SOURCES = [
+        """
+        def foo(a, b):
+            return a * b + 1.5
+        """,
+        """
+        def foo(a, n: int):
+            tot = 0.0
+            for i in range(n):
+                if a[i] > 0:
+                    tot = tot + a[i]
+            return tot
+        """,
+        """
+        def foo(x: int, y: int):
+            while x > y:
+                x = x - 3
+            return x * 2
+        """,
+        ]
+
+    @pytest.mark.parametrize('src', SOURCES)
+    def test_same_code(self, src):
+        pytest.importorskip('peachpy')
+        import jit
+        codes = []
+        for name in ('peachpy', 'direct'):
+            comp = jit.AstCompiler(src, encoder=name)
+            comp.compile()
+            asm = comp.asm
+            if name == 'direct':
+                data, consts, fixups, padding = encode(asm.instructions)
+            else:
+                data, consts, fixups = asm._peachpy_fixups(asm._encode())
+                padding = []
+            data = bytearray(data)
+            for offset, target, pc in fixups:
+                data[offset:offset+4] = b'\0' * 4
+            codes.append((data, padding))
+        (data1, _), (data2, padding) = codes
+        assert len(data1) == len(data2)
+        for offset, size in padding:
+            data1[offset:offset+size] = data2[offset:offset+size]
+        assert data1 == data2
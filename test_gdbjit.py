@@ -0,0 +1,76 @@
+import shutil
+import tempfile
+import subprocess
+import pytest
+import gdbjit
+
+
+class TestElf:
+
+    @pytest.mark.skipif(not shutil.which('readelf'), reason='needs readelf')
+    def test_readelf(self, tmpdir):
+        elf = gdbjit.make_elf(0x7f0000001000, 64, [(0, 48, 'foo'),
+                                                   (48, 16, 'bar')])
+        path = tmpdir.join('jit.o')
+        path.write_binary(elf)
+        out = subprocess.run(['readelf', '-h', '-S', '-s', '-W', str(path)],
+                             check=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             universal_newlines=True)
+        assert out.stderr == ''
+        text = out.stdout
+        assert 'REL (Relocatable file)' in text
+        assert 'X86-64' in text
+        line, = [line for line in text.splitlines() if '.text' in line]
+        fields = line.split()
+        i = fields.index('NOBITS')
+        assert fields[i+1:i+4] == ['00007f0000001000', '000000', '000040']
+        symbols = [line.split() for line in text.splitlines()
+                   if 'FUNC' in line]
+        assert [(s[1], s[2], s[7]) for s in symbols] == [
+            ('0000000000000000', '48', 'foo'),
+            ('0000000000000030', '16', 'bar')]
+
+
+@pytest.mark.skipif(not shutil.which('cc'), reason='needs a C compiler')
+class TestRegister:
+
+    def test_register(self):
+        gdbjit.enable()
+        try:
+            desc = gdbjit._descriptor
+            assert desc.version == 1
+            e1 = gdbjit.register(0x1000, 16, [(0, 16, 'foo')])
+            e2 = gdbjit.register(0x2000, 16, [(0, 16, 'bar')])
+            assert desc.action_flag == gdbjit.JIT_REGISTER_FN
+            assert desc.relevant_entry == e2.entry
+            assert desc.first_entry == e2.entry
+            assert e2.entry.next_entry == e1.entry
+            assert e1.entry.prev_entry == e2.entry
+            data = gdbjit.ffi.buffer(e1.entry.symfile_addr,
+                                     e1.entry.symfile_size)[:]
+            assert data == gdbjit.make_elf(0x1000, 16, [(0, 16, 'foo')])
+            gdbjit.unregister(e2)
+            assert desc.action_flag == gdbjit.JIT_UNREGISTER_FN
+            assert desc.relevant_entry == e2.entry
+            assert desc.first_entry == e1.entry
+            assert e1.entry.prev_entry == gdbjit.ffi.NULL
+            gdbjit.unregister(e1)
+            assert desc.first_entry == gdbjit.ffi.NULL
+        finally:
+            gdbjit.disable()
+
+    def test_build_lib(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+        lib = gdbjit._build_lib()
+        desc = gdbjit.ffi.addressof(lib, '__jit_debug_descriptor')
+        assert desc.version == 1
+        # the temporary directory is removed
+        assert tmpdir.listdir() == []
+
+    def test_no_compiler(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+        monkeypatch.setenv('CC', 'jit30min-no-such-cc')
+        with pytest.raises(RuntimeError, match='C compiler'):
+            gdbjit._build_lib()
+        assert tmpdir.listdir() == []
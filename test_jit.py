@@ -1,8 +1,28 @@
+import ast
+import math
+import array
+import textwrap
 import pytest
 import jit
+import cpu
+import assembler
+from codearena import PAGE
 from assembler import FunctionAssembler as FA
 from test_assembler import TestFunctionAssembler as AssemblerTest
 
+def helper(x):
+    return x * x + square_plus_one(x) - 1
+
+def square_plus_one(x):
+    return x * x + 1
+
+# a global, which the compiled code cannot read
+K = 3.0
+
+# set by TestTiered.test_helper_defined_after, after decorating the function
+global_helper = None
+
+
 class TestCompiledFuntion(AssemblerTest):
 
     def test_basic(self):
@@ -11,26 +31,128 @@ class TestCompiledFuntion(AssemblerTest):
         assert p.fptr(12.34, 56.78) == 12.34 + 56.78
         assert p(12.34, 56.78) == 12.34 + 56.78
 
-    def load(self, asm):
-        code = asm.assemble_and_relocate()
-        return jit.CompiledFunction(asm.nargs, code)
+class TestDirectEncoder:
+
+    @pytest.fixture(autouse=True)
+    def direct(self, monkeypatch):
+        monkeypatch.setattr(assembler, 'DEFAULT_ENCODER', 'direct')
+
+    def test_encoder(self):
+        asm = FA('foo', [])
+        assert asm.encoder == 'direct'
+        with pytest.raises(ValueError):
+            FA('foo', [], encoder='foo')
+
+    def test_compile(self):
+        comp = jit.AstCompiler("""
+        def foo(a, n: int):
+            tot = 0.0
+            for i in range(n):
+                if a[i] > 0:
+                    tot = tot + a[i] * 2.5
+            return tot
+        """, encoder='direct')
+        fn = comp.compile()
+        assert comp.asm.encoder == 'direct'
+        a = array.array('d', [1, -2, 3, 4])
+        assert fn(a, 4) == 20
+        fn2 = jit.compile(encoder='direct')(helper)
+        assert fn2(3) == helper(3)
 
 class TestRegAllocator:
 
+    def allocate(self, src):
+        tree = ast.parse(textwrap.dedent(src))
+        live = jit.LiveRanges(tree.body[0])
+        return live, jit.RegAllocator(live)
+
     def test_allocate(self):
-        regs = jit.RegAllocator()
+        live, regs = self.allocate("""
+        def foo(a, b):
+            c = a + b
+            return c
+        """)
         assert regs.get('a') == FA.xmm0
         assert regs.get('b') == FA.xmm1
-        assert regs.get('a') == FA.xmm0
         assert regs.get('c') == FA.xmm2
 
-    def test_too_many_vars(self):
-        regs = jit.RegAllocator()
-        # force allocation of xmm0..xmm14
-        for i in range(15):
-            regs.get('var%d' % i)
-        assert regs.get('var15') == FA.xmm15
-        pytest.raises(NotImplementedError, "regs.get('var16')")
+    def test_reuse_registers(self):
+        live, regs = self.allocate("""
+        def foo(a):
+            b = a + 1
+            c = b + 1
+            d = c + 1
+            return d
+        """)
+        assert live.ranges == {'a': [0, 1], 'b': [1, 2], 'c': [2, 3],
+                               'd': [3, 4]}
+        # a is dead when c is born
+        assert regs.get('c') == FA.xmm0
+        assert regs.get('d') == FA.xmm1
+
+    def test_loop(self):
+        live, regs = self.allocate("""
+        def foo(n):
+            i = 0
+            tot = 0
+            while i < n:
+                tmp = i * 2
+                tot = tot + tmp
+                i = i + 1
+            x = 1
+            return tot + x
+        """)
+        # tot and i are live around the back edge, tmp is not
+        assert live.ranges['i'] == [1, 6]
+        assert live.ranges['tot'] == [2, 8]
+        assert live.ranges['tmp'] == [4, 5]
+        assert live.ranges['n'] == [0, 6]
+        assert live.weights['i'] == 1 + 10 + 10 + 10 + 10
+
+    def test_loop_carried(self):
+        live, regs = self.allocate("""
+        def foo(n):
+            i = 0
+            while i < n:
+                if i < 5:
+                    last = i
+                i = i + 1
+            return last
+        """)
+        # last is defined inside the loop but read after it: its value must
+        # survive the back edge
+        assert live.ranges['last'] == [2, 6]
+
+    def test_spill(self):
+        n = len(jit.RegAllocator.REGISTERS)
+        lines = ['def foo():']
+        lines += ['    v%d = %d' % (i, i) for i in range(n)]
+        lines += ['    hot = 0']
+        lines += ['    hot = hot + v%d' % i for i in range(n)]
+        live, regs = self.allocate('\n'.join(lines))
+        spilled = [varname for varname, loc in regs.locations.items()
+                   if isinstance(loc, jit.StackSlot)]
+        assert 'hot' not in spilled
+        assert len(spilled) == jit.RegAllocator.RESERVED + 1
+        assert regs.nslots == len(spilled)
+
+    def test_stack_args(self):
+        n = len(jit.RegAllocator.REGISTERS) + 4
+        argnames = ['a%d' % i for i in range(n)]
+        src = 'def foo(%s):\n    return %s' % (', '.join(argnames),
+                                               ' + '.join(argnames))
+        live, regs = self.allocate(src)
+        assert regs.get('a0') is FA.xmm0
+        assert regs.get('a7') is FA.xmm7
+        slots = [loc for loc in regs.locations.values()
+                 if isinstance(loc, jit.StackSlot)]
+        # the arguments which don't fit in registers stay where the caller
+        # put them
+        assert slots
+        assert all(isinstance(slot, jit.ArgSlot) for slot in slots)
+        assert regs.nslots == 0
+        loaded = regs.stack_args()
+        assert len(loaded) + len(slots) == n - 8
 
 
 class TestAstCompiler:
@@ -59,6 +181,32 @@ class TestAstCompiler:
         fn = comp.compile()
         assert fn(3, 4) == 4
 
+    def test_many_arguments(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b, c, d, e, f, g, h, i, j, k, l):
+            return a - b + c - d + e - f + g - h + i - j + k * l
+        """)
+        fn = comp.compile()
+        args = range(1, 13)
+        assert fn(*args) == 1 - 2 + 3 - 4 + 5 - 6 + 7 - 8 + 9 - 10 + 11 * 12
+
+    def test_stack_arguments_spilled(self):
+        n = 20
+        argnames = ['a%d' % i for i in range(n)]
+        comp = jit.AstCompiler('def foo(%s):\n    return %s' % (
+            ', '.join(argnames), ' + '.join(argnames)))
+        fn = comp.compile()
+        assert fn(*range(n)) == sum(range(n))
+
+    def test_mixed_arguments(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b, c, d, e, f, g, h, i, j, arr):
+            return a + b + c + d + e + f + g + h + i * arr[0] + j * arr[1]
+        """)
+        fn = comp.compile()
+        data = array.array('d', [100, 1000])
+        assert fn(*range(10), data) == sum(range(8)) + 8*100 + 9*1000
+
     def test_add(self):
         comp = jit.AstCompiler("""
         def foo(a, b):
@@ -76,6 +224,36 @@ class TestAstCompiler:
         res = (3-4) + (3*4) - (3.0/4)
         assert fn(3, 4) == res
 
+    def test_unary_minus(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b):
+            return -a + -(a * b) - +b
+        """)
+        fn = comp.compile()
+        assert 'XORPD' in self.instructions(comp)
+        assert fn(3, 4) == -3 - 12 - 4
+        assert fn(-0.5, 2) == 0.5 + 1 - 2
+        comp = jit.AstCompiler("""
+        def foo(n: int, m: int):
+            k = -n
+            return -(k * m) + -m
+        """)
+        fn = comp.compile()
+        assert 'NEG' in self.instructions(comp)
+        assert 'XORPD' not in self.instructions(comp)
+        assert fn(3, 4) == 12 - 4
+
+    def test_unsupported_binops(self):
+        for expr, opname in [('a // b', 'FLOORDIV'), ('a ** b', 'POW'),
+                             ('n % 3', 'MOD')]:
+            comp = jit.AstCompiler("""
+            def foo(a, b, n: int):
+                return %s
+            """ % expr)
+            with pytest.raises(NotImplementedError) as exc:
+                comp.compile()
+            assert str(exc.value) == 'operator %s' % opname
+
     def test_assign(self):
         comp = jit.AstCompiler("""
         def foo(a):
@@ -109,6 +287,688 @@ class TestAstCompiler:
         fn = comp.compile()
         assert fn(5) == 1+2+3+4
 
+    def test_nested_expressions(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b, c):
+            return (a - b*c) / (c - (a+b)*(a-b)) + 2*(b - (c - a))
+        """)
+        fn = comp.compile()
+        a, b, c = 3.0, 4.0, 5.0
+        assert fn(a, b, c) == (a - b*c) / (c - (a+b)*(a-b)) + 2*(b - (c - a))
+
+    def test_no_stack_traffic(self):
+        comp = jit.AstCompiler("""
+        def foo(x, y):
+            return x*x + y*y
+        """)
+        fn = comp.compile()
+        names = [name for name, args in comp.asm.instructions]
+        # the default return after the last one is removed as dead code
+        assert names == ['MOVSD', 'MULSD', 'MOVSD', 'MULSD', 'ADDSD',
+                         'MOVSD', 'RET']
+        assert fn(3, 4) == 25
+
+    def test_assign_in_place(self):
+        comp = jit.AstCompiler("""
+        def foo(x):
+            x = x + 1
+            return x
+        """)
+        fn = comp.compile()
+        names = [name for name, args in comp.asm.instructions]
+        assert names[0] == 'ADDSD'
+        assert fn(41) == 42
+
+    def test_spill_temporaries(self):
+        # 14 variables leave only two free registers, but the expression
+        # needs three
+        comp = jit.AstCompiler("""
+        def foo(a, b):
+            v0 = 0
+            v1 = 1
+            v2 = 2
+            v3 = 3
+            v4 = 4
+            v5 = 5
+            v6 = 6
+            v7 = 7
+            v8 = 8
+            v9 = 9
+            v10 = 10
+            v11 = 11
+            return ((a+b) * (a-b)) + ((a*b) - (b/a))
+        """)
+        fn = comp.compile()
+        a, b = 3.0, 4.0
+        assert fn(a, b) == ((a+b) * (a-b)) + ((a*b) - (b/a))
+
+    def test_many_variables(self):
+        n = 30
+        lines = ['def foo(a):']
+        lines += ['    v%d = a + %d' % (i, i) for i in range(n)]
+        lines += ['    return ' + ' + '.join('v%d' % i for i in range(n))]
+        comp = jit.AstCompiler('\n'.join(lines))
+        fn = comp.compile()
+        assert comp.regs.nslots > 0
+        assert fn(1) == sum(1 + i for i in range(n))
+
+    def test_nested_loops(self):
+        comp = jit.AstCompiler("""
+        def foo(n):
+            tot = 0
+            i = 0
+            while i < n:
+                j = 0
+                while j < i:
+                    tot = tot + j
+                    j = j + 1
+                i = i + 1
+            return tot
+        """)
+        fn = comp.compile()
+        assert fn(10) == sum(j for i in range(10) for j in range(i))
+
+    def test_optimize(self):
+        src = """
+        def foo(x):
+            k = 2 * 3
+            return x * k / 4 * 1
+        """
+        comp1 = jit.AstCompiler(src, optimize=False)
+        fn1 = comp1.compile()
+        comp2 = jit.AstCompiler(src)
+        fn2 = comp2.compile()
+        n1 = len(comp1.asm.instructions)
+        n2 = len(comp2.asm.instructions)
+        assert n2 < n1
+        assert fn1(7) == fn2(7) == 7 * 6 / 4
+
+    def instructions(self, comp):
+        return [name for name, args in comp.asm.instructions]
+
+    def test_comparisons(self):
+        nan = float('nan')
+        values = [(1, 2), (2, 1), (2, 2), (nan, 1), (1, nan), (nan, nan)]
+        for op in ('<', '<=', '>', '>=', '==', '!='):
+            comp = jit.AstCompiler("""
+            def foo(a, b):
+                if a %s b:
+                    return 1
+                return 0
+            """ % op)
+            fn = comp.compile()
+            for a, b in values:
+                expected = eval('a %s b' % op)
+                assert fn(a, b) == expected, (a, op, b)
+
+    def test_single_branch(self):
+        comp = jit.AstCompiler("""
+        def foo(a):
+            if a < 0:
+                a = 0 - a
+            return a
+        """)
+        fn = comp.compile()
+        names = self.instructions(comp)
+        assert names.count('JBE') == 1
+        assert 'JMP' not in names
+        assert fn(-42) == fn(42) == 42
+
+    def test_undefined_variables(self):
+        def foo(x):
+            return x * K
+        with pytest.raises(NotImplementedError) as exc:
+            jit.compile(foo)
+        assert str(exc.value) == 'variable K might be used before assignment'
+        for src in ["""
+            def foo(x):
+                if x > 0:
+                    y = 1.0
+                return y
+            """, """
+            def foo(x):
+                while x > 0:
+                    y = x
+                    x = x - 1
+                return y
+            """]:
+            comp = jit.AstCompiler(src)
+            with pytest.raises(NotImplementedError):
+                comp.compile()
+
+    def test_chained_comparison(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b, c):
+            if a < b <= c:
+                return 1
+            return 0
+        """)
+        fn = comp.compile()
+        for args in [(1, 2, 3), (1, 2, 2), (2, 1, 3), (1, 3, 2)]:
+            a, b, c = args
+            assert fn(*args) == (a < b <= c)
+
+    def test_boolops(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b, c):
+            if (a < b and b < c) or not (a < c or c == 1):
+                return 1
+            return 0
+        """)
+        fn = comp.compile()
+        for a in (0, 1, 2):
+            for b in (0, 1, 2):
+                for c in (0, 1, 2):
+                    expected = (a < b and b < c) or not (a < c or c == 1)
+                    assert fn(a, b, c) == expected, (a, b, c)
+
+    def test_truth_value(self):
+        comp = jit.AstCompiler("""
+        def foo(a):
+            if a:
+                return 1
+            return 2
+        """)
+        fn = comp.compile()
+        assert fn(0) == 2
+        assert fn(-0.5) == 1
+        assert fn(float('nan')) == 1
+
+    def test_else_elif(self):
+        comp = jit.AstCompiler("""
+        def foo(a):
+            if a < 0:
+                res = 0 - 1
+            elif a == 0:
+                res = 0
+            else:
+                res = 1
+            return res
+        """)
+        fn = comp.compile()
+        assert fn(-5) == -1
+        assert fn(0) == 0
+        assert fn(5) == 1
+
+    def test_rotated_loop(self):
+        comp = jit.AstCompiler("""
+        def foo(a):
+            i = 0
+            while i < a:
+                i = i + 1
+            return i
+        """)
+        fn = comp.compile()
+        names = self.instructions(comp)
+        assert 'JMP' not in names
+        assert names.count('ALIGN') == 1
+        # the guard and the backward jump
+        assert names.count('JBE') == 1
+        assert names.count('JA') == 1
+        assert fn(0) == 0
+        assert fn(-1) == 0
+        assert fn(10) == 10
+
+    def test_array_load(self):
+        comp = jit.AstCompiler("""
+        def foo(a, n):
+            tot = 0
+            i = 0
+            while i < n:
+                tot = tot + a[i]
+                i = i + 1
+            return tot + a[0]
+        """)
+        fn = comp.compile()
+        assert fn.argtypes == ['const double*', 'double']
+        data = array.array('d', [1, 2, 3, 4])
+        assert fn(data, 4) == 1 + 2 + 3 + 4 + 1
+        assert fn(memoryview(data), 2) == 1 + 2 + 1
+        assert fn(bytes(data), 3) == 1 + 2 + 3 + 1
+
+    def test_array_store(self):
+        comp = jit.AstCompiler("""
+        def foo(src, dst, n, k):
+            i = 0
+            while i < n:
+                dst[i] = src[i] * k + dst[i]
+                i = i + 1
+            dst[src[0]] = 42
+        """)
+        fn = comp.compile()
+        assert fn.argtypes == ['const double*', 'double*', 'double', 'double']
+        src = array.array('d', [3, 2, 1])
+        dst = bytearray(array.array('d', [10, 20, 30, 40]))
+        fn(src, dst, 3, 2)
+        assert list(array.array('d', dst)) == [16, 24, 32, 42]
+        pytest.raises(BufferError, fn, src, bytes(dst), 3, 2)
+        pytest.raises(TypeError, fn, src, array.array('f', [0]*4), 3, 2)
+
+    def test_int_variables(self):
+        comp = jit.AstCompiler("""
+        def foo(n: int):
+            i = 0
+            tot = 0
+            while i < n:
+                tot = tot + i * i
+                i = i + 1
+            return tot
+        """)
+        fn = comp.compile()
+        assert fn.argtypes == ['int64_t']
+        names = self.instructions(comp)
+        assert 'ADD' in names
+        assert 'IMUL' in names
+        assert 'CMP' in names
+        assert 'UCOMISD' not in names
+        assert 'ADDSD' not in names
+        assert fn(10) == sum(i*i for i in range(10))
+        assert fn(0) == 0
+
+    def test_int_float_conversions(self):
+        comp = jit.AstCompiler("""
+        def foo(a, n: int):
+            i = 1
+            x = a * i
+            y = n / 2
+            if n < a:
+                return x + y + i
+            return -1.0
+        """)
+        fn = comp.compile()
+        assert fn.argtypes == ['double', 'int64_t']
+        assert 'CVTSI2SD' in self.instructions(comp)
+        assert fn(2.5, 1) == 2.5 + 0.5 + 1
+        assert fn(2.5, 3) == -1
+
+    def test_int_comparisons(self):
+        for op in ('<', '<=', '>', '>=', '==', '!='):
+            comp = jit.AstCompiler("""
+            def foo(a: int, b: int):
+                if a %s b:
+                    return 1
+                return 0
+            """ % op)
+            fn = comp.compile()
+            for a, b in [(1, 2), (2, 1), (2, 2), (-3, 2)]:
+                expected = eval('a %s b' % op)
+                assert fn(a, b) == expected, (a, op, b)
+
+    def test_int_index(self):
+        comp = jit.AstCompiler("""
+        def foo(a, n: int):
+            i = 1
+            tot = 0.0
+            while i < n:
+                tot = tot + a[i] - a[i-1]
+                i = i + 1
+            return tot + a[i*0]
+        """)
+        fn = comp.compile()
+        assert 'CVTTSD2SI' not in self.instructions(comp)
+        data = array.array('d', [1, 3, 6, 10])
+        assert fn(data, 4) == 10 - 1 + 1
+
+    def test_many_int_variables(self):
+        n = len(jit.AstCompiler.INT_REGISTERS) + 2
+        lines = ['def foo(k: int):']
+        lines += ['    v%d = k + %d' % (i, i) for i in range(n)]
+        lines += ['    return ' + ' + '.join('v%d' % i for i in range(n))]
+        comp = jit.AstCompiler('\n'.join(lines))
+        fn = comp.compile()
+        assert fn(1) == sum(1 + i for i in range(n))
+
+    def test_for_range(self):
+        comp = jit.AstCompiler("""
+        def foo(a, n: int):
+            tot = 0.0
+            for i in range(n):
+                tot = tot + a[i]
+            for j in range(1, n, 2):
+                tot = tot + 10 * a[j]
+            for k in range(n - 1, -1, -1):
+                tot = tot * 2 + a[k]
+            return tot
+        """)
+        fn = comp.compile()
+        assert fn.argtypes == ['const double*', 'int64_t']
+        def expected(a, n):
+            tot = 0.0
+            for i in range(n):
+                tot = tot + a[i]
+            for j in range(1, n, 2):
+                tot = tot + 10 * a[j]
+            for k in range(n - 1, -1, -1):
+                tot = tot * 2 + a[k]
+            return tot
+        data = array.array('d', [1, 2, 3, 4, 5])
+        for n in range(6):
+            assert fn(data, n) == expected(data, n)
+
+    def test_for_float_bounds(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b):
+            tot = 0
+            for i in range(a, b):
+                tot = tot + i
+            return tot
+        """)
+        fn = comp.compile()
+        assert 'CVTTSD2SI' in self.instructions(comp)
+        assert fn(1.5, 4.9) == 1 + 2 + 3
+        assert fn(-2.5, 1) == -2 + -1 + 0
+        assert fn(3, 1) == 0
+
+    def test_for_loop_variable(self):
+        comp = jit.AstCompiler("""
+        def foo(n: int):
+            i = -1
+            for i in range(n):
+                i = i * 10
+            return i
+        """)
+        fn = comp.compile()
+        assert fn(0) == -1
+        assert fn(5) == 40
+
+    def test_break_continue(self):
+        comp = jit.AstCompiler("""
+        def foo(n: int, limit):
+            tot = 0
+            for i in range(n):
+                if i == 3:
+                    continue
+                if tot > limit:
+                    break
+                tot = tot + i
+            j = 0
+            while j < n:
+                j = j + 1
+                if j < 2:
+                    continue
+                tot = tot + 100
+                if j >= 4:
+                    break
+            return tot
+        """)
+        fn = comp.compile()
+        def expected(n, limit):
+            tot = 0
+            for i in range(n):
+                if i == 3:
+                    continue
+                if tot > limit:
+                    break
+                tot = tot + i
+            j = 0
+            while j < n:
+                j = j + 1
+                if j < 2:
+                    continue
+                tot = tot + 100
+                if j >= 4:
+                    break
+            return tot
+        for n in range(8):
+            for limit in (0, 5, 100):
+                assert fn(n, limit) == expected(n, limit), (n, limit)
+
+    def test_break_outside_loop(self):
+        for stmt in ('break', 'continue'):
+            comp = jit.AstCompiler("""
+            def foo(a):
+                if a:
+                    %s
+            """ % stmt)
+            pytest.raises(NotImplementedError, comp.compile)
+
+    def test_vectorized_for(self):
+        comp = jit.AstCompiler("""
+        def foo(a, n: int):
+            tot = 0.0
+            for i in range(n):
+                tot = tot + a[i] * a[i]
+            return tot
+        """)
+        fn = comp.compile()
+        assert 'MULPD' in self.instructions(comp)
+        data = array.array('d', range(11))
+        assert fn(data, 11) == sum(x*x for x in range(11))
+
+    def test_calls(self):
+        comp = jit.AstCompiler("""
+        def foo(a, n: int):
+            tot = 0.0
+            for i in range(n):
+                tot = tot + twice(a[i], 1) * 10
+            clear(a, n)
+            return tot + fib(10)
+
+        def twice(x, k: int):
+            while k > 0:
+                x = x * 2
+                k = k - 1
+            return x
+
+        def clear(b, n: int):
+            for i in range(n):
+                b[i] = 0
+
+        def fib(n):
+            if n < 2:
+                return n
+            return fib(n - 1) + fib(n - 2)
+        """)
+        fn = comp.compile()
+        assert fn.argtypes == ['double*', 'int64_t']
+        assert len(comp.functions) == 4
+        data = array.array('d', [1, 2, 3])
+        assert fn(data, 3) == (2 + 4 + 6) * 10 + 55
+        assert list(data) == [0, 0, 0]
+
+    def test_entry(self):
+        src = """
+        def foo(x):
+            return bar(x) + 1
+
+        def bar(x):
+            if x > 0:
+                return x
+            return 0 - x
+        """
+        assert jit.AstCompiler(src).compile()(-3) == 4
+        comp = jit.AstCompiler(src, entry='bar')
+        assert comp.compile()(-3) == 3
+        assert len(comp.functions) == 1
+        with pytest.raises(ValueError):
+            jit.AstCompiler(src, entry='baz').compile()
+
+    def test_call_saves_registers(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b, n: int):
+            x = a + 1
+            y = b * 2
+            i = n + 1
+            z = x * (y + negate(a, b)) - y
+            return x + y + z + i
+
+        def negate(a, b):
+            if a < b:
+                return 0 - a
+            return 0 - b
+        """)
+        fn = comp.compile()
+        def expected(a, b, n):
+            x = a + 1
+            y = b * 2
+            z = x * (y - min(a, b)) - y
+            return x + y + z + n + 1
+        assert fn(3, 4, 5) == expected(3, 4, 5)
+        assert fn(4, 3, -1) == expected(4, 3, -1)
+
+    def test_call_stack_arguments(self):
+        params = ', '.join('a%d' % i for i in range(11))
+        comp = jit.AstCompiler("""
+        def foo(x):
+            return weighted(x, 1, 2, 3, 4, 5, 6, 7, 8, 9, x + 1)
+
+        def weighted(%s):
+            if a0 > 0:
+                return %s
+            return 0
+        """ % (params, ' + '.join('a%d * %d' % (i, i) for i in range(11))))
+        fn = comp.compile()
+        x = 2.0
+        args = [x, 1, 2, 3, 4, 5, 6, 7, 8, 9, x + 1]
+        assert fn(x) == sum(arg * i for i, arg in enumerate(args))
+
+    def test_inline(self):
+        src = """
+        def foo(a, n: int):
+            tot = 0.0
+            for i in range(n):
+                tot = tot + square(a[i]) + get(a, i)
+            return tot
+
+        def square(x):
+            return x * x
+
+        def get(b, i: int):
+            return b[i]
+        """
+        comp = jit.AstCompiler(src)
+        fn = comp.compile()
+        assert 'CALL' not in self.instructions(comp)
+        assert len(comp.functions) == 3
+        comp2 = jit.AstCompiler(src, optimize=False)
+        fn2 = comp2.compile()
+        assert 'CALL' in self.instructions(comp2)
+        data = array.array('d', [1, 2, 3])
+        assert fn(data, 3) == fn2(data, 3) == 1 + 4 + 9 + 1 + 2 + 3
+
+    def test_call_errors(self):
+        for call, exc in [('bar(x, x)', TypeError),
+                          ('baz(x)', NotImplementedError),
+                          ('bar(x)', NotImplementedError)]:
+            comp = jit.AstCompiler("""
+            def foo(x):
+                return %s
+
+            def bar(n: int):
+                while n > 0:
+                    n = n - 1
+                return n
+            """ % call)
+            pytest.raises(exc, comp.compile)
+
+    def test_sqrt_abs(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b):
+            return sqrt(a) + abs(b) * 10 + math.fabs(a - 100) * 1000
+        """)
+        fn = comp.compile()
+        names = self.instructions(comp)
+        assert 'SQRTSD' in names
+        assert 'ANDPD' in names
+        assert 'CALL' not in names
+        assert fn(16, -3) == 4 + 30 + 84000
+
+    def test_min_max(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b, c):
+            return min(a, b) + max(a, b, c) * 10
+        """)
+        fn = comp.compile()
+        assert fn(1, 2, 3) == 1 + 30
+        assert fn(5, 2, -3) == 2 + 50
+        # like in Python, the first argument wins if they compare equal or
+        # are unordered
+        nan = float('nan')
+        comp = jit.AstCompiler("""
+        def foo(a, b):
+            return min(a, b)
+        """)
+        fn = comp.compile()
+        assert math.copysign(1, fn(-0.0, 0.0)) == -1
+        assert math.copysign(1, fn(0.0, -0.0)) == 1
+        assert math.isnan(fn(nan, 1))
+        assert fn(1, nan) == 1
+
+    def test_int_builtins(self):
+        comp = jit.AstCompiler("""
+        def foo(n: int, k: int):
+            i = abs(n) + min(n, k, 3) * 10 + max(n, 5) * 100
+            return i
+        """)
+        fn = comp.compile()
+        assert 'CMOVG' in self.instructions(comp)
+        for n, k in [(-7, 2), (7, -2), (0, 0)]:
+            assert fn(n, k) == abs(n) + min(n, k, 3) * 10 + max(n, 5) * 100
+
+    @pytest.mark.parametrize('features', [None, frozenset()])
+    def test_floor_ceil(self, features, monkeypatch):
+        if features is not None:
+            monkeypatch.setattr(cpu, 'features', lambda: features)
+        comp = jit.AstCompiler("""
+        def foo(a, b):
+            i = floor(a) * 100 + math.ceil(b)
+            return i
+        """)
+        fn = comp.compile()
+        names = self.instructions(comp)
+        if features is None and 'sse4_1' in cpu.features():
+            assert 'ROUNDSD' in names
+        else:
+            assert 'ROUNDSD' not in names
+        for a, b in [(1.5, 2.5), (-1.5, -2.5), (3, -4), (-0.5, 0.5)]:
+            expected = math.floor(a) * 100 + math.ceil(b)
+            assert fn(a, b) == expected, (a, b)
+
+    def test_libm(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b, n: int):
+            x = a * 2
+            i = n + 1
+            y = exp(a) + math.atan2(a, b) * x + pow(b, 2) + i
+            return y + x + i
+        """)
+        fn = comp.compile()
+        assert 'CALL' in self.instructions(comp)
+        a, b, n = 0.5, -2.0, 3
+        x = a * 2
+        y = math.exp(a) + math.atan2(a, b) * x + math.pow(b, 2) + n + 1
+        assert fn(a, b, n) == y + x + n + 1
+
+    def test_builtins_in_functions(self):
+        comp = jit.AstCompiler("""
+        def foo(a, n: int):
+            tot = 0.0
+            for i in range(n - 1):
+                tot = tot + dist(a[i], a[i+1]) + log(a[i])
+            return tot
+
+        def dist(x, y):
+            return sqrt((x - y) * (x - y))
+        """)
+        fn = comp.compile()
+        data = array.array('d', [1, 4, 2])
+        expected = 3 + 2 + math.log(1) + math.log(4)
+        assert abs(fn(data, 3) - expected) < 1e-12
+
+    def test_numpy_array(self):
+        numpy = pytest.importorskip('numpy')
+        comp = jit.AstCompiler("""
+        def foo(a, n):
+            i = 0
+            while i < n:
+                a[i] = a[i] * a[i]
+                i = i + 1
+        """)
+        fn = comp.compile()
+        a = numpy.arange(5, dtype=numpy.float64)
+        fn(a, len(a))
+        assert list(a) == [0, 1, 4, 9, 16]
+
 
 class TestDecorator:
 
@@ -118,3 +978,649 @@ class TestDecorator:
             return a+b
         assert type(foo) is jit.CompiledFunction
         assert foo(39, 3) == 42.0
+
+    def test_options(self):
+        @jit.compile(optimize=False)
+        def foo(a):
+            return a * 1
+        assert type(foo) is jit.CompiledFunction
+        assert foo(42) == 42.0
+
+    def test_helpers(self):
+        @jit.compile
+        def foo(a, b):
+            return helper(a) + helper(b)
+        assert foo(1, 2) == (1 + 2 - 1) + (4 + 5 - 1)
+
+    def test_memoize(self):
+        src = textwrap.dedent("""
+        def foo(a, b):
+            return a+b
+        """)
+        cache = jit.compile_cache
+        hits = cache.hits
+        fn1 = jit.compile_source(src)
+        fn2 = jit.compile_source(src)
+        assert fn1 is fn2
+        assert cache.hits == hits + 1
+        fn3 = jit.compile_source(src, optimize=False)
+        assert fn3 is not fn1
+
+
+class TestCompileCache:
+
+    ADD = b'\xf2\x0f\x58\xc1\xc3' # addsd  xmm0,xmm1 ; ret
+
+    def make(self):
+        return jit.CompiledFunction(2, self.ADD)
+
+    def test_free(self):
+        fn = self.make()
+        assert fn(1, 2) == 3
+        fn.free()
+        assert fn.size == 0
+        with pytest.raises(RuntimeError):
+            fn(1, 2)
+        fn.free() # freeing twice is harmless
+
+    def test_get_put(self):
+        cache = jit.CompileCache()
+        key = cache.key('def foo(a, b): return a+b', {'optimize': True})
+        assert cache.get(key) is None
+        fn = self.make()
+        cache.put(key, fn)
+        assert cache.get(key) is fn
+        assert cache.stats() == dict(entries=1, bytes=fn.size, hits=1,
+                                     misses=1, evictions=0)
+
+    def test_lru_eviction(self):
+        cache = jit.CompileCache(max_entries=2)
+        fns = [self.make() for i in range(3)]
+        cache.put('a', fns[0])
+        cache.put('b', fns[1])
+        assert cache.get('a') is fns[0] # 'b' is now the least recently used
+        cache.put('c', fns[2])
+        assert cache.get('b') is None
+        assert cache.evictions == 1
+        # evicted, but still usable
+        assert fns[1](1, 2) == 3
+        assert fns[0](1, 2) == 3
+        assert fns[2](1, 2) == 3
+
+    def test_max_bytes(self):
+        fn = self.make()
+        cache = jit.CompileCache(max_bytes=fn.size)
+        cache.put('a', fn)
+        fn2 = self.make()
+        cache.put('b', fn2)
+        assert cache.get('a') is None
+        assert cache.get('b') is fn2
+        assert cache.nbytes == fn2.size
+
+    def test_clear(self):
+        cache = jit.CompileCache()
+        fn = self.make()
+        cache.put('a', fn)
+        cache.clear()
+        assert cache.get('a') is None
+        assert cache.nbytes == 0
+        assert fn(1, 2) == 3
+
+    def test_eviction_releases_code(self, monkeypatch):
+        arena = jit.CodeArena(chunk_size=4*PAGE, consts_size=PAGE)
+        monkeypatch.setattr(jit, 'code_arena', arena)
+        # each function takes a chunk of its own
+        code = b'\x90' * (2*PAGE) + self.ADD
+        cache = jit.CompileCache(max_entries=1)
+        cache.put('a', jit.CompiledFunction(2, code))
+        mapped = arena.stats()['mapped']
+        cache.put('b', jit.CompiledFunction(2, code))
+        assert cache.evictions == 1
+        # 'a' is no longer referenced, so its chunk is unmapped
+        assert arena.stats()['mapped'] == mapped
+        assert arena.stats()['functions'] == 1
+
+    def test_evicted_function_still_works(self, monkeypatch):
+        monkeypatch.setattr(jit, 'compile_cache',
+                            jit.CompileCache(max_entries=2))
+        @jit.compile
+        def kernel(a, b):
+            return a * b
+        for k in range(3):
+            jit.compile_source('def foo(a):\n    return a + %d\n' % k)
+        assert jit.compile_cache.evictions == 2
+        assert kernel(3, 4) == 12
+
+
+class TestCompileMany:
+
+    ADD = b'\xf2\x0f\x58\xc1\xc3' # addsd  xmm0,xmm1 ; ret
+    SUB = b'\xf2\x0f\x5c\xc1\xc3' # subsd  xmm0,xmm1 ; ret
+
+    @pytest.fixture(autouse=True)
+    def caches(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(jit, 'disk_cache', jit.DiskCache(str(tmpdir)))
+        monkeypatch.setattr(jit, 'compile_cache', jit.CompileCache())
+
+    def fake_compile(self, monkeypatch):
+        def compile_entry(src, options):
+            if 'add' in src:
+                code = self.ADD
+            elif 'sub' in src:
+                code = self.SUB
+            else:
+                raise NotImplementedError(src.split('(')[0])
+            entry = 2, code, ['double', 'double'], b'', []
+            return entry, jit.CompileStats(jit.entry_name(src, options))
+        monkeypatch.setattr(jit, '_compile_entry', compile_entry)
+
+    def test_compile_many(self):
+        def foo(a, b):
+            return a + b
+        def bar(a):
+            return foo(a, a) * 2
+        src = 'def baz(a, b):\n    return a - b\n'
+        fns = jit.compile_many([foo, bar, src, foo], processes=2)
+        assert fns[0](1, 2) == 3
+        assert fns[1](5) == 20
+        assert fns[2](5, 3) == 2
+        assert fns[3] is fns[0]
+        assert jit.compile(foo) is fns[0]
+        assert jit.compile_many([src]) == [fns[2]]
+
+    def test_serial(self, monkeypatch):
+        self.fake_compile(monkeypatch)
+        add, sub = jit.compile_many(['def add(a, b): ...',
+                                     'def sub(a, b): ...'], processes=1)
+        assert add(1, 2) == 3
+        assert sub(1, 2) == -1
+
+    def test_caches(self, monkeypatch):
+        src = 'def add(a, b): ...'
+        jit.disk_cache.put(jit.disk_cache.key(src, dict(optimize=True,
+                                                        vectorize=True)),
+                           2, self.ADD, ['double', 'double'])
+        def broken(src, options):
+            raise AssertionError('the cache was not used')
+        monkeypatch.setattr(jit, '_compile_entry', broken)
+        fn1, fn2 = jit.compile_many([src, src])
+        assert fn1 is fn2
+        assert fn1(1, 2) == 3
+        assert jit.compile_many([src]) == [fn1]
+        assert jit.compile_cache.hits == 1
+
+    def test_errors(self, monkeypatch):
+        self.fake_compile(monkeypatch)
+        srcs = ['def foo(a): ...', 'def add(a, b): ...', 'def bar(a): ...']
+        with pytest.raises(jit.CompileError) as exc:
+            jit.compile_many(srcs, processes=1)
+        assert [(src, str(e)) for src, e in exc.value.errors] == [
+            (srcs[0], 'def foo'), (srcs[2], 'def bar')]
+        assert str(exc.value).splitlines() == [
+            '2 function(s) failed to compile:',
+            '  def foo(a): ...: NotImplementedError: def foo',
+            '  def bar(a): ...: NotImplementedError: def bar']
+        # the functions which compiled are cached
+        assert jit.compile_source(srcs[1])(1, 2) == 3
+
+    def test_errors_in_processes(self):
+        def foo(a):
+            return a
+        def bar(a):
+            while a:
+                pass
+            else:
+                pass
+            return a
+        with pytest.raises(jit.CompileError) as exc:
+            jit.compile_many([bar, foo, bar], processes=2)
+        errors = exc.value.errors
+        assert [fn for fn, e in errors] == [bar, bar]
+        assert all(isinstance(e, NotImplementedError) for fn, e in errors)
+        assert 'bar: NotImplementedError' in str(exc.value)
+
+
+class TestCompileStats:
+
+    @pytest.fixture(autouse=True)
+    def totals(self, monkeypatch):
+        monkeypatch.setattr(jit, 'compile_cache', None)
+        monkeypatch.setattr(jit.compilestats, 'totals',
+                            jit.compilestats.Totals())
+
+    def test_stats(self):
+        def foo(a, b):
+            return helper(a) + b
+        seen = []
+        jit.compilestats.add_hook(seen.append)
+        try:
+            fn = jit.compile(foo)
+        finally:
+            jit.compilestats.remove_hook(seen.append)
+        stats = fn.stats
+        assert seen == [stats]
+        assert stats.name == 'foo'
+        assert not stats.cached
+        assert stats.functions == 3 # foo, helper and square_plus_one
+        assert stats.instructions > 0
+        assert 0 < stats.code_size + stats.consts_size <= fn.size
+        assert 'xmm0' in stats.registers
+        for phase in ('parse', 'optimize', 'lower', 'codegen', 'encode',
+                      'link', 'load'):
+            assert stats.times[phase] > 0
+        totals = jit.compile_stats()
+        assert totals['compilations'] == 1
+        assert totals['code_size'] == stats.code_size
+        assert totals['times'] == stats.times
+
+    def test_compiler(self):
+        comp = jit.AstCompiler("""
+            def foo(a, b):
+                return a + b
+        """, optimize=False)
+        fn = comp.compile()
+        assert fn.stats is comp.stats
+        assert comp.stats.times['optimize'] == 0
+        assert comp.stats.times['load'] > 0
+        assert comp.stats.instructions >= 3 # ADDSD, MOVSD, RET
+
+    def test_disk_cache(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(jit, 'disk_cache', jit.DiskCache(str(tmpdir)))
+        src = 'def add(a, b): ...'
+        code = b'\xf2\x0f\x58\xc1\xc3' # addsd  xmm0,xmm1 ; ret
+        jit.disk_cache.put(jit.disk_cache.key(src, {}), 2, code,
+                           ['double', 'double'], b'\0' * 8)
+        fn = jit.compile_source(src)
+        assert fn(1, 2) == 3
+        assert fn.stats.name == 'add'
+        assert fn.stats.cached
+        assert fn.stats.code_size == 5
+        assert fn.stats.consts_size == 8
+        assert fn.stats.total_time == fn.stats.times['load'] > 0
+        assert jit.compile_stats()['cached'] == 1
+
+    def test_raw(self):
+        fn = jit.CompiledFunction(2, b'\xc3')
+        assert fn.stats is None
+
+    def test_entry_name(self):
+        assert jit.entry_name('def foo(a):\n  def bar(): ...', {}) == 'foo'
+        assert jit.entry_name('\n    def foo(a): ...', {}) == 'foo'
+        assert jit.entry_name('def foo(a): ...', {'entry': 'bar'}) == 'bar'
+
+
+class TestDebugInfo:
+
+    ADD = b'\xf2\x0f\x58\xc1\xc3' # addsd  xmm0,xmm1 ; ret
+
+    @pytest.fixture
+    def perf_map(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(jit, 'compile_cache', None)
+        path = tmpdir.join('perf.map')
+        yield path
+        jit.perfmap.disable()
+
+    def test_perf_map(self, perf_map):
+        jit.perfmap.enable(str(perf_map))
+        fn = jit.CompiledFunction(2, self.ADD)
+        assert fn.symbols == [(0, 5, 'jit30min')]
+        assert perf_map.read() == '%x 5 jit30min:jit30min\n' % (
+            fn.block.address)
+
+    def test_line_markers(self, perf_map):
+        jit.perfmap.enable(str(perf_map), lines=True)
+        marker = b'\x48\xb8' + (jit.perfmap.LINE_MARKER + 2).to_bytes(8,
+                                                                   'little')
+        fn = jit.CompiledFunction(2, marker + self.ADD,
+                                  symbols=[(0, 15, 'add')], line_markers=True)
+        assert fn(1, 2) == 3 # the marker is now a NOP
+        assert fn.lines == [(0, 15, 'add', 2)]
+        assert perf_map.read() == '%x f jit30min:add:+2\n' % (
+            fn.block.address)
+
+    def test_no_line_markers(self, perf_map):
+        # code compiled without lines=True is never scanned for markers,
+        # even if some bytes happen to look like one
+        jit.perfmap.enable(str(perf_map), lines=True)
+        marker = b'\x48\xb8' + (jit.perfmap.LINE_MARKER + 2).to_bytes(8,
+                                                                   'little')
+        code = marker + self.ADD
+        fn = jit.CompiledFunction(2, code, symbols=[(0, 15, 'add')])
+        assert jit.ffi.buffer(jit.ffi.cast('char*', fn.block.address),
+                              15)[:] == code
+        assert fn.lines == []
+
+    def test_compiled_lines(self, perf_map):
+        jit.perfmap.enable(str(perf_map), lines=True)
+        def foo(a, b):
+            c = a + b
+            d = helper(c)
+            return d * 2
+        fn = jit.compile(foo)
+        assert fn(1, 2) == 2 * helper(3)
+        assert [name for _, _, name in fn.symbols] == [
+            'foo', 'helper', 'square_plus_one']
+        # the lines are counted from the def
+        foo_lines = [line for _, _, name, line in fn.lines if name == 'foo']
+        assert foo_lines == sorted(foo_lines)
+        assert set(foo_lines) <= {1, 2, 3}
+        assert foo_lines[-1] == 3
+        text = perf_map.read()
+        assert 'jit30min:foo:+3\n' in text
+        assert 'jit30min:helper:+1\n' in text
+        # the markers are part of the cache key
+        jit.perfmap.disable()
+        fn2 = jit.compile(foo)
+        assert fn2.lines == []
+        assert fn2.size < fn.size
+
+    def test_gdb(self):
+        try:
+            jit.gdbjit.enable()
+        except Exception as e:
+            pytest.skip('cannot build the gdb helper: %s' % e)
+        try:
+            fn = jit.CompiledFunction(2, self.ADD, symbols=[(0, 5, 'add')])
+        finally:
+            jit.gdbjit.disable()
+        desc = jit.gdbjit._descriptor
+        entry = fn._gdb_entry.entry
+        assert desc.first_entry == entry
+        fn.free()
+        assert fn._gdb_entry is None
+        assert desc.first_entry != entry
+
+
+class TestProfile:
+
+    # mov rax, [rip+consts]; add qword [rax], 1; ret
+    COUNT = b'\x48\x8b\x05\x00\x00\x00\x00\x48\x83\x00\x01\xc3'
+
+    def test_counters(self):
+        fn = jit.CompiledFunction(0, self.COUNT, consts=bytes(8),
+                                  relocs=[(3, -7)],
+                                  links=[(0, 'counters', 0)],
+                                  counters=[('foo', 1, 'taken')])
+        assert fn.profile() == {('foo', 1): {'taken': 0}}
+        fn()
+        fn()
+        assert fn.profile() == {('foo', 1): {'taken': 2}}
+        fn.reset_profile()
+        assert fn.profile() == {('foo', 1): {'taken': 0}}
+
+    def test_not_instrumented(self):
+        fn = jit.CompiledFunction(0, b'\xc3')
+        with pytest.raises(ValueError):
+            fn.profile()
+        assert jit.CompiledFunction(0, b'\xc3', counters=[]).profile() == {}
+
+    def test_compiled(self):
+        @jit.compile(instrument=True)
+        def foo(n: int):
+            tot = 0.0
+            for i in range(n):
+                if i < 3:
+                    tot = tot + 1.0
+                else:
+                    tot = tot + 0.5
+            j = 0
+            while j < n:
+                if j > 6:
+                    break
+                j = j + 1
+            return tot
+        assert foo(10) == 3 + 3.5
+        # the lines are counted from the def
+        prof = foo.profile()
+        assert set(prof) == {('foo', 2), ('foo', 3), ('foo', 8), ('foo', 9)}
+        loop = prof['foo', 2]
+        assert loop['entries'] == 1
+        assert loop['iterations'] == 10
+        assert loop['cycles'] > 0
+        assert prof['foo', 3] == {'taken': 3, 'not_taken': 7}
+        assert prof['foo', 8]['iterations'] == 8
+        assert prof['foo', 9] == {'taken': 1, 'not_taken': 7}
+        foo(10)
+        assert foo.profile()['foo', 2]['entries'] == 2
+
+    def test_return_in_loop(self):
+        @jit.compile(instrument=True)
+        def foo(a, n: int):
+            for i in range(n):
+                for j in range(n):
+                    if a[j] > i:
+                        return a[j]
+            return 0
+        a = array.array('d', [0, 0, 5])
+        assert foo(a, 3) == 5
+        prof = foo.profile()
+        assert prof['foo', 1]['entries'] == 1
+        assert prof['foo', 2]['iterations'] == 3
+        # the cycles are added back when returning from inside the loops
+        assert 0 < prof['foo', 2]['cycles'] <= prof['foo', 1]['cycles']
+
+    def test_helpers(self):
+        def count(n: int):
+            k = 0
+            for i in range(n):
+                k = k + 1
+            return k
+        def foo(n: int):
+            return count(n) + count(2*n)
+        fn = jit.compile_source(jit.getsource(foo) + '\n' +
+                                jit.getsource(count), instrument=True)
+        assert fn(3) == 9
+        assert fn.profile()['count', 2]['iterations'] == 9
+
+    def test_cache_key(self):
+        def foo(n: int):
+            for i in range(n):
+                pass
+            return n
+        assert jit.compile(foo).counters is None
+        assert jit.compile(foo, instrument=True).counters
+
+
+class TestTiered:
+
+    def test_interpreted(self):
+        @jit.tiered(threshold=100)
+        def foo(a, b):
+            return a+b
+        assert foo(39, 3) == 42
+        assert foo.counter == 1
+        assert foo.compiled is None
+        assert foo.wait() is None
+        assert foo.__name__ == 'foo'
+
+    def test_compile_after_calls(self):
+        @jit.tiered(threshold=3)
+        def foo(a, b):
+            return a+b
+        for i in range(3):
+            assert foo(39, 3) == 42
+        fn = foo.wait()
+        assert type(fn) is jit.CompiledFunction
+        assert foo(39, 3) == 42.0
+        assert foo.counter == 3
+
+    def test_loop_iterations(self):
+        @jit.tiered(threshold=10)
+        def foo(n):
+            i = 0
+            tot = 0
+            while i < n:
+                tot = tot + i
+                i = i + 1
+            return tot
+        assert foo(20) == 190
+        assert foo.counter == 21
+        assert type(foo.wait()) is jit.CompiledFunction
+        assert foo(20) == 190.0
+
+    def test_cannot_compile(self):
+        @jit.tiered(threshold=1)
+        def foo(a, b):
+            return a % b
+        with pytest.warns(RuntimeWarning):
+            assert foo(7, 4) == 3
+            assert foo.wait() is None
+        assert foo.error is not None
+        assert foo(7, 4) == 3
+
+    def test_keyword_arguments(self):
+        @jit.tiered(threshold=2)
+        def foo(a, b, c=10):
+            return a - b + c
+        assert foo(5, b=3) == 12
+        assert foo(b=3, a=5, c=1) == 3
+        assert type(foo.wait()) is jit.CompiledFunction
+        assert foo(5, b=3) == 12
+        assert foo(b=3, a=5, c=1) == 3
+        assert foo(5, 3, 1) == 3
+        with pytest.raises(TypeError):
+            foo(5, d=3)
+
+    def test_helper_defined_after(self, monkeypatch):
+        @jit.tiered(threshold=100)
+        def foo(x):
+            return helper(x) + global_helper(x)
+        def helper(x):
+            return x * 2
+        monkeypatch.setitem(globals(), 'global_helper', lambda x: x + 1)
+        assert foo(3) == 10
+
+    def test_closure(self):
+        k = 3
+        @jit.tiered(threshold=100)
+        def foo(n):
+            tot = 0
+            for i in range(n):
+                tot = tot + k
+            return tot
+        assert foo(4) == 12
+        assert foo.counter == 5
+        k = 5
+        assert foo(1) == 5
+
+
+class TestMap:
+
+    ADD = b'\xf2\x0f\x58\xc1\xc3' # addsd  xmm0,xmm1 ; ret
+
+    def test_map(self):
+        fn = jit.CompiledFunction(2, self.ADD)
+        a = array.array('d', range(10))
+        b = array.array('d', range(100, 110))
+        assert list(fn.map(a, b)) == [x+y for x, y in zip(a, b)]
+        assert list(fn.map(a[:0], b[:0])) == []
+
+    def test_broadcast(self):
+        fn = jit.CompiledFunction(2, self.ADD)
+        a = array.array('d', range(10))
+        assert list(fn.map(a, 0.5)) == [x+0.5 for x in a]
+        assert list(fn.map(1, a)) == [x+1 for x in a]
+
+    def test_out(self):
+        fn = jit.CompiledFunction(2, self.ADD)
+        a = array.array('d', range(10))
+        out = array.array('d', [0]*10)
+        assert fn.map(a, a, out=out) is out
+        assert list(out) == [2*x for x in a]
+        out = array.array('d', [0]*3)
+        assert list(fn.map(1, 2, out=out)) == [3, 3, 3]
+
+    def test_errors(self):
+        fn = jit.CompiledFunction(2, self.ADD)
+        a = array.array('d', range(10))
+        with pytest.raises(ValueError):
+            fn.map(a, a[:3])
+        with pytest.raises(ValueError):
+            fn.map(a, a, out=array.array('d', [0]))
+        with pytest.raises(TypeError):
+            fn.map(1, 2)
+        with pytest.raises(TypeError):
+            fn.map(a)
+        with pytest.raises(TypeError):
+            fn.map(a, array.array('i', range(10)))
+        fn.free()
+        with pytest.raises(RuntimeError):
+            fn.map(a, a)
+
+    def test_many_arguments(self):
+        # xmm0 += xmm1 + ... + xmm7 + [rsp+8] + ... + [rsp+32]; ret
+        code = (b''.join(b'\xf2\x0f\x58' + bytes([0xc0 | k])
+                         for k in range(1, 8)) +
+                b''.join(b'\xf2\x0f\x58\x44\x24' + bytes([8 + 8*j])
+                         for j in range(4)) +
+                b'\xc3')
+        fn = jit.CompiledFunction(12, code)
+        assert fn(*range(12)) == 66
+        args = [array.array('d', [k, 10*k]) for k in range(12)]
+        assert list(fn.map(*args)) == [66, 660]
+        assert list(fn.map(*args[:11], 100)) == [155, 650]
+
+    def test_compiled(self):
+        @jit.compile
+        def foo(a, b, c):
+            if a < b:
+                return c
+            return a*b
+        a = array.array('d', [1, 5, 3])
+        assert list(foo.map(a, 3, 42)) == [42, 15, 9]
+
+
+class TestParallel:
+
+    ADD = b'\xf2\x0f\x58\xc1\xc3' # addsd  xmm0,xmm1 ; ret
+    # (int64_t lo, int64_t hi) -> hi - lo
+    LENGTH = (b'\x48\x89\xf0'       # mov rax, rsi
+              b'\x48\x29\xf8'       # sub rax, rdi
+              b'\xf2\x48\x0f\x2a\xc0' # cvtsi2sd xmm0, rax
+              b'\xc3')               # ret
+
+    def test_split(self):
+        assert jit.split(0, 10, 3) == [(0, 3), (3, 6), (6, 10)]
+        assert jit.split(5, 7, 4) == [(5, 6), (6, 7)]
+        assert jit.split(0, 0, 4) == [(0, 0)]
+        assert jit.split(3, 1, 4) == [(3, 3)]
+        chunks = jit.split(-7, 1000, 8)
+        assert len(chunks) == 8
+        assert [x for lo, hi in chunks for x in range(lo, hi)] == \
+            list(range(-7, 1000))
+
+    def test_parallel_map(self, monkeypatch):
+        monkeypatch.setattr(jit.CompiledFunction, 'MIN_CHUNK_SIZE', 3)
+        fn = jit.CompiledFunction(2, self.ADD)
+        a = array.array('d', range(100))
+        b = array.array('d', range(100, 200))
+        expected = list(fn.map(a, b))
+        for nthreads in (1, 2, 7, 100, 1000):
+            assert list(fn.parallel_map(a, b, nthreads=nthreads)) == expected
+        assert list(fn.parallel_map(a, 0.5, nthreads=4)) == [x+0.5 for x in a]
+        out = array.array('d', [0]*100)
+        assert fn.parallel_map(a, a, out=out, nthreads=4) is out
+        assert list(out) == [2*x for x in a]
+        assert list(fn.parallel_map(a[:0], b[:0])) == []
+
+    def test_parallel_reduce(self):
+        fn = jit.CompiledFunction(2, self.LENGTH,
+                                  argtypes=['int64_t', 'int64_t'])
+        for nthreads in (1, 3, 1000):
+            assert fn.parallel_reduce(10, 1010, nthreads=nthreads) == 1000
+        assert fn.parallel_reduce(5, 5) == 0
+        assert fn.parallel_reduce(0, 100, nthreads=4, combine=max) == 25
+        fn.free()
+        with pytest.raises(RuntimeError):
+            fn.parallel_reduce(0, 10)
+
+    def test_compiled(self):
+        @jit.compile
+        def partial_sum(lo: int, hi: int, a):
+            tot = 0.0
+            for i in range(lo, hi):
+                tot = tot + a[i]
+            return tot
+        a = array.array('d', range(10000))
+        assert partial_sum.parallel_reduce(0, len(a), a) == sum(a)
+        assert partial_sum.parallel_reduce(0, len(a), a, nthreads=3) == sum(a)
@@ -0,0 +1,8 @@
+import math
+import libm
+
+class TestLibm:
+
+    def test_address(self):
+        exp = libm.ffi.cast('double(*)(double)', libm.address('exp'))
+        assert exp(1.0) == math.exp(1.0)
@@ -0,0 +1,66 @@
+import struct
+import pytest
+import libm
+import linking
+from assembler import FunctionAssembler, link
+
+
+class TestLinking:
+
+    def test_placeholder(self):
+        value = linking.placeholder('libm', 3)
+        assert linking.decode(value) == ('libm', 3)
+        assert linking.decode(linking.placeholder('counters')) == (
+            'counters', 0)
+        for x in [0.0, 1.5, -2.0, float('nan'), float('inf')]:
+            value, = struct.unpack('<Q', struct.pack('<d', x))
+            assert linking.decode(value) is None
+        assert linking.decode(0xffffffffffffffff) is None
+
+    def test_resolve(self):
+        consts = struct.pack('<dQdQ', 1.5, 0, 2.5, 0)
+        links = [(8, 'libm', libm.NAMES.index('sin')), (24, 'counters', 0)]
+        a, sin, b, counters = struct.unpack(
+            '<dQdQ', linking.resolve(consts, links, 0x1234))
+        assert (a, b) == (1.5, 2.5)
+        assert sin == libm.address('sin')
+        assert counters == 0x1234
+        assert linking.resolve(consts, []) is consts
+        with pytest.raises(ValueError):
+            linking.resolve(consts, [(0, 'call', 1)])
+
+    def test_assemble(self):
+        asm = FunctionAssembler('foo', ['x'], encoder='direct')
+        asm.prologue(0, makes_calls=True)
+        asm.call_extern('sin')
+        asm.call_extern('sin')
+        asm.call(1)
+        asm.count(0)
+        asm.epilogue()
+        code, consts, relocs, links = asm.assemble()
+        # one link for each constant, and one for each call to the module
+        kinds = sorted(kind for offset, kind, arg in links)
+        assert kinds == ['call', 'counters', 'libm']
+        for offset, kind, arg in links:
+            if kind == 'call':
+                assert code[offset-2:offset] == b'\xff\x15'
+            else:
+                value, = struct.unpack_from('<Q', consts, offset)
+                assert linking.decode(value) == (kind, arg)
+
+    def test_link(self):
+        functions = []
+        for name in ['foo', 'bar']:
+            asm = FunctionAssembler(name, [], encoder='direct')
+            asm.prologue(0, makes_calls=True)
+            asm.call_extern('cos')
+            asm.call(1)
+            asm.epilogue()
+            functions.append(asm.assemble())
+        code, consts, relocs, links, offsets = link(functions)
+        # the calls are resolved, the libm constants are left to resolve()
+        assert [kind for offset, kind, arg in links] == ['libm', 'libm']
+        for offset, kind, arg in links:
+            value, = struct.unpack_from('<Q', consts, offset)
+            assert linking.decode(value) == ('libm', libm.NAMES.index('cos'))
+        assert code.count(b'\xff\x15') == 2 # CALL [rip+x] to cos
@@ -0,0 +1,110 @@
+import ast
+import textwrap
+import pytest
+from lowering import lower, RangeLoop
+
+def lower_src(src):
+    tree = lower(ast.parse(textwrap.dedent(src)))
+    return tree.body[0]
+
+def dump(stmts):
+    lines = []
+    for stmt in stmts:
+        if isinstance(stmt, RangeLoop):
+            lines.append('while %s:' % ast.unparse(stmt.test))
+            lines += ['    ' + line for line in dump(stmt.body)]
+        else:
+            lines.append(ast.unparse(stmt))
+    return lines
+
+class TestLowering:
+
+    def test_range(self):
+        funcdef = lower_src("""
+        def foo(a, n):
+            for i in range(n):
+                a[i] = i
+        """)
+        assert dump(funcdef.body) == [
+            'for1.stop = int(n)',
+            'i = 0',
+            'while i < for1.stop:',
+            '    a[i] = i',
+            '    i = i + 1',
+            ]
+
+    def test_start_step(self):
+        funcdef = lower_src("""
+        def foo(a, n):
+            for i in range(n, 0, -2):
+                a[i] = i
+        """)
+        assert dump(funcdef.body) == [
+            'i = int(n)',
+            'while i > 0:',
+            '    a[i] = i',
+            '    i = i + -2',
+            ]
+
+    def test_counter(self):
+        # i is read after the loop, so it must not be incremented past the
+        # last value
+        funcdef = lower_src("""
+        def foo(n):
+            for i in range(10):
+                pass
+            return i
+        """)
+        assert dump(funcdef.body) == [
+            'for1.next = 0',
+            'while for1.next < 10:',
+            '    i = for1.next',
+            '    pass',
+            '    for1.next = for1.next + 1',
+            'return i',
+            ]
+
+    def test_nested(self):
+        funcdef = lower_src("""
+        def foo(n):
+            for i in range(3):
+                for j in range(i):
+                    pass
+            for i in range(2):
+                pass
+        """)
+        assert dump(funcdef.body) == [
+            'i = 0',
+            'while i < 3:',
+            '    for1.stop = int(i)',
+            '    j = 0',
+            '    while j < for1.stop:',
+            '        pass',
+            '        j = j + 1',
+            '    i = i + 1',
+            'i = 0',
+            'while i < 2:',
+            '    pass',
+            '    i = i + 1',
+            ]
+
+    def test_unsupported(self):
+        for loop in ('for i in range(n, 1, 0)',
+                     'for i in range(0, n, n)',
+                     'for i in range(0, n, 1.5)',
+                     'for i in n',
+                     'for i, j in range(n)'):
+            with pytest.raises(NotImplementedError):
+                lower_src("""
+                def foo(n):
+                    %s:
+                        pass
+                """ % loop)
+        with pytest.raises(NotImplementedError):
+            lower_src("""
+            def foo(n):
+                for i in range(n):
+                    pass
+                else:
+                    pass
+            """)
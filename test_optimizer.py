@@ -0,0 +1,120 @@
+import ast
+import textwrap
+from optimizer import optimize
+
+def body(src):
+    tree = optimize(ast.parse(textwrap.dedent(src)))
+    return tree.body[0].body
+
+def retval(src):
+    stmts = body(src)
+    assert isinstance(stmts[-1], ast.Return)
+    return stmts[-1].value
+
+
+class TestConstantFolding:
+
+    def test_fold(self):
+        value = retval("""
+        def foo():
+            return (1 + 2) * 3 - 4 / 2
+        """)
+        assert isinstance(value, ast.Num)
+        assert value.n == 7.0
+
+    def test_fold_unary(self):
+        value = retval("""
+        def foo():
+            return -(2 * 3)
+        """)
+        assert value.n == -6
+
+    def test_division_by_zero(self):
+        value = retval("""
+        def foo():
+            return 1 / 0
+        """)
+        assert isinstance(value, ast.BinOp)
+
+    def test_identities(self):
+        value = retval("""
+        def foo(x):
+            return (1 * x * 1 - 0) / 1
+        """)
+        assert isinstance(value, ast.Name)
+        assert value.id == 'x'
+
+    def test_unsafe_identities(self):
+        # -0.0 + 0 == 0.0 and x*0 is not 0 if x is NaN or infinite
+        for expr in ('x + 0', 'x * 0', '0 - x', 'x * 1.0'):
+            value = retval("""
+            def foo(x):
+                return %s
+            """ % expr)
+            assert isinstance(value, ast.BinOp)
+
+    def test_division_by_power_of_two(self):
+        value = retval("""
+        def foo(x):
+            return x / 4
+        """)
+        assert isinstance(value.op, ast.Mult)
+        assert value.right.n == 0.25
+        #
+        value = retval("""
+        def foo(x):
+            return x / 3
+        """)
+        assert isinstance(value.op, ast.Div)
+
+
+class TestConstantPropagation:
+
+    def test_propagate(self):
+        stmts = body("""
+        def foo(x):
+            a = 2
+            b = a * 3
+            return x * b
+        """)
+        assert len(stmts) == 1
+        assert stmts[0].value.right.n == 6
+
+    def test_assigned_twice(self):
+        stmts = body("""
+        def foo(x):
+            a = 2
+            while x < 10:
+                a = a + 1
+                x = x + 1
+            return a
+        """)
+        assert len(stmts) == 3
+
+    def test_for_target(self):
+        stmts = body("""
+        def foo(x):
+            i = 0
+            for i in range(3):
+                x = x + i
+            return i
+        """)
+        assert len(stmts) == 3
+        assert isinstance(stmts[-1].value, ast.Name)
+
+    def test_conditional_assignment(self):
+        stmts = body("""
+        def foo(x):
+            if x < 0:
+                a = 2
+            return a
+        """)
+        assert isinstance(stmts[-1].value, ast.Name)
+
+    def test_arguments(self):
+        stmts = body("""
+        def foo(a):
+            a = 2
+            return a
+        """)
+        assert len(stmts) == 2
@@ -0,0 +1,73 @@
+from peephole import optimize
+
+# the passes compare the operands by identity, like the registers and
+# labels of encoder.py
+class Operand:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+xmm0, xmm1, rax, rcx = [Operand(name) for name in
+                        ('xmm0', 'xmm1', 'rax', 'rcx')]
+L1, L2, L3 = [Operand(name) for name in ('L1', 'L2', 'L3')]
+
+
+class TestPeephole:
+
+    def test_push_pop(self):
+        code = [('pushsd', (xmm0,)), ('popsd', (xmm1,)),
+                ('push', (rax,)), ('pop', (rax,)),
+                ('RET', ())]
+        assert optimize(code) == [('MOVSD', (xmm1, xmm0)), ('RET', ())]
+
+    def test_push_pop_not_adjacent(self):
+        code = [('pushsd', (xmm0,)), ('ADDSD', (xmm0, xmm1)),
+                ('popsd', (xmm0,)), ('RET', ())]
+        assert optimize(code) == code
+
+    def test_redundant_moves(self):
+        code = [('MOVSD', (xmm0, xmm0)), ('MOV', (rax, rax)),
+                ('MOV', (rax, rcx)), ('RET', ())]
+        assert optimize(code) == [('MOV', (rax, rcx)), ('RET', ())]
+
+    def test_jump_to_next(self):
+        code = [('CMP', (rax, rcx)), ('JE', (L1,)), ('ALIGN', (16,)),
+                ('LABEL', (L2,)), ('LABEL', (L1,)), ('RET', ())]
+        assert optimize(code) == [('CMP', (rax, rcx)), ('ALIGN', (16,)),
+                                  ('LABEL', (L2,)), ('LABEL', (L1,)),
+                                  ('RET', ())]
+
+    def test_thread_jumps(self):
+        code = [('JE', (L1,)), ('ADD', (rax, 1)),
+                ('LABEL', (L1,)), ('JMP', (L2,)),
+                ('LABEL', (L3,)), ('ADD', (rax, 2)),
+                ('LABEL', (L2,)), ('JMP', (L3,))]
+        # the JMP after L1 now goes to the next instruction
+        assert optimize(code) == [('JE', (L3,)), ('ADD', (rax, 1)),
+                                  ('LABEL', (L1,)),
+                                  ('LABEL', (L3,)), ('ADD', (rax, 2)),
+                                  ('LABEL', (L2,)), ('JMP', (L3,))]
+
+    def test_thread_jumps_loop(self):
+        code = [('LABEL', (L1,)), ('JMP', (L2,)),
+                ('LABEL', (L2,)), ('JMP', (L1,))]
+        assert optimize(code) == [('LABEL', (L1,)),
+                                  ('LABEL', (L2,)), ('JMP', (L1,))]
+
+    def test_dead_code(self):
+        code = [('MOV', (rax, rcx)), ('RET', ()),
+                ('PXOR', (xmm0, xmm0)), ('RET', ())]
+        assert optimize(code) == [('MOV', (rax, rcx)), ('RET', ())]
+
+    def test_dead_code_until_label(self):
+        code = [('JE', (L1,)), ('JMP', (L2,)), ('ADD', (rax, 1)),
+                ('LABEL', (L2,)), ('RET', ()),
+                ('LABEL', (L1,)), ('ADD', (rax, 2)), ('RET', ())]
+        # the JMP becomes a jump to the next instruction
+        assert optimize(code) == [('JE', (L1,)),
+                                  ('LABEL', (L2,)), ('RET', ()),
+                                  ('LABEL', (L1,)), ('ADD', (rax, 2)),
+                                  ('RET', ())]
@@ -0,0 +1,57 @@
+import perfmap
+from perfmap import LINE_MARKER, NOP10
+
+def marker(line):
+    return b'\x48\xb8' + (LINE_MARKER + line).to_bytes(8, 'little')
+
+
+class TestLineMarkers:
+
+    def test_strip(self):
+        code = b'\x90' + marker(3) + b'\x90' * 5 + marker(4) + b'\xc3'
+        stripped, markers = perfmap.strip_line_markers(code)
+        assert stripped == b'\x90' + NOP10 + b'\x90' * 5 + NOP10 + b'\xc3'
+        assert markers == [(1, 3), (16, 4)]
+
+    def test_no_markers(self):
+        code = b'\x90\xc3'
+        assert perfmap.strip_line_markers(code) == (code, [])
+        # the tail of the marker, but not after MOV rax
+        code = b'\x90' * 8 + (LINE_MARKER >> 32).to_bytes(4, 'little')
+        assert perfmap.strip_line_markers(code) == (code, [])
+
+    def test_line_table(self):
+        symbols = [(0, 32, 'foo'), (32, 16, 'bar')]
+        markers = [(4, 1), (10, 3), (36, 1)]
+        assert perfmap.line_table(symbols, markers) == [
+            (4, 6, 'foo', 1), (10, 22, 'foo', 3), (36, 12, 'bar', 1)]
+        assert perfmap.line_table(symbols, []) == []
+
+
+class TestPerfMap:
+
+    def test_entries(self):
+        symbols = [(0, 32, 'foo'), (32, 16, 'bar')]
+        assert perfmap.entries(symbols) == [(0, 32, 'jit30min:foo'),
+                                            (32, 16, 'jit30min:bar')]
+        lines = [(4, 6, 'foo', 1), (10, 22, 'foo', 3)]
+        assert perfmap.entries(symbols, lines) == [
+            (0, 4, 'jit30min:foo'),
+            (4, 6, 'jit30min:foo:+1'),
+            (10, 22, 'jit30min:foo:+3'),
+            (32, 16, 'jit30min:bar')]
+
+    def test_register(self, tmpdir):
+        path = tmpdir.join('perf.map')
+        perfmap.register(0x1000, [(0, 16, 'foo')]) # disabled: ignored
+        perfmap.enable(str(path))
+        try:
+            assert perfmap.enabled
+            assert not perfmap.lines_enabled
+            perfmap.register(0x1000, [(0, 16, 'foo'), (16, 32, 'bar')])
+            perfmap.register(0x2000, [(0, 0, 'empty')])
+        finally:
+            perfmap.disable()
+        assert not perfmap.enabled
+        assert path.read() == ('1000 10 jit30min:foo\n'
+                               '1010 20 jit30min:bar\n')
@@ -0,0 +1,18 @@
+import profiler
+
+
+class TestProfiler:
+
+    def test_report(self):
+        counters = [('foo', 2, 'entries'), ('foo', 2, 'iterations'),
+                    ('foo', 2, 'cycles'), ('foo', 3, 'taken'),
+                    ('foo', 3, 'not_taken'), ('bar', 1, 'taken'),
+                    ('bar', 1, 'not_taken'), ('bar', 1, 'taken'),
+                    ('bar', 1, 'not_taken')]
+        values = [1, 10, 500, 4, 6, 1, 2, 3, 4]
+        assert profiler.report(counters, values) == {
+            ('foo', 2): {'entries': 1, 'iterations': 10, 'cycles': 500},
+            ('foo', 3): {'taken': 4, 'not_taken': 6},
+            # two ifs on the same line
+            ('bar', 1): {'taken': 4, 'not_taken': 6},
+            }
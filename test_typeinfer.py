@@ -0,0 +1,110 @@
+import ast
+import textwrap
+import pytest
+from typeinfer import Types
+
+def infer(src):
+    tree = ast.parse(textwrap.dedent(src))
+    return Types(tree.body[0])
+
+class TestTypes:
+
+    def test_constants(self):
+        types = infer("""
+        def foo(a):
+            i = 0
+            x = 0.0
+            y = a
+            return i
+        """)
+        assert types.ints == {'i'}
+
+    def test_arithmetic(self):
+        types = infer("""
+        def foo(a):
+            i = 1
+            j = i * 2 + i - 3
+            x = i / 2
+            y = i + a
+            return j
+        """)
+        assert types.ints == {'i', 'j'}
+
+    def test_fixpoint(self):
+        types = infer("""
+        def foo(a):
+            i = 0
+            j = 0
+            while i < 10:
+                j = i
+                i = i + a
+            k = j + 1
+            return k
+        """)
+        # i is assigned a float, hence j and k are floats too
+        assert types.ints == set()
+
+    def test_loop_counter(self):
+        types = infer("""
+        def foo(a, n):
+            tot = 0
+            i = 0
+            while i < n:
+                tot = tot + a[i]
+                i = i + 1
+            return tot
+        """)
+        assert types.ints == {'i'}
+
+    def test_annotations(self):
+        types = infer("""
+        def foo(a, n: int, x: float):
+            return n
+        """)
+        assert types.ints == {'n'}
+        assert types.argtype('n') == 'int64_t'
+        assert types.argtype('a') == 'double'
+        assert types.argtype('x') == 'double'
+
+    def test_int_argument(self):
+        types = infer("""
+        def foo(n: int):
+            n = n - 1
+            return n
+        """)
+        assert types.ints == {'n'}
+        with pytest.raises(NotImplementedError):
+            infer("""
+            def foo(n: int):
+                n = n / 2
+            """)
+        with pytest.raises(NotImplementedError):
+            infer("""
+            def foo(n: str):
+                pass
+            """)
+
+    def test_is_int(self):
+        types = infer("""
+        def foo(a, n: int):
+            pass
+        """)
+        def is_int(src):
+            return types.is_int(ast.parse(src, mode='eval').body)
+        assert is_int('n + 1')
+        assert is_int('n * n - 3')
+        assert not is_int('n / 1')
+        assert not is_int('n + 1.0')
+        assert is_int('-n + +n')
+        assert not is_int('-a')
+        assert not is_int('a + 1')
+        assert not is_int('a[n]')
+        assert not is_int('True')
+        assert is_int('int(a)')
+        assert is_int('int(a) * n')
+        assert not is_int('int(a, 2)')
+        assert is_int('floor(a) + math.ceil(a)')
+        assert is_int('abs(n) + min(n, 1) + max(n, 2, n)')
+        assert not is_int('abs(a)')
+        assert not is_int('min(n, a)')
+        assert not is_int('sqrt(n)')
@@ -0,0 +1,131 @@
+import ast
+import array
+import textwrap
+import jit
+from vectorizer import VectorLoop
+
+def analyze(src, arrays):
+    tree = ast.parse(textwrap.dedent(src))
+    loop = tree.body[0].body[-1]
+    return VectorLoop.analyze(loop, arrays)
+
+def instructions(comp):
+    return [name for name, args in comp.asm.instructions]
+
+
+class TestAnalysis:
+
+    def test_elementwise(self):
+        vloop = analyze("""
+        def foo(a, b, c, n, k):
+            while i < n:
+                c[i] = a[i] * k + b[i] * 2
+                i = i + 1
+        """, {'a', 'b', 'c'})
+        assert vloop.index == 'i'
+        assert vloop.limit.id == 'n'
+        assert [name for name, _ in vloop.stores] == ['c']
+        assert vloop.reductions == []
+        assert vloop.invariants == [('name', 'k'), ('num', 2)]
+
+    def test_reduction(self):
+        vloop = analyze("""
+        def foo(a, b, n):
+            while i < n:
+                s = s + a[i] * b[i]
+                t = t - a[i]
+                i = i + 1
+        """, {'a', 'b'})
+        assert [name for name, _, _ in vloop.reductions] == ['s', 't']
+        assert vloop.registers_needed() == 2*2 + 2
+
+    def test_not_vectorizable(self):
+        bodies = [
+            # the index is used as a value
+            "a[i] = i",
+            # loop-carried dependency
+            "a[i] = x\n    x = a[i]",
+            # not the same index
+            "a[i] = b[n]",
+            # unsupported statement
+            "if a[i] < 0:\n        a[i] = 0",
+            # reduction variable read in the loop
+            "s = s + a[i]\n    a[i] = s",
+            ]
+        for body in bodies:
+            src = "def foo(a, b, n):\n  while i < n:\n    %s\n    i = i + 1"
+            assert analyze(src % body, {'a', 'b'}) is None, body
+
+    def test_empty(self):
+        # only the increment of the index: there is nothing to vectorize
+        assert analyze("""
+        def foo(a, n):
+            while i < n:
+                i = i + 1
+        """, {'a'}) is None
+
+
+class TestCodegen:
+
+    def test_elementwise(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b, c, n, k):
+            i = 0
+            while i < n:
+                c[i] = a[i] * k + b[i]
+                i = i + 1
+        """)
+        fn = comp.compile()
+        names = instructions(comp)
+        assert 'MULPD' in names
+        assert 'ADDPD' in names
+        for n in range(12):
+            a = array.array('d', range(n))
+            b = array.array('d', range(100, 100 + n))
+            c = array.array('d', [0] * (n + 1))
+            fn(a, b, c, n, 3)
+            assert list(c) == [a[i] * 3 + b[i] for i in range(n)] + [0]
+
+    def test_reduction(self):
+        comp = jit.AstCompiler("""
+        def foo(a, b, n):
+            s = 0
+            i = 0
+            while i < n:
+                s = s + a[i] * b[i]
+                i = i + 1
+            return s
+        """)
+        fn = comp.compile()
+        for n in range(12):
+            # integer values, so that the result is exact in any order
+            a = array.array('d', range(n))
+            b = array.array('d', range(2, n + 2))
+            assert fn(a, b, n) == sum(x * y for x, y in zip(a, b))
+
+    def test_fractional_index(self):
+        comp = jit.AstCompiler("""
+        def foo(a, start, n):
+            s = 0
+            i = start
+            while i < n:
+                s = s + a[i]
+                i = i + 1
+            return s
+        """)
+        fn = comp.compile()
+        a = array.array('d', range(10))
+        assert fn(a, 0, 10) == 45
+        # a[0.5] + a[1.5] + ... + a[9.5] with truncation
+        assert fn(a, 0.5, 10) == 45
+
+    def test_disabled(self):
+        comp = jit.AstCompiler("""
+        def foo(a, n):
+            i = 0
+            while i < n:
+                a[i] = a[i] * 2
+                i = i + 1
+        """, vectorize=False)
+        comp.compile()
+        assert 'MULPD' not in instructions(comp)
@@ -0,0 +1,107 @@
+"""
+Type inference: find which variables of a function hold integers.
+
+A variable is an int if all the values assigned to it are ints, i.e. int
+constants, int variables, calls to int(), floor() and ceil(), abs(), min()
+and max() of ints, and +, -, * between ints. Everything else is a
+float, in particular the result of / and the elements of arrays. Arguments
+are floats, unless they are annotated with int:
+
+    def foo(a, n: int):
+        ...
+
+Ints are compiled to 64-bit general purpose registers: like in C, they
+silently wrap around on overflow.
+"""
+import ast
+
+INT_OPS = (ast.Add, ast.Sub, ast.Mult)
+
+
+# the builtins which always return an int
+INT_BUILTINS = ('int', 'floor', 'ceil')
+# the builtins which return an int if all their arguments are ints
+POLY_BUILTINS = ('abs', 'min', 'max')
+
+
+def call_name(node):
+    """
+    Return the name of the function called by node, or None if it's not a
+    name: math.f is considered the same as f
+    """
+    func = node.func
+    if isinstance(func, ast.Name):
+        return func.id
+    if (isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name)
+        and func.value.id == 'math'):
+        return func.attr
+    return None
+
+def is_int_call(node):
+    """
+    Check whether node is a call to int(), floor() or ceil(), which the
+    compiler supports as builtins
+    """
+    return (isinstance(node, ast.Call) and call_name(node) in INT_BUILTINS and
+            len(node.args) == 1 and not node.keywords)
+
+
+def annotation(arg):
+    ann = arg.annotation
+    if ann is None:
+        return 'float'
+    if isinstance(ann, ast.Name) and ann.id in ('int', 'float'):
+        return ann.id
+    raise NotImplementedError('unsupported annotation for %s' % arg.arg)
+
+
+class Types:
+
+    def __init__(self, funcdef):
+        argnames = [arg.arg for arg in funcdef.args.args]
+        self.ints = set(arg.arg for arg in funcdef.args.args
+                        if annotation(arg) == 'int')
+        values = {} # varname -> [assigned values]
+        for node in ast.walk(funcdef):
+            if isinstance(node, ast.Assign):
+                for target in node.targets:
+                    if isinstance(target, ast.Name):
+                        values.setdefault(target.id, []).append(node.value)
+        # start by assuming that all the local variables are ints, and
+        # demote them to float until we reach a fixpoint
+        local_vars = set(values) - set(argnames)
+        self.ints |= local_vars
+        changed = True
+        while changed:
+            changed = False
+            for varname in sorted(self.ints & local_vars):
+                if not all(self.is_int(value) for value in values[varname]):
+                    self.ints.remove(varname)
+                    changed = True
+        for varname in self.ints - local_vars:
+            if not all(self.is_int(value) for value in values.get(varname, [])):
+                raise NotImplementedError('cannot assign a float to the int '
+                                          'argument %s' % varname)
+
+    def is_int(self, node):
+        """
+        Return True if the expression node computes an int
+        """
+        if isinstance(node, ast.Num):
+            # bools are not ast.Num on Python 3.8+
+            return type(node.n) is int
+        elif isinstance(node, ast.Name):
+            return node.id in self.ints
+        elif isinstance(node, ast.BinOp):
+            return (isinstance(node.op, INT_OPS) and
+                    self.is_int(node.left) and self.is_int(node.right))
+        elif isinstance(node, ast.UnaryOp):
+            return (isinstance(node.op, (ast.USub, ast.UAdd)) and
+                    self.is_int(node.operand))
+        elif (isinstance(node, ast.Call) and
+              call_name(node) in POLY_BUILTINS and node.args):
+            return all(self.is_int(arg) for arg in node.args)
+        return is_int_call(node)
+
+    def argtype(self, argname):
+        return 'int64_t' if argname in self.ints else 'double'
@@ -0,0 +1,335 @@
+"""
+Auto-vectorization of simple loops over arrays, using packed SSE2
+instructions.
+
+We recognize loops of this shape:
+
+    while i < n:
+        a[i] = <expr>
+        s = s + <expr>
+        ...
+        i = i + 1
+
+where each <expr> uses only the +, -, *, / operators on array elements
+indexed by i, constants and variables which are not modified by the loop.
+The vectorized loop processes UNROLL*2 elements per iteration; reductions
+are split across UNROLL accumulators to break the dependency chain between
+iterations, and the remaining elements are handled by the original scalar
+loop.
+
+Note that vectorized reductions add the elements in a different order, so
+the result might differ in the last bits from the scalar loop. Moreover,
+like in C, we assume that different array arguments don't partially
+overlap.
+"""
+import ast
+
+UNROLL = 2
+LANES = 2
+
+PACKED_OPS = {
+    ast.Add: 'ADDPD',
+    ast.Sub: 'SUBPD',
+    ast.Mult: 'MULPD',
+    ast.Div: 'DIVPD',
+    }
+
+
+def is_increment(stmt, varname):
+    """
+    Check whether stmt is "varname = varname + 1"
+    """
+    if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and
+            isinstance(stmt.targets[0], ast.Name) and
+            stmt.targets[0].id == varname):
+        return False
+    value = stmt.value
+    if not (isinstance(value, ast.BinOp) and isinstance(value.op, ast.Add)):
+        return False
+    operands = [value.left, value.right]
+    return (any(isinstance(op, ast.Name) and op.id == varname
+                for op in operands) and
+            any(isinstance(op, ast.Num) and op.n == 1 for op in operands))
+
+
+class VectorLoop:
+    """
+    The analysis of a vectorizable loop. Use VectorLoop.analyze() to build
+    it, and emit() to generate the code of the vectorized part.
+    """
+
+    def __init__(self, index, limit, stores, reductions):
+        self.index = index            # name of the induction variable
+        self.limit = limit            # Name or Num node
+        self.stores = stores          # [(arrayname, expr)]
+        self.reductions = reductions  # [(varname, op, expr)]
+        self.invariants = []          # [('name', varname) or ('num', value)]
+        for _, expr in stores:
+            self._collect_invariants(expr)
+        for _, _, expr in reductions:
+            self._collect_invariants(expr)
+
+    @classmethod
+    def analyze(cls, loop, arrays, ints=()):
+        """
+        Return a VectorLoop if loop can be vectorized, else None. arrays is
+        the set of the array arguments of the function, ints the set of the
+        int variables.
+        """
+        test = loop.test
+        if not (isinstance(test, ast.Compare) and len(test.ops) == 1 and
+                isinstance(test.ops[0], ast.Lt) and
+                isinstance(test.left, ast.Name)):
+            return None
+        index = test.left.id
+        limit = test.comparators[0]
+        body = loop.body
+        if (not body or index in arrays or
+            not is_increment(body[-1], index)):
+            return None
+        assigned = set()
+        for stmt in body:
+            if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1):
+                return None
+            target = stmt.targets[0]
+            if isinstance(target, ast.Name):
+                if target.id in assigned:
+                    return None
+                assigned.add(target.id)
+        if not (isinstance(limit, ast.Num) or
+                isinstance(limit, ast.Name) and limit.id not in assigned and
+                limit.id not in arrays):
+            return None
+        from compiler import subscript_index
+        #
+        def is_vector_expr(node):
+            if isinstance(node, ast.BinOp):
+                return (type(node.op) in PACKED_OPS and
+                        is_vector_expr(node.left) and
+                        is_vector_expr(node.right))
+            elif isinstance(node, ast.Subscript):
+                return is_element(node)
+            elif isinstance(node, ast.Name):
+                return node.id not in assigned and node.id not in arrays
+            return isinstance(node, ast.Num)
+        #
+        def is_element(node):
+            idx = subscript_index(node)
+            return (isinstance(node.value, ast.Name) and
+                    node.value.id in arrays and
+                    isinstance(idx, ast.Name) and idx.id == index)
+        #
+        stores = []
+        reductions = []
+        for stmt in body[:-1]:
+            target = stmt.targets[0]
+            value = stmt.value
+            if isinstance(target, ast.Subscript):
+                if not (is_element(target) and is_vector_expr(value)):
+                    return None
+                stores.append((target.value.id, value))
+                continue
+            varname = target.id
+            if (varname == index or varname in ints or
+                not isinstance(value, ast.BinOp)):
+                return None
+            left, op, right = value.left, value.op, value.right
+            if isinstance(left, ast.Name) and left.id == varname:
+                expr = right
+            elif (isinstance(op, ast.Add) and isinstance(right, ast.Name) and
+                  right.id == varname):
+                expr = left
+            else:
+                return None
+            if type(op) not in (ast.Add, ast.Sub) or not is_vector_expr(expr):
+                return None
+            reductions.append((varname, op, expr))
+        if not stores and not reductions:
+            # an empty loop: there is nothing to vectorize
+            return None
+        return cls(index, limit, stores, reductions)
+
+    def _collect_invariants(self, node):
+        if isinstance(node, ast.BinOp):
+            self._collect_invariants(node.left)
+            self._collect_invariants(node.right)
+        elif isinstance(node, (ast.Name, ast.Num)):
+            key = self.invariant_key(node)
+            if key not in self.invariants:
+                self.invariants.append(key)
+
+    def invariant_key(self, node):
+        if isinstance(node, ast.Name):
+            return ('name', node.id)
+        return ('num', node.n)
+
+    # register usage
+
+    def need(self, node, as_operand=False):
+        """
+        Sethi-Ullman number of a vector expression. Array elements always
+        need a register, since packed SSE instructions require aligned
+        memory operands.
+        """
+        if isinstance(node, ast.BinOp):
+            left = self.need(node.left)
+            right = self.need(node.right, as_operand=True)
+            if left == right:
+                return left + 1
+            return max(left, right)
+        elif isinstance(node, ast.Subscript):
+            return 1
+        return 0 if as_operand else 1
+
+    def registers_needed(self):
+        exprs = ([expr for _, expr in self.stores] +
+                 [expr for _, _, expr in self.reductions])
+        # at least two temporaries are needed to evaluate the loop test
+        temps = max([2] + [self.need(expr) for expr in exprs])
+        return len(self.invariants) + UNROLL*len(self.reductions) + temps
+
+    # code generation
+
+    def emit(self, comp):
+        """
+        Emit the vectorized loop: when it finishes, the index variable points
+        to the first element which still has to be processed by the scalar
+        loop.
+        """
+        asm = comp.asm
+        regs = comp.regs
+        scalar_label = asm.Label()
+        vdone_label = asm.Label()
+        loop_label = asm.Label()
+        index = ast.Name(id=self.index, ctx=ast.Load())
+        step = UNROLL * LANES
+        #
+        # we can use a float index to compute addresses only if it's an
+        # integer
+        int_index = comp.is_int(index)
+        if not int_index:
+            index_op = comp.var(self.index)
+            asm.CVTTSD2SI(asm.rax, index_op)
+            tmp = regs.new_temp()
+            asm.CVTSI2SD(tmp, asm.rax)
+            asm.UCOMISD(tmp, comp.var(self.index))
+            regs.free_temp(tmp)
+            asm.JNE(scalar_label)
+            asm.JP(scalar_label)
+        #
+        # broadcast the invariants and zero the accumulators
+        self.broadcast = []
+        for key in self.invariants:
+            kind, value = key
+            reg = regs.new_temp()
+            if kind == 'name' and value in comp.types.ints:
+                asm.CVTSI2SD(reg, comp.var(value))
+            elif kind == 'name':
+                asm.MOVSD(reg, comp.var(value))
+            else:
+                asm.MOVSD(reg, asm.const(value))
+            asm.UNPCKLPD(reg, reg)
+            self.broadcast.append((key, reg))
+        self.accumulators = []
+        for _ in self.reductions:
+            accs = [regs.new_temp() for _ in range(UNROLL)]
+            for acc in accs:
+                asm.XORPD(acc, acc)
+            self.accumulators.append(accs)
+        #
+        # i + step - 1 < n
+        last = ast.BinOp(left=index, op=ast.Add(), right=ast.Num(n=step - 1))
+        test = ast.Compare(left=last, ops=[ast.Lt()], comparators=[self.limit])
+        comp.cond_jump(test, vdone_label, False)
+        asm.ALIGN(16)
+        asm.LABEL(loop_label)
+        if int_index:
+            asm.MOV(asm.rax, comp.var(self.index))
+        else:
+            asm.CVTTSD2SI(asm.rax, comp.var(self.index))
+        for u in range(UNROLL):
+            for arrayname, expr in self.stores:
+                reg = self.emit_expr(comp, expr, u)
+                asm.MOVUPD(self.element(comp, arrayname, u), reg)
+                regs.free_temp(reg)
+            for (varname, op, expr), accs in zip(self.reductions,
+                                                 self.accumulators):
+                reg = self.emit_expr(comp, expr, u)
+                getattr(asm, PACKED_OPS[type(op)])(accs[u], reg)
+                regs.free_temp(reg)
+        increment = ast.Assign(
+            targets=[ast.Name(id=self.index, ctx=ast.Store())],
+            value=ast.BinOp(left=index, op=ast.Add(), right=ast.Num(n=step)))
+        comp.visit(increment)
+        comp.cond_jump(test, loop_label, True)
+        asm.LABEL(vdone_label)
+        #
+        # sum the accumulators into the reduction variables. Subtractions
+        # were accumulated as negative values, so we always add.
+        for (varname, op, expr), accs in zip(self.reductions,
+                                             self.accumulators):
+            acc = accs[0]
+            for other in accs[1:]:
+                asm.ADDPD(acc, other)
+            tmp = regs.new_temp()
+            asm.MOVAPD(tmp, acc)
+            asm.UNPCKHPD(tmp, tmp)
+            asm.ADDSD(acc, tmp)
+            regs.free_temp(tmp)
+            if comp.in_register(varname):
+                asm.ADDSD(comp.var(varname), acc)
+            else:
+                asm.ADDSD(acc, comp.var(varname))
+                asm.MOVSD(comp.var(varname), acc)
+        asm.LABEL(scalar_label)
+        for accs in self.accumulators:
+            for acc in accs:
+                regs.free_temp(acc)
+        for key, reg in self.broadcast:
+            regs.free_temp(reg)
+
+    def element(self, comp, arrayname, u):
+        base = comp.arrays[arrayname]
+        offset = 8 * LANES * u
+        if offset:
+            return comp.asm.oword[base + comp.asm.rax*8 + offset]
+        return comp.asm.oword[base + comp.asm.rax*8]
+
+    def invariant_reg(self, node):
+        key = self.invariant_key(node)
+        for k, reg in self.broadcast:
+            if k == key:
+                return reg
+        raise KeyError(key)
+
+    def emit_expr(self, comp, node, u):
+        """
+        Evaluate node for the u-th vector of the unrolled iteration, and
+        return a temporary register holding the result
+        """
+        asm = comp.asm
+        regs = comp.regs
+        if isinstance(node, ast.Subscript):
+            reg = regs.new_temp()
+            asm.MOVUPD(reg, self.element(comp, node.value.id, u))
+            return reg
+        elif not isinstance(node, ast.BinOp):
+            reg = regs.new_temp()
+            asm.MOVAPD(reg, self.invariant_reg(node))
+            return reg
+        op = getattr(asm, PACKED_OPS[type(node.op)])
+        right_node = node.right
+        if self.need(right_node, as_operand=True) > self.need(node.left):
+            right = self.emit_expr(comp, right_node, u)
+            left = self.emit_expr(comp, node.left, u)
+            right_owned = True
+        else:
+            left = self.emit_expr(comp, node.left, u)
+            if isinstance(right_node, (ast.Name, ast.Num)):
+                right, right_owned = self.invariant_reg(right_node), False
+            else:
+                right, right_owned = self.emit_expr(comp, right_node, u), True
+        op(left, right)
+        if right_owned:
+            regs.free_temp(right)
+        return left